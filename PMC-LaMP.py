@@ -53,6 +53,13 @@ def send_query_to_server(query):
         headers = {"Content-Type": "application/json"}
 
         response = requests.post(url, json=json_payload, headers=headers)
+        if response.status_code in (429, 503):
+            # Still loading, or too busy: the server says when to come back
+            st.warning(
+                f"{response.json()['detail']}. Please try again in "
+                f"{response.headers.get('Retry-After', 'a few')} seconds."
+            )
+            return None
         response.raise_for_status()
         response_data = response.json()
 
@@ -64,6 +71,57 @@ def send_query_to_server(query):
         return None
 
 
+def stream_query_to_server(query):
+    """
+    Sends a query to the streaming endpoint and shows the answer as it is generated.
+
+    Args:
+        query (str): The user's query.
+
+    Returns:
+        dict: The full response (query, answer, references), or None if an error occurred.
+    """
+    try:
+        url = f"http://{SERVER_IP}:8000/query/stream"
+        json_payload = {"query": query}
+        headers = {"Content-Type": "application/json"}
+
+        with requests.post(url, json=json_payload, headers=headers, stream=True) as response:
+            if response.status_code in (429, 503):
+                st.warning(
+                    f"{response.json()['detail']}. Please try again in "
+                    f"{response.headers.get('Retry-After', 'a few')} seconds."
+                )
+                return None
+            response.raise_for_status()
+
+            response_data = {"query": query, "answer": "", "references": []}
+            answer_placeholder = st.empty()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                if event["type"] == "references":
+                    response_data["references"] = event["references"]
+                elif event["type"] == "token":
+                    response_data["answer"] += event["text"]
+                    answer_placeholder.write(f"Response: {response_data['answer']}")
+                elif event["type"] == "done":
+                    response_data["answer"] = event["answer"]
+                elif event["type"] == "error":
+                    st.error(f"Error during the query request: {event['detail']}")
+                    return None
+            # The complete answer is shown with its sources by display_conversation
+            answer_placeholder.empty()
+
+        save_conversation(query, response_data)
+
+        return response_data
+    except Exception as e:
+        st.error(f"Error during the query request: {e}")
+        return None
+
+
 def display_conversation(answer, references):
     """
     Displays the conversation response and reference sources.
@@ -106,13 +164,17 @@ def main():
     )
 
     query = st.text_input("Enter your query here...", key="query_input")
+    stream_answer = st.checkbox("Show the answer as it is generated", value=True)
     submit_button = st.button("Submit Query")
 
     if submit_button or (query and query != st.session_state.get("last_query")):
         if query:
             st.session_state["last_query"] = query
             with st.spinner("Processing..."):
-                response = send_query_to_server(query)
+                if stream_answer:
+                    response = stream_query_to_server(query)
+                else:
+                    response = send_query_to_server(query)
 
                 if response:
                     query = response.get("query", "")
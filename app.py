@@ -4,7 +4,9 @@ import subprocess
 import sys
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+import routers.admin_router as admin_router
 import routers.query_router as query_router
+import routers.status_router as status_router
 from services.utils import configure_logging
 from contextlib import asynccontextmanager
 
@@ -16,9 +18,48 @@ log = logging.getLogger(__name__)
 async def lifespan(app: FastAPI):
     """Lifespan context manager for FastAPI."""
     from services.model_initializations import ModelLoader
+    from services.answer_cache import AnswerCache
+    from services.inference_executor import InferenceExecutor
+    from config import (
+        ANSWER_CACHE_ENTRIES,
+        ANSWER_CACHE_MB,
+        ANSWER_CACHE_TTL,
+        ANSWER_CACHE_PATH,
+        ANSWER_CACHE_DISK_ENTRIES,
+        ANSWER_CACHE_SIMILARITY,
+        GENERATION_WORKERS,
+        GENERATION_QUEUE_SIZE,
+        GENERATION_TIMEOUT,
+        RETRIEVAL_WORKERS,
+        RETRIEVAL_QUEUE_SIZE,
+        RETRIEVAL_TIMEOUT,
+    )
 
     log.info("Starting FastAPI application...")
-    app.state.model_dependencies = ModelLoader().load_models()
+    # Models load in the background; /ready reports their progress and
+    # retrieval-only queries are served as soon as the index is up
+    app.state.model_loader = ModelLoader()
+    app.state.model_loader.start_loading()
+    # Queries run on bounded worker pools so the event loop stays responsive;
+    # retrieval-only queries are not stuck behind generations
+    app.state.executors = {
+        "generation": InferenceExecutor(
+            "generation", GENERATION_WORKERS, GENERATION_QUEUE_SIZE, GENERATION_TIMEOUT
+        ),
+        "retrieval": InferenceExecutor(
+            "retrieval", RETRIEVAL_WORKERS, RETRIEVAL_QUEUE_SIZE, RETRIEVAL_TIMEOUT
+        ),
+    }
+    app.state.answer_cache = None
+    if ANSWER_CACHE_ENTRIES:
+        app.state.answer_cache = AnswerCache(
+            max_entries=ANSWER_CACHE_ENTRIES,
+            max_bytes=ANSWER_CACHE_MB * 1024 * 1024,
+            ttl=ANSWER_CACHE_TTL,
+            path=ANSWER_CACHE_PATH,
+            max_disk_entries=ANSWER_CACHE_DISK_ENTRIES,
+            semantic_threshold=ANSWER_CACHE_SIMILARITY,
+        )
 
     subprocess.Popen(
         [sys.executable, "-m", "streamlit", "run", "PMC-LaMP.py"],
@@ -31,6 +72,8 @@ async def lifespan(app: FastAPI):
     
     yield
     log.info("Shutting down FastAPI application...")
+    for executor in app.state.executors.values():
+        executor.shutdown()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -43,6 +86,8 @@ app.add_middleware(
 )
 
 app.include_router(query_router.router)
+app.include_router(status_router.router)
+app.include_router(admin_router.router)
 
 
 if __name__ == "__main__":
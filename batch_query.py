@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import logging
+import argparse
+from pathlib import Path
+from config import GENERATION_BATCH_SIZE
+from services.model_initializations import COMPONENTS, RETRIEVAL_COMPONENTS, ModelLoader
+from services.query_processor import answer_with_rag_batch, retrieve_documents_batch
+from services.utils import configure_logging, format_time
+
+# Fields tried, in order, for the question of each input record
+QUESTION_FIELDS = ["question", "query", "body", "title"]
+
+
+def parse_arguments():
+    """Sets up command-line argument parser."""
+    parser = argparse.ArgumentParser(
+        description="Answer a JSONL file of questions without the API server"
+    )
+    parser.add_argument(
+        "--input",
+        type=str,
+        required=True,
+        help="JSONL file with one question per line",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=True,
+        help="JSONL file the answers are appended to; rerun to resume",
+    )
+    parser.add_argument(
+        "--id_field",
+        type=str,
+        default="request_id",
+        help="Field identifying each question (default: request_id, else id, else "
+        "the line number)",
+    )
+    parser.add_argument(
+        "--question_field",
+        type=str,
+        default=None,
+        help=f"Field holding the question (default: the first of {QUESTION_FIELDS})",
+    )
+    parser.add_argument(
+        "--retrieval_only",
+        action="store_true",
+        help="Only retrieve the references, without loading the reader model",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=32,
+        help="# of questions retrieved together and written per step",
+    )
+    parser.add_argument(
+        "--num_docs_final",
+        type=int,
+        default=5,
+        help="# of references per question",
+    )
+    parser.add_argument(
+        "--filters",
+        type=json.loads,
+        default=None,
+        help='Metadata filters applied to every question, as JSON (e.g. '
+        '\'{"year_min": 2020, "sections": ["RESULTS"]}\')',
+    )
+    return parser.parse_args()
+
+
+def read_questions(input_path: Path, id_field: str, question_field=None):
+    """Reads (id, question) pairs from a JSONL file"""
+    questions = []
+    with open(input_path, "r") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            fields = [question_field] if question_field else QUESTION_FIELDS
+            field = next((name for name in fields if record.get(name)), None)
+            if field is None:
+                raise ValueError(f"No question on line {line_number} of {input_path}")
+            question_id = record.get(id_field, record.get("id", line_number))
+            questions.append((str(question_id), record[field]))
+    return questions
+
+
+def read_finished_ids(output_path: Path) -> set:
+    """Ids already in the output; drops a last line cut off by an interrupted run"""
+    if not output_path.exists():
+        return set()
+    finished, lines = set(), []
+    with open(output_path, "r") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                logging.warning(f"Dropping an incomplete line of {output_path}")
+                continue
+            finished.add(result["id"])
+            lines.append(line if line.endswith("\n") else line + "\n")
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        f.writelines(lines)
+    os.replace(tmp_path, output_path)
+    return finished
+
+
+def main():
+    configure_logging()
+    args = parse_arguments()
+    start_time = time.time()
+
+    input_path, output_path = Path(args.input), Path(args.output)
+    questions = read_questions(input_path, args.id_field, args.question_field)
+    finished = read_finished_ids(output_path)
+    pending = [q for q in questions if q[0] not in finished]
+    logging.info(
+        f"{len(questions)} questions, {len(questions) - len(pending)} already answered"
+    )
+    if not pending:
+        return
+
+    model_loader = ModelLoader()
+    components = RETRIEVAL_COMPONENTS if args.retrieval_only else COMPONENTS
+    model_dependencies = model_loader.load_models(components, watch_index=False)
+
+    with open(output_path, "a") as output:
+        for start in range(0, len(pending), args.batch_size):
+            batch = pending[start : start + args.batch_size]
+            texts = [question for _, question in batch]
+            if args.retrieval_only:
+                results = [
+                    ("", references, None)
+                    for references in retrieve_documents_batch(
+                        texts,
+                        model_dependencies.knowledge_base,
+                        num_docs_final=args.num_docs_final,
+                        reranker=model_dependencies.reranker,
+                        filters=args.filters,
+                    )
+                ]
+            else:
+                results = answer_with_rag_batch(
+                    texts,
+                    model_dependencies.reader_llm,
+                    model_dependencies.knowledge_base,
+                    model_dependencies.rag_prompt_template,
+                    reranker=model_dependencies.reranker,
+                    num_docs_final=args.num_docs_final,
+                    batch_size=GENERATION_BATCH_SIZE,
+                    filters=args.filters,
+                    context_packer=model_dependencies.context_packer,
+                )
+            for (question_id, question), (answer, references, prompt_tokens) in zip(
+                batch, results
+            ):
+                result = {
+                    "id": question_id,
+                    "query": question,
+                    "answer": answer,
+                    "references": references,
+                    "prompt_tokens": prompt_tokens,
+                }
+                output.write(json.dumps(result) + "\n")
+            # Everything written so far survives an interruption
+            output.flush()
+            os.fsync(output.fileno())
+            done = start + len(batch)
+            logging.info(
+                f"Answered {done}/{len(pending)} questions in "
+                f"{format_time(int(time.time() - start_time))}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -5,11 +5,79 @@ import os
 SERVER_IP = os.getenv('SERVER_IP', 'localhost')
 
 FAISS_INDEX = "indexes/faiss_index"
+# Search-time settings of IVF (nprobe) and HNSW (efSearch) indexes built with
+# index_generator.py --index_type; see ann.json in the index for recall data
+FAISS_NPROBE = 16
+FAISS_EF_SEARCH = 128
+# Indexes built with a lossy --vector_codec fetch this many times k candidates
+# and re-score them against the full-precision vectors
+FAISS_RESCORE_FACTOR = 4
+# Seconds between checks for a newly published index version (0 disables the
+# watcher; POST /admin/reload still works), the token /admin requests must
+# send in X-Admin-Token (unset disables the /admin endpoints), and the
+# directory POST /admin/reload may load indexes from
+INDEX_WATCH_INTERVAL = 30
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+INDEX_ROOT = "indexes"
+# Query admission control: generation and retrieval-only queries each run on
+# a bounded pool of workers with a bounded wait queue. Queries beyond that are
+# refused with 429, and queries not answered within the timeout (in seconds,
+# queue wait included) with 503; both ask clients to retry after
+# OVERLOAD_RETRY_AFTER seconds
+GENERATION_WORKERS = 8
+GENERATION_QUEUE_SIZE = 8
+GENERATION_TIMEOUT = 180
+RETRIEVAL_WORKERS = 4
+RETRIEVAL_QUEUE_SIZE = 32
+RETRIEVAL_TIMEOUT = 30
+OVERLOAD_RETRY_AFTER = 5
+# Concurrent generations are micro-batched: prompts arriving within
+# GENERATION_BATCH_WAIT seconds of each other are generated together, up to
+# GENERATION_BATCH_SIZE prompts (1 disables batching) and
+# GENERATION_BATCH_TOKENS padded prompt + new tokens. Keep GENERATION_WORKERS
+# at least GENERATION_BATCH_SIZE so batches can fill; see GET /load/generation
+GENERATION_BATCH_SIZE = 8
+GENERATION_BATCH_WAIT = 0.05
+GENERATION_BATCH_TOKENS = 16384
+# The reader's key/value cache for the part of the prompt before the context
+# (system message and chat markup) is computed once at startup, and every
+# generation starts from a copy of it; see GET /load/prefix_cache
+PREFIX_KV_CACHE = True
+# Most questions accepted by one POST /query/batch request
+MAX_BATCH_QUERIES = 64
+# Answer cache: up to ANSWER_CACHE_ENTRIES answers (0 disables the cache) and
+# ANSWER_CACHE_MB in memory, kept for ANSWER_CACHE_TTL seconds. Answers are
+# also stored in ANSWER_CACHE_PATH (None keeps them in memory only) and reused
+# after a restart. With ANSWER_CACHE_SIMILARITY (e.g. 0.95), a query whose
+# embedding is at least this similar to a cached query reuses its answer
+ANSWER_CACHE_ENTRIES = 1024
+ANSWER_CACHE_MB = 64
+ANSWER_CACHE_TTL = 24 * 3600
+ANSWER_CACHE_PATH = "cache/answers.sqlite"
+ANSWER_CACHE_DISK_ENTRIES = 100000
+ANSWER_CACHE_SIMILARITY = None
 
 
 READER_MODEL = "HuggingFaceH4/zephyr-7b-beta"
 EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L12-v2"
-# RERANKER_MODEL = RAGPretrainedModel.from_pretrained("colbert-ir/colbertv2.0")
+# Also search the BM25 index built with the FAISS index and fuse both result
+# lists, which helps with gene symbols, drug names and trial IDs
+LEXICAL_SEARCH = True
+# Cross-encoder that reranks RERANK_CANDIDATES retrieved chunks on the CPU
+# (None fetches only the chunks that are used). Scoring a query's candidates
+# is cut short to stay within RERANK_BUDGET seconds
+RERANKER_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+RERANKER_DEVICE = "cpu"
+RERANK_CANDIDATES = 30
+RERANK_BATCH_SIZE = 16
+RERANK_BUDGET = 0.25
+# Reader prompts (template, question and context) are kept within
+# PROMPT_TOKEN_BUDGET reader-tokenizer tokens (None joins the retrieved chunks
+# as they are): adjacent or overlapping chunks of an article are merged, and a
+# chunk sharing CONTEXT_DUPLICATE_THRESHOLD of its word 5-grams with one
+# already in the context is dropped
+PROMPT_TOKEN_BUDGET = 2048
+CONTEXT_DUPLICATE_THRESHOLD = 0.8
 PROMPT_TEMPLATE = [
     {
         "role": "system",
@@ -202,7 +202,7 @@ def download_articles(pmcid_file):
 
 
 def generate_index(
-    articles_dir, keyword, max_files=250000, group_size=1000, chunk_size=1000, chunk_overlap=20
+    articles_dir, keyword, max_files=250000, max_memory=2048, chunk_size=None, chunk_overlap=20
 ):
     """Generate FAISS index from downloaded articles."""
     print_section("Generating FAISS Index")
@@ -216,18 +216,11 @@ def generate_index(
     article_count = len(article_files)
     print(f"Found {article_count} articles to index.")
 
-    # Adjust group size if very few articles
-    if article_count < 100:
-        group_size = min(group_size, article_count)
-        print(f"Adjusting group size to {group_size} for small article collection")
-
-    # Calculate expected processing groups
-    expected_groups = (article_count + group_size - 1) // group_size
-    print(f"Will process articles in approximately {expected_groups} groups")
+    print(f"Using a memory budget of {max_memory} MB for the indexing pipeline")
 
     print("\nStarting index generation...")
     print("This may take a while depending on the number of articles.")
-    print("Progress will be displayed as groups are processed:")
+    print("Progress will be displayed as batches are processed:")
 
     index_name = f"faiss_index_{keyword.replace(' ', '_')}"
     command = (
@@ -235,11 +228,12 @@ def generate_index(
         f"--document_path {articles_dir} "
         f"--input_type json "
         f"--max_files {max_files} "
-        f"--group_size {group_size} "
-        f"--chunk_size {chunk_size} "
+        f"--max_memory {max_memory} "
         f"--chunk_overlap {chunk_overlap} "
         f"--index_name {index_name}"
     )
+    if chunk_size:
+        command += f" --chunk_size {chunk_size}"
 
     try:
         process = subprocess.Popen(
@@ -261,18 +255,20 @@ def generate_index(
         if process.stdout is not None:
             for line in process.stdout:
                 # Look for progress indicators in the output
-                if "Processing group" in line and "of files" in line:
+                if "Batch " in line and "files added" in line:
                     try:
-                        # Try to extract the group number
-                        current_group = int(
-                            line.split("Processing group")[1].split("of")[0].strip()
+                        # Try to extract the batch number and its file count
+                        current_group = int(line.split("Batch")[1].split(":")[0].strip())
+                        articles_processed += int(
+                            line.split("from")[1].split("files")[0].strip()
                         )
-                        group_total = expected_groups
-                        group_progress = (
-                            current_group / group_total * 100 if group_total > 0 else 0
+                        file_progress = (
+                            articles_processed / article_count * 100
+                            if article_count > 0
+                            else 0
                         )
                         print(
-                            f"\r[Group {current_group}/{group_total}] Overall progress: {group_progress:.1f}%",
+                            f"\r[Batch {current_group}] Overall progress: {file_progress:.1f}%",
                             end="",
                         )
                     except Exception:
@@ -292,7 +288,7 @@ def generate_index(
                         # Only update occasionally to avoid too many updates
                         if articles_processed % 10 == 0:
                             print(
-                                f"\r[Group {current_group}] Files processed: {articles_processed}/{article_count} ({file_progress:.1f}%)",
+                                f"\r[Batch {current_group}] Files processed: {articles_processed}/{article_count} ({file_progress:.1f}%)",
                                 end="",
                             )
                     except Exception:
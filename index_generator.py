@@ -1,9 +1,25 @@
+import os
 import time
 import logging
 import argparse
 from pathlib import Path
 from config import EMBEDDING_MODEL
 from services.document_processor import process_docs_in_groups
+from services.ann_index import INDEX_TYPES, VECTOR_CODECS, build_ann_index
+from services.docstore import write_docstore
+from services.lexical_index import build_lexical_index, remove_lexical_index
+from services.metadata_index import build_metadata_index
+from services.index_versions import publish_version
+from services.bioc_reader import INPUT_TYPES
+from services.embeddings import EMBEDDING_BACKENDS, SentenceEmbedder
+from services.shards import (
+    claim_shards,
+    init_shard_root,
+    mark_shard_done,
+    merge_shards,
+    shard_dir,
+    shard_root_for,
+)
 from services.utils import configure_logging, format_time
 
 
@@ -23,18 +39,188 @@ def parse_arguments():
         help="Maximum # of documents to process",
     )
     parser.add_argument(
-        "--group_size",
+        "--max_memory",
+        type=int,
+        default=2048,
+        help="Memory budget in MB for documents in flight through the pipeline",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=None,
+        help="Chunk size in embedding tokens (default: the model's max sequence length)",
+    )
+    parser.add_argument(
+        "--chunk_overlap",
+        type=int,
+        default=20,
+        help="Overlap in tokens when a long passage is split",
+    )
+    parser.add_argument(
+        "--input_type",
+        choices=INPUT_TYPES,
+        default="json",
+        help="BioC json or xml files, or tar.gz/tgz/tar/zip bundles of them",
+    )
+    parser.add_argument(
+        "--index_name",
+        type=str,
+        default="faiss_index",
+        help="Name of the index directory under ./indexes",
+    )
+    parser.add_argument(
+        "--checkpoint_every",
+        type=int,
+        default=1,
+        help="# of batches between checkpoints of a resumable build",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=max(1, (os.cpu_count() or 1) - 1),
+        help="# of processes used to extract and chunk documents",
+    )
+    parser.add_argument(
+        "--embedding_cache_dir",
+        type=str,
+        default="embedding_cache",
+        help="Directory of the persistent chunk embedding cache",
+    )
+    parser.add_argument(
+        "--embedding_cache_size",
+        type=int,
+        default=4096,
+        help="Size cap of the embedding cache in MB (0 disables the cache)",
+    )
+    parser.add_argument(
+        "--device",
+        default=None,
+        help="Device for the embedding model (default: cuda if available, else cpu)",
+    )
+    parser.add_argument(
+        "--embedding_backend",
+        choices=EMBEDDING_BACKENDS,
+        default="auto",
+        help="fp32, int8 (CPU only) or auto (int8 on CPU, fp32 on GPU)",
+    )
+    parser.add_argument(
+        "--embedding_processes",
+        type=int,
+        default=1,
+        help="# of CPU encoder processes",
+    )
+    parser.add_argument(
+        "--embedding_threads",
+        type=int,
+        default=None,
+        help="Torch intra-op threads per CPU encoder (default: CPUs / processes)",
+    )
+    parser.add_argument(
+        "--batch_tokens",
+        type=int,
+        default=8192,
+        help="Max padded tokens per embedding batch (chunks are bucketed by length)",
+    )
+    parser.add_argument(
+        "--parity_check",
+        type=int,
+        default=0,
+        help="# of chunks to compare against fp32 embeddings (0 disables the check)",
+    )
+    parser.add_argument(
+        "--dedup_threshold",
+        type=float,
+        default=None,
+        help="Skip embedding chunks this similar (MinHash Jaccard) to a kept chunk",
+    )
+    parser.add_argument(
+        "--index_type",
+        choices=INDEX_TYPES,
+        default="flat",
+        help="Exact flat index, or an approximate IVF-Flat, IVF-PQ or HNSW index",
+    )
+    parser.add_argument(
+        "--vector_codec",
+        choices=VECTOR_CODECS,
+        default="float32",
+        help="Store served vectors as float32, fp16, int8 scalar-quantized or PQ codes",
+    )
+    parser.add_argument(
+        "--rescore_factor",
+        type=int,
+        default=4,
+        help="Candidates per hit re-scored at full precision in the recall report",
+    )
+    parser.add_argument(
+        "--nlist",
+        type=int,
+        default=None,
+        help="# of IVF lists (default: about 4 * sqrt(# of chunks))",
+    )
+    parser.add_argument(
+        "--pq_m",
+        type=int,
+        default=None,
+        help="# of PQ sub-quantizers, must divide the dimension (default: dim / 8)",
+    )
+    parser.add_argument(
+        "--hnsw_m",
+        type=int,
+        default=32,
+        help="# of neighbors per HNSW node",
+    )
+    parser.add_argument(
+        "--train_size",
+        type=int,
+        default=None,
+        help="# of chunk vectors sampled to train IVF/PQ indexes (default: 16384)",
+    )
+    parser.add_argument(
+        "--recall_k",
+        type=int,
+        default=10,
+        help="k of the recall@k report of approximate indexes",
+    )
+    parser.add_argument(
+        "--recall_queries",
         type=int,
         default=1000,
-        help="# of documents being processed per group",
+        help="# of sampled chunk vectors used as recall queries (0 disables the report)",
     )
     parser.add_argument(
-        "--chunk_size", type=int, default=1000, help="Chunk size for text splitting"
+        "--keep_versions",
+        type=int,
+        default=3,
+        help="# of published index versions to keep for the API to switch between",
     )
     parser.add_argument(
-        "--chunk_overlap", type=int, default=20, help="Chunk overlap for text splitting"
+        "--num_shards",
+        type=int,
+        default=1,
+        help="Split the build into this many shards, built by concurrent workers",
+    )
+    parser.add_argument(
+        "--shard_id",
+        type=int,
+        default=None,
+        help="Build only this shard (default: claim any unfinished shards)",
+    )
+    parser.add_argument(
+        "--lease_ttl",
+        type=int,
+        default=600,
+        help="Seconds after which the shard lease of a silent worker expires",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="Merge the finished shards into the index instead of building",
+    )
+    parser.add_argument(
+        "--no_lexical_index",
+        action="store_true",
+        help="Skip the BM25 index used for hybrid lexical + vector search",
     )
-    parser.add_argument("--input_type", default="json", help="json or pdf")
     return parser.parse_args()
 
 
@@ -54,32 +240,111 @@ def main():
 
     # Make sure files exist
     logging.info(f"Searching for {args.input_type}s...")
-    doc_files = list(docs_path.rglob(f"*.{args.input_type}"))[: args.max_files]
+    doc_files = sorted(docs_path.rglob(f"*.{args.input_type}"))[: args.max_files]
     if not doc_files:
         logging.info(f"No {args.input_type}s found.")
         return
 
-    # Process documents and create knowledge vectorstore
+    index_dir = Path("./indexes")
+    index_dir.mkdir(exist_ok=True)
+    index_path = index_dir / args.index_name
+    shard_root = shard_root_for(index_path)
+
+    ann_options = dict(
+        nlist=args.nlist,
+        pq_m=args.pq_m,
+        hnsw_m=args.hnsw_m,
+        train_size=args.train_size,
+        recall_k=args.recall_k,
+        recall_queries=args.recall_queries,
+        vector_codec=args.vector_codec,
+        rescore_factor=args.rescore_factor,
+    )
+
+    if args.merge:
+        # Only the vectors' embedding function is needed, not a fast backend
+        embedding_model = SentenceEmbedder(EMBEDDING_MODEL, device="cpu", backend="fp32")
+        knowledge_vectorstore = merge_shards(
+            shard_root, index_path, doc_files, embedding_model
+        )
+        embedding_model.close()
+        write_docstore(knowledge_vectorstore, index_path)
+        build_metadata_index(knowledge_vectorstore, index_path)
+        if args.no_lexical_index:
+            remove_lexical_index(index_path)
+        else:
+            build_lexical_index(knowledge_vectorstore, index_path)
+        build_ann_index(index_path, args.index_type, **ann_options)
+        publish_version(index_path, keep=args.keep_versions)
+        logging.info(f"Knowledge vectorstore successfully saved to {index_path}.")
+        return
+
+    build_options = dict(
+        workers=args.workers,
+        max_memory=args.max_memory,
+        checkpoint_every=args.checkpoint_every,
+        embedding_cache_mb=args.embedding_cache_size,
+        device=args.device,
+        embedding_backend=args.embedding_backend,
+        embedding_processes=args.embedding_processes,
+        embedding_threads=args.embedding_threads,
+        parity_sample=args.parity_check,
+        batch_tokens=args.batch_tokens,
+        dedup_threshold=args.dedup_threshold,
+    )
+
+    if args.num_shards > 1:
+        # Each worker claims unfinished shards through leases on the shared
+        # filesystem; run --merge once every shard is done
+        init_shard_root(shard_root, args.num_shards)
+        for shard_id, shard_inputs, fingerprint in claim_shards(
+            shard_root, doc_files, args.num_shards, args.lease_ttl, args.shard_id
+        ):
+            logging.info(f"Building shard {shard_id} ({len(shard_inputs)} files)")
+            if shard_inputs:
+                process_docs_in_groups(
+                    shard_inputs,
+                    args.chunk_size,
+                    args.chunk_overlap,
+                    args.input_type,
+                    EMBEDDING_MODEL,
+                    index_path=shard_dir(shard_root, shard_id),
+                    # The cache is not safe for concurrent processes, so each
+                    # shard keeps its own
+                    embedding_cache_dir=Path(args.embedding_cache_dir)
+                    / f"shard-{shard_id:03d}",
+                    **build_options,
+                )
+            mark_shard_done(shard_root, shard_id, fingerprint)
+        logging.info(f"No unfinished shards left to claim in {shard_root}")
+        return
+
+    # Process new or changed documents and checkpoint the knowledge vectorstore
     knowledge_vectorstore = process_docs_in_groups(
         doc_files,
-        args.group_size,
         args.chunk_size,
         args.chunk_overlap,
         args.input_type,
         EMBEDDING_MODEL,
+        index_path=index_path,
+        embedding_cache_dir=Path(args.embedding_cache_dir),
+        **build_options,
     )
 
     if knowledge_vectorstore is None:
         logging.error("Failed to process documents. 'process_docs_in_groups' returned None.")
         return
+    write_docstore(knowledge_vectorstore, index_path)
+    build_metadata_index(knowledge_vectorstore, index_path)
+    if args.no_lexical_index:
+        remove_lexical_index(index_path)
+    else:
+        build_lexical_index(knowledge_vectorstore, index_path)
+    build_ann_index(index_path, args.index_type, **ann_options)
+    # A running API picks up the new version without restarting
+    publish_version(index_path, keep=args.keep_versions)
 
-    # Save knowledge vectorstore
-    logging.info("\nSaving knowledge vectorstore...")
-    index_dir = Path("./indexes")
-    index_dir.mkdir(exist_ok=True)
-    index_name = "faiss_index"
-    knowledge_vectorstore.save_local(str(index_dir / index_name))
-    logging.info("Knowledge vectorstore successfully saved.")
+    logging.info(f"Knowledge vectorstore successfully saved to {index_path}.")
 
     # Log total execution time
     elapsed_time = format_time(int(time.time() - start_time))
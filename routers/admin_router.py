@@ -0,0 +1,59 @@
+import hmac
+from pathlib import Path
+from typing import Optional
+from fastapi import APIRouter, Header, HTTPException, Request
+from config import ADMIN_TOKEN, INDEX_ROOT
+from schemas import ReloadRequest
+
+router = APIRouter(prefix="/admin")
+
+
+def check_admin_token(token: Optional[str]):
+    if not ADMIN_TOKEN:
+        raise HTTPException(
+            status_code=403, detail="Set ADMIN_TOKEN to enable the /admin endpoints"
+        )
+    if token is None or not hmac.compare_digest(
+        token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")
+    ):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+def check_index_path(index_path: str):
+    """Refuses indexes outside INDEX_ROOT, since loading one can run its pickles"""
+    try:
+        Path(index_path).resolve().relative_to(Path(INDEX_ROOT).resolve())
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail=f"index_path must be inside {INDEX_ROOT}"
+        )
+
+
+@router.get("/index")
+async def index_status(req: Request, x_admin_token: Optional[str] = Header(None)):
+    """Served index version, versions still draining and the last reload"""
+    check_admin_token(x_admin_token)
+    model_loader = req.app.state.model_loader
+    return {
+        "index_path": str(model_loader.index_path),
+        **model_loader.index_versions.status(),
+        "reload": model_loader.reload_status,
+    }
+
+
+@router.post("/reload", status_code=202)
+async def reload_index(
+    req: Request,
+    request: Optional[ReloadRequest] = None,
+    x_admin_token: Optional[str] = Header(None),
+):
+    """Loads the current version of an index in the background and swaps it in"""
+    check_admin_token(x_admin_token)
+    index_path = request.index_path if request else None
+    if index_path is not None:
+        check_index_path(index_path)
+    if not req.app.state.model_loader.reload_knowledge_base(index_path):
+        raise HTTPException(
+            status_code=409, detail="The index is still loading or already reloading"
+        )
+    return {"detail": "Reload started, see /admin/index"}
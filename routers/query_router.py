@@ -1,28 +1,378 @@
+import json
+import queue
+import asyncio
+from typing import Optional
 from fastapi import APIRouter, HTTPException, Request
-from schemas import QueryRequest, AnswerResponse, ErrorResponse
-from services.query_processor import answer_with_rag
+from fastapi.responses import StreamingResponse
+from config import (
+    GENERATION_BATCH_SIZE,
+    GENERATION_TIMEOUT,
+    MAX_BATCH_QUERIES,
+    OVERLOAD_RETRY_AFTER,
+)
+from schemas import (
+    QueryRequest,
+    AnswerResponse,
+    BatchQueryRequest,
+    BatchAnswerResponse,
+    ErrorResponse,
+)
+from services.answer_cache import answer_cache_key, answer_partition
+from services.inference_executor import JobTimeoutError, QueueFullError
+from services.metadata_index import FilterError
+from services.model_initializations import COMPONENTS, RETRIEVAL_COMPONENTS
+from services.query_processor import (
+    answer_with_rag,
+    answer_with_rag_batch,
+    generate_answer,
+    make_streamer,
+    retrieve_context,
+    retrieve_documents,
+    retrieve_documents_batch,
+)
 
 router = APIRouter()
 
+# Seconds clients are asked to wait while models are still loading
+LOADING_RETRY_AFTER = 10
 
-@router.post(
-    "/query", response_model=AnswerResponse, responses={400: {"model": ErrorResponse}}
-)
-async def query(request: QueryRequest, req: Request):
-    model_dependencies = req.app.state.model_dependencies
 
+def require_components(req: Request, components):
+    """Raises 503 until `components` are loaded, returns the model dependencies"""
+    model_loader = req.app.state.model_loader
+    if not model_loader.is_ready(components):
+        raise HTTPException(
+            status_code=503,
+            detail="Models are still loading, see /ready",
+            headers={"Retry-After": str(LOADING_RETRY_AFTER)},
+        )
+    return model_loader.dependencies()
+
+
+def queue_full(e: QueueFullError) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=f"{e}, please retry later",
+        headers={"Retry-After": str(OVERLOAD_RETRY_AFTER)},
+    )
+
+
+async def run_query_job(executor, fn, *args):
+    """Runs a blocking query job on `executor`, mapping overload to 429/503"""
     try:
-        answer, relevant_docs_with_source = answer_with_rag(
-            question=request.query,
+        return await executor.run(fn, *args)
+    except QueueFullError as e:
+        raise queue_full(e)
+    except JobTimeoutError as e:
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(OVERLOAD_RETRY_AFTER)},
+        )
+    except FilterError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"An error occurred while processing the query: {e}"
+        )
+
+
+def query_filters(request) -> Optional[dict]:
+    """The metadata filters set on a (batch) query request, if any"""
+    if request.filters is None:
+        return None
+    return request.filters.model_dump(exclude_none=True) or None
+
+
+async def answer_cache_key_for(req: Request, request: QueryRequest):
+    """Answer cache key, partition and (in semantic mode) embedding of a query"""
+    model_loader = req.app.state.model_loader
+    settings = model_loader.answer_settings(request.retrieval_only)
+    filters = query_filters(request)
+    if filters is not None:
+        # Filtered answers are only reused by queries with the same filters
+        settings = {**settings, "filters": filters}
+    partition = answer_partition(model_loader.index_versions.version, settings)
+    embedding = None
+    if req.app.state.answer_cache.semantic_threshold is not None:
+        embedding = await asyncio.to_thread(
+            model_loader.embedding_model.embed_query, request.query
+        )
+    return answer_cache_key(request.query, partition), partition, embedding
+
+
+def retrieve_job(index_versions, model_dependencies, query, filters=None):
+    # The query keeps the index version it started with if a new one is swapped in
+    with index_versions.acquire() as knowledge_base:
+        references = retrieve_documents(
+            query,
+            knowledge_base,
+            reranker=model_dependencies.reranker,
+            filters=filters,
+        )
+        return "", references, None
+
+
+def context_job(index_versions, model_dependencies, query, filters=None):
+    with index_versions.acquire() as knowledge_base:
+        return retrieve_context(
+            query,
+            model_dependencies.reader_llm,
+            knowledge_base,
+            model_dependencies.rag_prompt_template,
+            reranker=model_dependencies.reranker,
+            filters=filters,
+            context_packer=model_dependencies.context_packer,
+        )
+
+
+def answer_job(index_versions, model_dependencies, query, filters=None):
+    with index_versions.acquire() as knowledge_base:
+        return answer_with_rag(
+            question=query,
             llm=model_dependencies.reader_llm,
-            knowledge_index=model_dependencies.knowledge_base,
+            knowledge_index=knowledge_base,
             prompt_template=model_dependencies.rag_prompt_template,
-            # reranker=model_dependencies.reranker,
+            reranker=model_dependencies.reranker,
+            filters=filters,
+            context_packer=model_dependencies.context_packer,
         )
-        return AnswerResponse(
-            query=request.query, answer=answer, references=relevant_docs_with_source
+
+
+def retrieve_batch_job(index_versions, model_dependencies, queries, filters=None):
+    with index_versions.acquire() as knowledge_base:
+        return [
+            ("", relevant_docs, None)
+            for relevant_docs in retrieve_documents_batch(
+                queries,
+                knowledge_base,
+                reranker=model_dependencies.reranker,
+                filters=filters,
+            )
+        ]
+
+
+def answer_batch_job(index_versions, model_dependencies, queries, filters=None):
+    with index_versions.acquire() as knowledge_base:
+        return answer_with_rag_batch(
+            questions=queries,
+            llm=model_dependencies.reader_llm,
+            knowledge_index=knowledge_base,
+            prompt_template=model_dependencies.rag_prompt_template,
+            reranker=model_dependencies.reranker,
+            batch_size=GENERATION_BATCH_SIZE,
+            filters=filters,
+            context_packer=model_dependencies.context_packer,
         )
-    except Exception as e:
+
+
+@router.post(
+    "/query",
+    response_model=AnswerResponse,
+    responses={
+        400: {"model": ErrorResponse},
+        429: {"model": ErrorResponse},
+        503: {"model": ErrorResponse},
+    },
+)
+async def query(request: QueryRequest, req: Request):
+    index_versions = req.app.state.model_loader.index_versions
+    filters = query_filters(request)
+    if request.retrieval_only:
+        model_dependencies = require_components(req, RETRIEVAL_COMPONENTS)
+        executor = req.app.state.executors["retrieval"]
+        job = retrieve_job
+    else:
+        model_dependencies = require_components(req, COMPONENTS)
+        executor = req.app.state.executors["generation"]
+        job = answer_job
+    job_args = (job, index_versions, model_dependencies, request.query, filters)
+
+    async def compute():
+        answer, references, prompt_tokens = await run_query_job(executor, *job_args)
+        return {
+            "answer": answer,
+            "references": references,
+            "prompt_tokens": prompt_tokens,
+        }
+
+    cache = req.app.state.answer_cache
+    if cache is None:
+        result = await compute()
+    else:
+        key, partition, embedding = await answer_cache_key_for(req, request)
+        result = await cache.get_or_compute(key, partition, compute, embedding)
+    return AnswerResponse(query=request.query, **result)
+
+
+@router.post(
+    "/query/batch",
+    response_model=BatchAnswerResponse,
+    responses={
+        400: {"model": ErrorResponse},
+        429: {"model": ErrorResponse},
+        503: {"model": ErrorResponse},
+    },
+)
+async def query_batch(request: BatchQueryRequest, req: Request):
+    """Answers a list of queries with one search call and batched generation"""
+    if not request.queries or len(request.queries) > MAX_BATCH_QUERIES:
         raise HTTPException(
-            status_code=500, detail=f"An error occurred while processing the query: {e}"
+            status_code=400,
+            detail=f"Send between 1 and {MAX_BATCH_QUERIES} queries per batch",
+        )
+    index_versions = req.app.state.model_loader.index_versions
+    if request.retrieval_only:
+        model_dependencies = require_components(req, RETRIEVAL_COMPONENTS)
+        results = await run_query_job(
+            req.app.state.executors["retrieval"],
+            retrieve_batch_job,
+            index_versions,
+            model_dependencies,
+            request.queries,
+            query_filters(request),
+        )
+    else:
+        model_dependencies = require_components(req, COMPONENTS)
+        results = await run_query_job(
+            req.app.state.executors["generation"],
+            answer_batch_job,
+            index_versions,
+            model_dependencies,
+            request.queries,
+            query_filters(request),
+        )
+    return BatchAnswerResponse(
+        results=[
+            AnswerResponse(
+                query=query,
+                answer=answer,
+                references=references,
+                prompt_tokens=prompt_tokens,
+            )
+            for query, (answer, references, prompt_tokens) in zip(
+                request.queries, results
+            )
+        ]
+    )
+
+
+def stream_events(
+    query,
+    references,
+    streamer=None,
+    generation=None,
+    answer="",
+    on_done=None,
+    prompt_tokens=None,
+):
+    """NDJSON lines: the references, then the answer's text as it is decoded
+
+    Without a streamer, `answer` (e.g. from the cache) is sent as one token.
+    `on_done` is called with the complete answer.
+    """
+    event = {
+        "type": "references",
+        "query": query,
+        "references": references,
+        "prompt_tokens": prompt_tokens,
+    }
+    yield json.dumps(event) + "\n"
+    if answer:
+        yield json.dumps({"type": "token", "text": answer}) + "\n"
+    if streamer is not None:
+        try:
+            for text in streamer:
+                if text:
+                    yield json.dumps({"type": "token", "text": text}) + "\n"
+        except queue.Empty:
+            detail = f"No new tokens within {GENERATION_TIMEOUT}s"
+            yield json.dumps({"type": "error", "detail": detail}) + "\n"
+            return
+        error = generation.exception()
+        if error is not None:
+            detail = f"An error occurred while processing the query: {error}"
+            yield json.dumps({"type": "error", "detail": detail}) + "\n"
+            return
+        answer = generation.result()
+    if on_done is not None:
+        on_done(answer)
+    yield json.dumps({"type": "done", "answer": answer}) + "\n"
+
+
+@router.post(
+    "/query/stream",
+    responses={
+        200: {"content": {"application/x-ndjson": {}}},
+        400: {"model": ErrorResponse},
+        429: {"model": ErrorResponse},
+        503: {"model": ErrorResponse},
+    },
+)
+async def query_stream(request: QueryRequest, req: Request):
+    """Streams the references, then the answer token by token, as NDJSON
+
+    Each line has a "type": "references" first, then one "token" per decoded
+    piece of text, and finally "done" with the full answer (or "error").
+    """
+    index_versions = req.app.state.model_loader.index_versions
+    if request.retrieval_only:
+        model_dependencies = require_components(req, RETRIEVAL_COMPONENTS)
+    else:
+        model_dependencies = require_components(req, COMPONENTS)
+
+    # Cached (or being computed for an identical query): sent in one piece
+    cache, on_done = req.app.state.answer_cache, None
+    if cache is not None:
+        key, partition, embedding = await answer_cache_key_for(req, request)
+        cached = cache.lookup(key, partition, embedding)
+        if cached is None and cache.in_flight(key) is not None:
+            cached = await asyncio.shield(cache.in_flight(key))
+        if cached is not None:
+            events = stream_events(
+                request.query,
+                cached["references"],
+                answer=cached["answer"],
+                prompt_tokens=cached.get("prompt_tokens"),
+            )
+            return StreamingResponse(events, media_type="application/x-ndjson")
+
+    # Retrieval and context packing run on the retrieval workers
+    prompt, references, prompt_tokens = await run_query_job(
+        req.app.state.executors["retrieval"],
+        retrieve_job if request.retrieval_only else context_job,
+        index_versions,
+        model_dependencies,
+        request.query,
+        query_filters(request),
+    )
+    if cache is not None:
+
+        def on_done(answer):
+            value = {
+                "answer": answer,
+                "references": references,
+                "prompt_tokens": prompt_tokens,
+            }
+            cache.put(key, partition, value, embedding)
+
+    if request.retrieval_only:
+        events = stream_events(request.query, references, on_done=on_done)
+    else:
+        llm = model_dependencies.reader_llm
+        streamer = make_streamer(llm, timeout=GENERATION_TIMEOUT)
+        try:
+            generation = req.app.state.executors["generation"].submit(
+                generate_answer, prompt, llm, streamer
+            )
+        except QueueFullError as e:
+            raise queue_full(e)
+        events = stream_events(
+            request.query,
+            references,
+            streamer,
+            generation,
+            on_done=on_done,
+            prompt_tokens=prompt_tokens,
         )
+    return StreamingResponse(events, media_type="application/x-ndjson")
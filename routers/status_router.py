@@ -0,0 +1,59 @@
+from fastapi import APIRouter, HTTPException, Request, Response
+from typing import Dict
+from schemas import (
+    AnswerCacheStats,
+    ExecutorLoad,
+    GenerationStats,
+    PrefixCacheStats,
+    ReadinessResponse,
+)
+
+router = APIRouter()
+
+
+@router.get("/ready", response_model=ReadinessResponse)
+async def ready(req: Request, response: Response):
+    """Load state and time of each model component; 503 until all are ready"""
+    readiness = req.app.state.model_loader.readiness()
+    if not readiness["ready"]:
+        response.status_code = 503
+    return readiness
+
+
+@router.get("/load", response_model=Dict[str, ExecutorLoad])
+async def load(req: Request):
+    """Running, queued, refused and timed-out queries of each query executor"""
+    return {
+        name: executor.load() for name, executor in req.app.state.executors.items()
+    }
+
+
+@router.get("/load/generation", response_model=GenerationStats)
+async def generation_load(req: Request):
+    """Batch sizes, throughput and latency of micro-batched generation"""
+    batcher = req.app.state.model_loader.generation_batcher
+    if batcher is None:
+        raise HTTPException(
+            status_code=404, detail="Generation batching is off or not loaded yet"
+        )
+    return batcher.stats()
+
+
+@router.get("/load/prefix_cache", response_model=PrefixCacheStats)
+async def prefix_cache_load(req: Request):
+    """Prompts generated from the cached prompt prefix and the prefill time saved"""
+    generator = req.app.state.model_loader.prefix_generator
+    if generator is None:
+        raise HTTPException(
+            status_code=404, detail="The prefix cache is off or not loaded yet"
+        )
+    return generator.stats()
+
+
+@router.get("/load/cache", response_model=AnswerCacheStats)
+async def cache_load(req: Request):
+    """Size of the answer cache and how queries were served from it"""
+    cache = req.app.state.answer_cache
+    if cache is None:
+        raise HTTPException(status_code=404, detail="The answer cache is off")
+    return cache.load()
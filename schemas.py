@@ -1,16 +1,110 @@
 from pydantic import BaseModel
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
+
+
+class QueryFilters(BaseModel):
+    # Publication years, inclusive; chunks of articles without a year are left out
+    year_min: Optional[int] = None
+    year_max: Optional[int] = None
+    # Accepted values (any of them, case-insensitive); sections are BioC section
+    # types such as INTRO, METHODS, RESULTS or DISCUSS
+    journals: Optional[List[str]] = None
+    article_types: Optional[List[str]] = None
+    sections: Optional[List[str]] = None
 
 
 class QueryRequest(BaseModel):
     query: str
+    # Skip generation and return only the references
+    retrieval_only: bool = False
+    # Only retrieve chunks of matching articles and sections
+    filters: Optional[QueryFilters] = None
 
 
 class AnswerResponse(BaseModel):
     query: str
     answer: str
     references: List[Tuple[str, str, float]]
+    # Length of the reader prompt in tokens (None for retrieval-only queries)
+    prompt_tokens: Optional[int] = None
+
+
+class BatchQueryRequest(BaseModel):
+    queries: List[str]
+    retrieval_only: bool = False
+    # Applied to every query of the batch
+    filters: Optional[QueryFilters] = None
+
+
+class BatchAnswerResponse(BaseModel):
+    results: List[AnswerResponse]
 
 
 class ErrorResponse(BaseModel):
     detail: str
+
+
+class ComponentStatus(BaseModel):
+    state: str
+    seconds: Optional[float] = None
+    error: Optional[str] = None
+
+
+class ReadinessResponse(BaseModel):
+    ready: bool
+    retrieval_ready: bool
+    components: Dict[str, ComponentStatus]
+
+
+class ReloadRequest(BaseModel):
+    # Index to switch to (its current published version); default: the served one
+    index_path: Optional[str] = None
+
+
+class ExecutorLoad(BaseModel):
+    running: int
+    queued: int
+    max_workers: int
+    max_queue: int
+    completed: int
+    failed: int
+    rejected: int
+    timed_out: int
+
+
+class GenerationStats(BaseModel):
+    requests: int
+    batches: int
+    failed: int
+    queued: int
+    mean_batch_size: Optional[float] = None
+    requests_per_second: float
+    busy_fraction: float
+    latency_p50: Optional[float] = None
+    latency_p95: Optional[float] = None
+    queue_wait_p50: Optional[float] = None
+    queue_wait_p95: Optional[float] = None
+    max_batch_size: int
+    max_wait: float
+    max_batch_tokens: int
+
+
+class PrefixCacheStats(BaseModel):
+    hits: int
+    misses: int
+    prefix_tokens: int
+    prefill_seconds: float
+    saved_prefill_tokens: int
+    estimated_saved_seconds: float
+
+
+class AnswerCacheStats(BaseModel):
+    entries: int
+    bytes: int
+    in_flight: int
+    hits: int
+    disk_hits: int
+    semantic_hits: int
+    coalesced: int
+    misses: int
+    evictions: int
@@ -0,0 +1,479 @@
+import os
+import json
+import time
+import pickle
+import logging
+import numpy as np
+import faiss
+from pathlib import Path
+from typing import Optional
+from langchain_community.vectorstores import FAISS
+from .docstore import DOCSTORE_FILE, SQLiteDocstore, read_docstore_fingerprint
+from .index_manifest import manifest_fingerprint
+
+INDEX_TYPES = ["flat", "ivf_flat", "ivf_pq", "hnsw"]
+VECTOR_CODECS = ["float32", "fp16", "sq8", "pq"]
+ANN_INDEX_FILE = "ann.faiss"
+ANN_REPORT_FILE = "ann.json"
+# Full-precision copy of the vectors, memory-mapped to re-score compressed hits
+FULL_VECTORS_FILE = "vectors.npy"
+
+# Search-time settings swept by the recall report
+NPROBE_SWEEP = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+EF_SEARCH_SWEEP = [16, 32, 64, 128, 256, 512]
+
+
+def _read_report(index_dir: Path) -> Optional[dict]:
+    report_path = Path(index_dir) / ANN_REPORT_FILE
+    if not report_path.exists():
+        return None
+    with open(report_path, "r") as f:
+        return json.load(f)
+
+
+def remove_ann_index(index_dir: Path):
+    for name in (ANN_INDEX_FILE, ANN_REPORT_FILE, FULL_VECTORS_FILE):
+        try:
+            os.remove(Path(index_dir) / name)
+        except FileNotFoundError:
+            pass
+
+
+def ann_factory_string(
+    index_type: str,
+    num_vectors: int,
+    dim: int,
+    nlist: Optional[int] = None,
+    pq_m: Optional[int] = None,
+    hnsw_m: int = 32,
+    vector_codec: str = "float32",
+) -> Optional[str]:
+    """faiss.index_factory description of `index_type` sized for `num_vectors`
+
+    `vector_codec` selects how vectors are stored: as float32, as fp16, as
+    8-bit scalar-quantized or as product-quantized codes. Returns None for the
+    plain flat float32 index.
+    """
+    if vector_codec not in VECTOR_CODECS:
+        raise ValueError(f"Unsupported vector codec: {vector_codec}")
+    if index_type == "ivf_pq":
+        if vector_codec not in ("float32", "pq"):
+            raise ValueError("ivf_pq indexes always store PQ codes")
+        vector_codec = "pq"
+
+    pq_m = pq_m or next(m for m in range(max(1, dim // 8), 0, -1) if dim % m == 0)
+    # 8-bit codes need 256 centroids per sub-quantizer; use fewer on small corpora
+    nbits = min(8, max(1, int(np.log2(max(2, num_vectors // 39)))))
+    codes = {
+        "float32": "Flat",
+        "fp16": "SQfp16",
+        "sq8": "SQ8",
+        "pq": f"PQ{pq_m}x{nbits}",
+    }[vector_codec]
+
+    if index_type == "flat":
+        return None if vector_codec == "float32" else codes
+    if index_type == "hnsw":
+        return f"HNSW{hnsw_m}" if vector_codec == "float32" else f"HNSW{hnsw_m},{codes}"
+    if index_type in ("ivf_flat", "ivf_pq"):
+        # ~4 sqrt(n) lists, with the 39 training points per list faiss asks for
+        nlist = nlist or max(1, min(int(4 * np.sqrt(num_vectors)), num_vectors // 39))
+        return f"IVF{nlist},{codes}"
+    raise ValueError(f"Unsupported index type: {index_type}")
+
+
+def rescore(full_vectors, query: np.ndarray, candidates: np.ndarray, k: int):
+    """Re-ranks candidate positions by exact squared L2 distance to `query`
+
+    Returns (distances, positions) of the best `k`, like a flat L2 search.
+    """
+    # Sorted positions keep reads from the memory-mapped file sequential
+    candidates = np.unique(candidates[candidates >= 0])
+    distances = ((np.asarray(full_vectors[candidates]) - query) ** 2).sum(axis=1)
+    order = np.argsort(distances, kind="stable")[:k]
+    return distances[order], candidates[order]
+
+
+def set_search_params(
+    index, nprobe: Optional[int] = None, ef_search: Optional[int] = None
+):
+    """Applies search-time settings to an IVF or HNSW index (others are left as is)"""
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        ivf = None
+    if ivf is not None and nprobe:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+    hnsw = getattr(faiss.downcast_index(index), "hnsw", None)
+    if hnsw is not None and ef_search:
+        hnsw.efSearch = ef_search
+
+
+def selector_search_params(index, selector):
+    """Search parameters restricting `index` to `selector`, keeping its settings
+
+    Returns None for indexes that cannot search through a selector (flat PQ).
+    """
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        ivf = None
+    if ivf is not None:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+    if isinstance(index, faiss.IndexPQ):
+        return None
+    return faiss.SearchParameters(sel=selector)
+
+
+def measure_recall(
+    index,
+    exact_index,
+    queries: np.ndarray,
+    k: int,
+    nprobe=None,
+    ef_search=None,
+    full_vectors=None,
+    rescore_factor: int = 1,
+) -> dict:
+    """recall@k of `index` against the exact neighbors from `exact_index`
+
+    With `full_vectors`, `rescore_factor` * k candidates are fetched and
+    re-scored at full precision, as RescoringFAISS does at query time.
+    """
+    k = min(k, exact_index.ntotal)
+    _, expected = exact_index.search(queries, k)
+    set_search_params(index, nprobe, ef_search)
+    start_time = time.time()
+    if full_vectors is None:
+        _, found = index.search(queries, k)
+    else:
+        _, candidates = index.search(queries, k * rescore_factor)
+        found = [
+            rescore(full_vectors, query, row, k)[1]
+            for query, row in zip(queries, candidates)
+        ]
+    elapsed = time.time() - start_time
+    hits = sum(
+        len(set(row_found[row_found >= 0]) & set(row_expected))
+        for row_found, row_expected in zip(found, expected)
+    )
+    return {
+        "recall": hits / (len(queries) * k),
+        "ms_per_query": elapsed * 1000 / len(queries),
+    }
+
+
+def build_ann_index(
+    index_dir: Path,
+    index_type: str,
+    nlist: Optional[int] = None,
+    pq_m: Optional[int] = None,
+    hnsw_m: int = 32,
+    train_size: Optional[int] = None,
+    recall_k: int = 10,
+    recall_queries: int = 1000,
+    vector_codec: str = "float32",
+    rescore_factor: int = 4,
+) -> Optional[dict]:
+    """Builds an approximate or compressed index next to the flat index in `index_dir`
+
+    The flat index stays in place for incremental builds; the served index is
+    trained on a sample of its vectors, saved as `ann.faiss`, and preferred by
+    `load_knowledge_base` while it matches the flat index. When it stores
+    lossy codes, the float32 vectors are also saved to `vectors.npy` so hits
+    can be re-scored at full precision from a memory-mapped file. A recall@k
+    report over a sweep of nprobe/efSearch values (with and without
+    re-scoring `rescore_factor` * k candidates), using a sample of the chunk
+    vectors as queries, is logged and saved as `ann.json`. Returns the report.
+    """
+    index_dir = Path(index_dir)
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unsupported index type: {index_type}")
+
+    fingerprint = manifest_fingerprint(index_dir)
+    flat_index = faiss.read_index(str(index_dir / "index.faiss"))
+    num_vectors, dim = flat_index.ntotal, flat_index.d
+    factory = ann_factory_string(
+        index_type, num_vectors, dim, nlist, pq_m, hnsw_m, vector_codec
+    )
+    if factory is None:
+        remove_ann_index(index_dir)
+        return None
+    lossy = "SQ" in factory or "PQ" in factory
+    report = _read_report(index_dir)
+    if (
+        report is not None
+        and report.get("fingerprint") == fingerprint
+        and report.get("factory") == factory
+        and report.get("rescore_factor") == (rescore_factor if lossy else None)
+        and (index_dir / ANN_INDEX_FILE).exists()
+    ):
+        logging.info(f"ANN index {factory} is up to date")
+        return report
+
+    remove_ann_index(index_dir)
+    vectors = flat_index.reconstruct_n(0, num_vectors)
+    rng = np.random.default_rng(0)
+    start_time = time.time()
+    index = faiss.index_factory(dim, factory, flat_index.metric_type)
+    if not index.is_trained:
+        default_size = 256 * 64
+        try:
+            # At least the 39 points per IVF list k-means asks for
+            default_size = max(default_size, 40 * faiss.extract_index_ivf(index).nlist)
+        except RuntimeError:
+            pass
+        train_size = min(num_vectors, train_size or default_size)
+        sample = vectors[np.sort(rng.choice(num_vectors, train_size, replace=False))]
+        logging.info(f"Training {factory} on {train_size} of {num_vectors} vectors...")
+        index.train(sample)
+    index.add(vectors)
+    build_seconds = time.time() - start_time
+
+    tmp_path = index_dir / (ANN_INDEX_FILE + ".tmp")
+    faiss.write_index(index, str(tmp_path))
+    os.replace(tmp_path, index_dir / ANN_INDEX_FILE)
+    full_vectors = None
+    if lossy:
+        # np.save appends .npy to names without it, so write through a handle
+        tmp_path = index_dir / (FULL_VECTORS_FILE + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, vectors)
+        os.replace(tmp_path, index_dir / FULL_VECTORS_FILE)
+        full_vectors = np.load(index_dir / FULL_VECTORS_FILE, mmap_mode="r")
+
+    report = {
+        "index_type": index_type,
+        "vector_codec": vector_codec,
+        "factory": factory,
+        "rescore_factor": rescore_factor if lossy else None,
+        "fingerprint": fingerprint,
+        "num_vectors": num_vectors,
+        "build_seconds": build_seconds,
+        "size_mb": os.path.getsize(index_dir / ANN_INDEX_FILE) / 1024 / 1024,
+        "flat_size_mb": os.path.getsize(index_dir / "index.faiss") / 1024 / 1024,
+        "recall_k": recall_k,
+        "sweep": [],
+    }
+    if recall_queries > 0:
+        num_queries = min(recall_queries, num_vectors)
+        queries = vectors[rng.choice(num_vectors, num_queries, replace=False)]
+        exact = measure_recall(flat_index, flat_index, queries, recall_k)
+        report["flat_ms_per_query"] = exact["ms_per_query"]
+        if index_type == "hnsw":
+            settings = [{"ef_search": ef} for ef in EF_SEARCH_SWEEP if ef >= recall_k]
+        elif index_type == "flat":
+            settings = [{}]
+        else:
+            nlist_used = faiss.extract_index_ivf(index).nlist
+            settings = [{"nprobe": n} for n in NPROBE_SWEEP if n <= nlist_used]
+        for setting in settings:
+            result = measure_recall(index, flat_index, queries, recall_k, **setting)
+            if full_vectors is not None:
+                rescored = measure_recall(
+                    index,
+                    flat_index,
+                    queries,
+                    recall_k,
+                    full_vectors=full_vectors,
+                    rescore_factor=rescore_factor,
+                    **setting,
+                )
+                result["rescored_recall"] = rescored["recall"]
+                result["rescored_ms_per_query"] = rescored["ms_per_query"]
+            report["sweep"].append({**setting, **result})
+
+    logging.info(
+        f"Built {factory} over {num_vectors} vectors in {build_seconds:.1f}s "
+        f"({report['size_mb']:.1f} MB, flat {report['flat_size_mb']:.1f} MB)"
+    )
+    for row in report["sweep"]:
+        setting = ", ".join(
+            f"{key}={row[key]}" for key in ("nprobe", "ef_search") if key in row
+        )
+        rescored = ""
+        if "rescored_recall" in row:
+            rescored = (
+                f"; re-scored x{rescore_factor}: {row['rescored_recall']:.3f}, "
+                f"{row['rescored_ms_per_query']:.2f} ms/query"
+            )
+        logging.info(
+            f"  {setting or factory}: recall@{recall_k} {row['recall']:.3f}, "
+            f"{row['ms_per_query']:.2f} ms/query{rescored} "
+            f"(flat {report['flat_ms_per_query']:.2f} ms/query)"
+        )
+
+    with open(index_dir / ANN_REPORT_FILE, "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+class RescoringFAISS(FAISS):
+    """FAISS vectorstore that re-scores hits of a compressed index at full precision
+
+    Searches fetch `rescore_factor` * k candidates from the compressed codes,
+    then re-rank them by exact L2 distance using `full_vectors`, a
+    memory-mapped float32 array, so only the candidates' rows are read.
+    Searches also take an `id_filter` that restricts them to the chunks
+    matching metadata filters.
+    """
+
+    def __init__(
+        self,
+        *args,
+        full_vectors=None,
+        rescore_factor: int = 4,
+        lexical_index=None,
+        metadata_index=None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.full_vectors = full_vectors
+        self.rescore_factor = max(1, rescore_factor)
+        # BM25 index searched alongside this one by query_processor, if any
+        self.lexical_index = lexical_index
+        # Metadata columns that query filters are turned into id filters with
+        self.metadata_index = metadata_index
+
+    def _search(self, vectors: np.ndarray, k: int, id_filter=None):
+        """(distances, positions) of the best `k` hits of each vector
+
+        Hits of a compressed index are re-scored at full precision. With
+        `id_filter` (see services.metadata_index), only the positions it
+        allows are searched.
+        """
+        fetch = k if self.full_vectors is None else k * self.rescore_factor
+        params = None
+        if id_filter is not None:
+            params = selector_search_params(self.index, id_filter.selector)
+            if params is None:
+                # Flat PQ codes cannot be searched through a selector, compare
+                # the allowed vectors at full precision instead
+                positions = id_filter.positions()
+                return [
+                    rescore(self.full_vectors, vector, positions, k)
+                    for vector in vectors
+                ]
+        all_distances, all_positions = self.index.search(vectors, fetch, params=params)
+        if self.full_vectors is None:
+            return list(zip(all_distances, all_positions))
+        return [
+            rescore(self.full_vectors, vector, positions, k)
+            for vector, positions in zip(vectors, all_positions)
+        ]
+
+    def similarity_search_with_score_by_vector(
+        self,
+        embedding,
+        k: int = 4,
+        filter=None,
+        fetch_k: int = 20,
+        id_filter=None,
+        **kwargs,
+    ):
+        if self.full_vectors is None and id_filter is None:
+            return super().similarity_search_with_score_by_vector(
+                embedding, k, filter=filter, fetch_k=fetch_k, **kwargs
+            )
+        vector = np.array([embedding], dtype=np.float32)
+        if self.full_vectors is None and self._normalize_L2:
+            faiss.normalize_L2(vector)
+        fetch = k if filter is None else max(k, fetch_k)
+        distances, positions = self._search(vector, fetch, id_filter)[0]
+
+        filter_func = self._create_filter_func(filter) if filter is not None else None
+        docs = []
+        for distance, pos in zip(distances, positions):
+            if pos < 0:
+                continue
+            doc = self.docstore.search(self.index_to_docstore_id[pos])
+            if filter_func is None or filter_func(doc.metadata):
+                docs.append((doc, float(distance)))
+        score_threshold = kwargs.get("score_threshold")
+        if score_threshold is not None:
+            docs = [(doc, score) for doc, score in docs if score <= score_threshold]
+        return docs[:k]
+
+    def similarity_search_with_score_by_vectors(
+        self, embeddings, k: int = 4, id_filter=None
+    ):
+        """(doc, score) lists for several query vectors, searched in one FAISS call"""
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if self._normalize_L2:
+            faiss.normalize_L2(vectors)
+        return [
+            [
+                (self.docstore.search(self.index_to_docstore_id[pos]), float(d))
+                for d, pos in zip(distances, positions)
+                if pos >= 0
+            ][:k]
+            for distances, positions in self._search(vectors, k, id_filter)
+        ]
+
+
+def read_knowledge_base(
+    index_dir: Path, nprobe: Optional[int] = None, ef_search: Optional[int] = None
+):
+    """Reads the index files in `index_dir` for serving
+
+    The ANN index is used instead of the flat one and the SQLite docstore
+    instead of the pickled one, as long as they match the saved build. With
+    the SQLite docstore, chunks are only read when a search returns them.
+    Returns (faiss index, docstore, index_to_docstore_id, full_vectors), where
+    full_vectors is the memory-mapped float32 array used to re-score hits of
+    a compressed index, or None.
+    """
+    index_dir = Path(index_dir)
+    fingerprint = manifest_fingerprint(index_dir)
+
+    index_path = index_dir / "index.faiss"
+    report = _read_report(index_dir)
+    if report is not None and report.get("fingerprint") != fingerprint:
+        logging.warning(
+            f"{ANN_INDEX_FILE} in {index_dir} is out of date, using the flat index"
+        )
+    elif report is not None and (index_dir / ANN_INDEX_FILE).exists():
+        index_path = index_dir / ANN_INDEX_FILE
+    index = faiss.read_index(str(index_path))
+    set_search_params(index, nprobe, ef_search)
+    full_vectors = None
+    if index_path.name == ANN_INDEX_FILE and (index_dir / FULL_VECTORS_FILE).exists():
+        full_vectors = np.load(index_dir / FULL_VECTORS_FILE, mmap_mode="r")
+
+    if read_docstore_fingerprint(index_dir) == fingerprint:
+        docstore = SQLiteDocstore(index_dir / DOCSTORE_FILE)
+        index_to_docstore_id = docstore.index_to_docstore_id
+    else:
+        logging.warning(
+            f"No up-to-date {DOCSTORE_FILE} in {index_dir}, unpickling the docstore"
+        )
+        # Same trust model as FAISS.load_local(allow_dangerous_deserialization=True)
+        with open(index_dir / "index.pkl", "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+
+    logging.info(f"Loaded {index_path.name} with {index.ntotal} vectors")
+    return index, docstore, index_to_docstore_id, full_vectors
+
+
+def load_knowledge_base(
+    index_dir: Path,
+    embedding_model,
+    nprobe: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    rescore_factor: int = 4,
+) -> FAISS:
+    """Loads the vectorstore in `index_dir` for serving (see read_knowledge_base)"""
+    index, docstore, index_to_docstore_id, full_vectors = read_knowledge_base(
+        index_dir, nprobe, ef_search
+    )
+    return RescoringFAISS(
+        embedding_model,
+        index,
+        docstore,
+        index_to_docstore_id,
+        full_vectors=full_vectors,
+        rescore_factor=rescore_factor,
+    )
@@ -0,0 +1,232 @@
+import json
+import time
+import asyncio
+import sqlite3
+import hashlib
+import logging
+import threading
+import unicodedata
+import numpy as np
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+# Puts between removals of expired and least recently used rows from disk
+DISK_PRUNE_INTERVAL = 100
+
+
+def normalize_query(query: str) -> str:
+    """Folds case, Unicode forms, whitespace and trailing punctuation"""
+    query = unicodedata.normalize("NFKC", query).casefold()
+    return " ".join(query.split()).rstrip(" ?.!")
+
+
+def answer_partition(index_version: str, settings: dict) -> str:
+    """Identifies the index version and settings answers were produced with"""
+    key = json.dumps({"index": index_version, **settings}, sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def answer_cache_key(query: str, partition: str) -> str:
+    key = f"{partition}\0{normalize_query(query)}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class _Entry:
+    def __init__(self, value: dict, partition: str, expires: float, embedding=None):
+        self.value = value
+        self.partition = partition
+        self.expires = expires
+        self.embedding = embedding
+        self.size = len(json.dumps(value))
+
+
+class AnswerCache:
+    """Cache of query answers, shared by identical concurrent queries
+
+    Answers are keyed by normalized query within a partition (index version
+    and generation settings), so a new index or model never serves stale
+    answers. The memory tier evicts the least recently used entries beyond
+    `max_entries` or `max_bytes`; entries expire after `ttl` seconds. With
+    `path`, answers are also kept in SQLite (up to `max_disk_entries`) and
+    survive restarts. With `semantic_threshold`, a query whose embedding has
+    at least this cosine similarity to a cached query of the same partition
+    reuses its answer (memory tier only).
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl: float = 24 * 3600,
+        path: Optional[Path] = None,
+        max_disk_entries: int = 100000,
+        semantic_threshold: Optional[float] = None,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self.semantic_threshold = semantic_threshold
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._puts = 0
+        self.stats = {
+            "hits": 0,
+            "disk_hits": 0,
+            "semantic_hits": 0,
+            "coalesced": 0,
+            "misses": 0,
+            "evictions": 0,
+        }
+
+        self._db = None
+        if path is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(path), check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, "
+                "partition TEXT NOT NULL, value TEXT NOT NULL, "
+                "expires REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used)"
+            )
+            self._prune_disk()
+
+    def lookup(self, key: str, partition: str, embedding=None) -> Optional[dict]:
+        """Cached answer for `key`, or for a similar enough query; None on a miss"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires > now:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry.value
+            if entry is not None:
+                self._remove(key)
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, expires FROM answers WHERE key = ? AND expires > ?",
+                    (key, now),
+                ).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        "UPDATE answers SET last_used = ? WHERE key = ?", (now, key)
+                    )
+                    self._db.commit()
+                    value = json.loads(row[0])
+                    self._add(key, _Entry(value, partition, row[1], embedding))
+                    self.stats["disk_hits"] += 1
+                    return value
+
+            if embedding is not None and self.semantic_threshold is not None:
+                value = self._find_similar(partition, embedding, now)
+                if value is not None:
+                    self.stats["semantic_hits"] += 1
+                    return value
+        return None
+
+    def _find_similar(self, partition: str, embedding, now: float) -> Optional[dict]:
+        best_key, best_score = None, self.semantic_threshold
+        query = np.asarray(embedding, dtype=np.float32)
+        for key, entry in self._entries.items():
+            if (
+                entry.partition != partition
+                or entry.embedding is None
+                or entry.expires <= now
+            ):
+                continue
+            score = float(np.dot(entry.embedding, query))
+            if score >= best_score:
+                best_key, best_score = key, score
+        if best_key is None:
+            return None
+        self._entries.move_to_end(best_key)
+        return self._entries[best_key].value
+
+    def put(self, key: str, partition: str, value: dict, embedding=None):
+        now = time.time()
+        if embedding is not None:
+            embedding = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            self._add(key, _Entry(value, partition, now + self.ttl, embedding))
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?)",
+                    (key, partition, json.dumps(value), now + self.ttl, now),
+                )
+                self._db.commit()
+                self._puts += 1
+                if self._puts % DISK_PRUNE_INTERVAL == 0:
+                    self._prune_disk()
+
+    def _add(self, key: str, entry: _Entry):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self._bytes += entry.size
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+        ):
+            self._remove(next(iter(self._entries)))
+            self.stats["evictions"] += 1
+
+    def _remove(self, key: str):
+        self._bytes -= self._entries.pop(key).size
+
+    def _prune_disk(self):
+        self._db.execute("DELETE FROM answers WHERE expires <= ?", (time.time(),))
+        self._db.execute(
+            "DELETE FROM answers WHERE key IN (SELECT key FROM answers "
+            "ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,),
+        )
+        self._db.commit()
+
+    async def get_or_compute(self, key: str, partition: str, compute, embedding=None):
+        """Cached answer, or the result of `await compute()`, stored for next time
+
+        Concurrent calls for the same key share one computation. A caller
+        that goes away does not cancel it for the others.
+        """
+        value = self.lookup(key, partition, embedding)
+        if value is not None:
+            return value
+        task = self._in_flight.get(key)
+        if task is not None:
+            with self._lock:
+                self.stats["coalesced"] += 1
+            return await asyncio.shield(task)
+
+        with self._lock:
+            self.stats["misses"] += 1
+
+        async def run():
+            try:
+                value = await compute()
+                self.put(key, partition, value, embedding)
+                return value
+            finally:
+                del self._in_flight[key]
+
+        task = self._in_flight[key] = asyncio.ensure_future(run())
+        return await asyncio.shield(task)
+
+    def in_flight(self, key: str):
+        """The running computation of `key`, if any, to await with asyncio.shield"""
+        return self._in_flight.get(key)
+
+    def load(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "in_flight": len(self._in_flight),
+                **self.stats,
+            }
@@ -0,0 +1,135 @@
+import io
+import json
+import logging
+import tarfile
+import zipfile
+import hashlib
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+INPUT_TYPES = ["json", "xml", "tar.gz", "tgz", "tar", "zip"]
+ARCHIVE_TYPES = ["tar.gz", "tgz", "tar", "zip"]
+MEMBER_SUFFIXES = (".json", ".xml")
+
+
+def is_archive(path: Path) -> bool:
+    return any(path.name.endswith(f".{suffix}") for suffix in ARCHIVE_TYPES)
+
+
+def parse_bioc_json(raw: bytes) -> List[dict]:
+    """Pulls passage text and infons out of a BioC JSON collection"""
+    bioc_data = _json_loads(raw)
+    if isinstance(bioc_data, list):
+        bioc_data = bioc_data[0]
+
+    passages = []
+    for document in bioc_data.get("documents", []):
+        for passage in document.get("passages", []):
+            if passage.get("text"):
+                passages.append(
+                    {"text": passage["text"], "infons": passage.get("infons") or {}}
+                )
+    return passages
+
+
+def parse_bioc_xml(raw: bytes) -> List[dict]:
+    """Pulls passage text and infons out of a BioC XML collection"""
+    passages = []
+    infons, text = {}, None
+    # Annotations and relations carry their own infons and text
+    nested = 0
+    for event, element in ET.iterparse(io.BytesIO(raw), events=("start", "end")):
+        if event == "start":
+            if element.tag == "passage":
+                infons, text = {}, None
+            elif element.tag in ("annotation", "relation"):
+                nested += 1
+            continue
+        if element.tag in ("annotation", "relation"):
+            nested -= 1
+            element.clear()
+        elif nested:
+            continue
+        elif element.tag == "infon":
+            infons[element.get("key")] = element.text or ""
+        elif element.tag == "text":
+            text = element.text
+        elif element.tag == "passage":
+            if text:
+                passages.append({"text": text, "infons": infons})
+            element.clear()
+    return passages
+
+
+def read_bioc_passages(raw: bytes, name: str) -> List[dict]:
+    """Parses BioC JSON or XML (picked by file name) and returns its passages"""
+    try:
+        if name.endswith(".xml"):
+            return parse_bioc_xml(raw)
+        return parse_bioc_json(raw)
+    except (ValueError, ET.ParseError):
+        logging.warning(f"Skipping invalid BioC file: {name}")
+        return []
+    except Exception as e:
+        logging.error(f"Failed to process {name}: {e}")
+        return []
+
+
+class _HashingReader(io.RawIOBase):
+    """File wrapper that hashes everything read through it"""
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.f.read(len(buffer))
+        self.sha256.update(data)
+        buffer[: len(data)] = data
+        return len(data)
+
+
+def hash_file(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def iter_archive_members(archive: Path, digest: dict) -> Iterator[Tuple[str, bytes]]:
+    """Yields (member name, bytes) of the BioC files inside a tar or zip archive
+
+    Tar archives are read as a stream in a single pass, without extracting
+    anything to disk. The SHA-256 of the archive is stored in `digest` once
+    all members have been read.
+    """
+    if archive.name.endswith(".zip"):
+        with zipfile.ZipFile(archive) as bundle:
+            for info in bundle.infolist():
+                if not info.is_dir() and info.filename.endswith(MEMBER_SUFFIXES):
+                    yield info.filename, bundle.read(info)
+        digest["sha256"] = hash_file(archive)
+        return
+
+    with open(archive, "rb") as f:
+        reader = _HashingReader(f)
+        with tarfile.open(fileobj=io.BufferedReader(reader), mode="r|*") as bundle:
+            for member in bundle:
+                if member.isfile() and member.name.endswith(MEMBER_SUFFIXES):
+                    yield member.name, bundle.extractfile(member).read()
+        # Hash any trailing padding the tar reader did not consume
+        for block in iter(lambda: f.read(1 << 20), b""):
+            reader.sha256.update(block)
+        digest["sha256"] = reader.sha256.hexdigest()
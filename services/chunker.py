@@ -0,0 +1,117 @@
+import re
+from typing import List
+from transformers import AutoTokenizer
+from langchain.docstore.document import Document as LangchainDocument
+
+CHUNKER_VERSION = "bioc-passages-2"
+
+# Infons holding article metadata, in order of preference; BioC-PMC puts them
+# on the front (title) passage
+YEAR_INFONS = ["year", "pub-date", "date"]
+JOURNAL_INFONS = ["journal", "journal-title"]
+ARTICLE_TYPE_INFONS = ["article-type", "article_type", "document_type"]
+YEAR_PATTERN = re.compile(r"\b(1[89]|20)\d\d\b")
+
+
+def passage_section(passage: dict) -> str:
+    infons = passage.get("infons") or {}
+    return infons.get("section_type") or infons.get("type") or ""
+
+
+def _first_infon(passages: List[dict], keys: List[str]) -> str:
+    for key in keys:
+        for passage in passages:
+            value = (passage.get("infons") or {}).get(key)
+            if value and value.strip():
+                return value.strip()
+    return ""
+
+
+def article_metadata(passages: List[dict]) -> dict:
+    """Publication year, journal and article type found in the passages' infons"""
+    metadata = {}
+    year = YEAR_PATTERN.search(_first_infon(passages, YEAR_INFONS))
+    if year:
+        metadata["year"] = int(year.group())
+    # PubTator-style journal infons continue with "; year; volume(issue)..."
+    journal = _first_infon(passages, JOURNAL_INFONS).split(";")[0].strip()
+    if journal:
+        metadata["journal"] = journal
+    article_type = _first_infon(passages, ARTICLE_TYPE_INFONS)
+    if article_type:
+        metadata["article_type"] = article_type
+    return metadata
+
+
+class PassageChunker:
+    """Splits BioC passages into chunks measured in embedding-tokenizer tokens
+
+    Consecutive passages of the same section are packed together while they
+    fit in `chunk_tokens` (including the tokenizer's special tokens); a chunk
+    never spans two sections. Passages longer than that are cut on token
+    boundaries into windows overlapping by `chunk_overlap` tokens. Chunk text
+    and `start_index` refer to the passages joined with newlines. Chunks carry
+    their section and the article's metadata (see article_metadata).
+    """
+
+    def __init__(self, tokenizer_name: str, chunk_tokens: int, chunk_overlap: int):
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, use_fast=True)
+        self.max_tokens = chunk_tokens - self.tokenizer.num_special_tokens_to_add()
+        if self.max_tokens <= 0:
+            raise ValueError(f"Chunk size of {chunk_tokens} tokens is too small")
+        self.overlap = min(chunk_overlap, self.max_tokens // 2)
+
+    def _passage_spans(self, passages: List[dict]):
+        """Yields (start, end, num_tokens, section) windows of every passage"""
+        texts = [passage.get("text") or "" for passage in passages]
+        encoded = self.tokenizer(
+            texts,
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+            verbose=False,
+        )
+
+        base = 0
+        step = self.max_tokens - self.overlap
+        for text, passage, token_offsets in zip(
+            texts, passages, encoded["offset_mapping"]
+        ):
+            section = passage_section(passage)
+            for i in range(0, len(token_offsets), step):
+                window = token_offsets[i : i + self.max_tokens]
+                yield base + window[0][0], base + window[-1][1], len(window), section
+                if i + self.max_tokens >= len(token_offsets):
+                    break
+            base += len(text) + 1
+
+    def split(self, passages: List[dict], source: str) -> List[LangchainDocument]:
+        full_text = "\n".join(passage.get("text") or "" for passage in passages)
+        metadata = article_metadata(passages)
+
+        spans = []
+        for start, end, num_tokens, section in self._passage_spans(passages):
+            last = spans[-1] if spans else None
+            if (
+                last is not None
+                and last[3] == section
+                and start >= last[1]
+                and last[2] + num_tokens <= self.max_tokens
+            ):
+                spans[-1] = (last[0], end, last[2] + num_tokens, section)
+            else:
+                spans.append((start, end, num_tokens, section))
+
+        return [
+            LangchainDocument(
+                page_content=full_text[start:end],
+                metadata={
+                    "source": source,
+                    "start_index": start,
+                    "section": section,
+                    **metadata,
+                },
+            )
+            for start, end, _, section in spans
+        ]
@@ -0,0 +1,172 @@
+import os
+import json
+import zlib
+import logging
+import threading
+import numpy as np
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Set
+
+DUPLICATES_FILE = "duplicates.json"
+SIGNATURES_FILE = "dedup_signatures.npz"
+
+# Largest prime below 2**32, so every MinHash value fits in a uint32
+_MERSENNE_PRIME = np.uint64(4294967291)
+
+
+def _lsh_shape(threshold: float, num_perm: int):
+    """Picks (bands, rows) with bands * rows <= num_perm whose LSH curve crosses
+    at `threshold`, the similarity where (1 / bands) ** (1 / rows) == threshold"""
+    best = None
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        crossing = (1 / bands) ** (1 / rows)
+        if best is None or abs(crossing - threshold) < best[0]:
+            best = (abs(crossing - threshold), bands, rows)
+    return best[1], best[2]
+
+
+class ChunkDeduplicator:
+    """Detects near-duplicate chunks with MinHash signatures and LSH banding
+
+    Chunks are compared on their word `shingle_size`-grams. A chunk whose
+    estimated Jaccard similarity to an already kept chunk reaches `threshold`
+    is not embedded; instead it is recorded as a pointer to that surviving
+    copy. Signatures of kept chunks and the pointers are saved with the index,
+    so incremental builds deduplicate against what is already indexed.
+    """
+
+    def __init__(
+        self, threshold: float = 0.9, num_perm: int = 64, shingle_size: int = 5
+    ):
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.bands, self.rows = _lsh_shape(threshold, num_perm)
+        rng = np.random.RandomState(1)
+        self._a = rng.randint(1, 2**31, size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, 2**31, size=num_perm).astype(np.uint64)
+
+        self.signatures: Dict[str, np.ndarray] = {}
+        self.pointers: Dict[str, dict] = {}
+        self._buckets = [{} for _ in range(self.bands)]
+        # Chunks are checked by the pipeline while checkpoints save the state
+        self._lock = threading.Lock()
+        self.saved_chunks = 0
+        self.saved_bytes = 0
+
+    def signature(self, text: str) -> np.ndarray:
+        words = text.lower().split()
+        shingles = {
+            " ".join(words[i : i + self.shingle_size])
+            for i in range(max(1, len(words) - self.shingle_size + 1))
+        }
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode("utf-8")) for shingle in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+        permuted = (np.outer(self._a, hashes) + self._b[:, None]) % _MERSENNE_PRIME
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, signature: np.ndarray):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows : (band + 1) * self.rows].tobytes()
+
+    def _add(self, chunk_id: str, signature: np.ndarray):
+        self.signatures[chunk_id] = signature
+        for band, key in self._band_keys(signature):
+            self._buckets[band].setdefault(key, []).append(chunk_id)
+
+    def check(self, chunk_id: str, text: str, metadata: dict) -> Optional[str]:
+        """Returns the surviving copy of a duplicate chunk, or None if it is new"""
+        signature = self.signature(text)
+        with self._lock:
+            candidates = set()
+            for band, key in self._band_keys(signature):
+                candidates.update(self._buckets[band].get(key, ()))
+
+            for candidate in sorted(candidates):
+                kept = self.signatures.get(candidate)
+                if kept is not None and np.mean(kept == signature) >= self.threshold:
+                    self.pointers[chunk_id] = {
+                        "duplicate_of": candidate,
+                        "source": metadata.get("source"),
+                        "start_index": metadata.get("start_index"),
+                    }
+                    self.saved_chunks += 1
+                    self.saved_bytes += len(text.encode("utf-8"))
+                    return candidate
+
+            self._add(chunk_id, signature)
+            return None
+
+    def is_duplicate(self, chunk_id: str) -> bool:
+        return chunk_id in self.pointers
+
+    def dependents(self, chunk_ids: Iterable[str]) -> Set[str]:
+        """Duplicates whose surviving copy is one of `chunk_ids`"""
+        chunk_ids = set(chunk_ids)
+        return {
+            dup_id
+            for dup_id, pointer in self.pointers.items()
+            if pointer["duplicate_of"] in chunk_ids
+        }
+
+    def remove(self, chunk_ids: Iterable[str]):
+        """Forgets kept chunks and duplicates, e.g. when their file changes"""
+        with self._lock:
+            for chunk_id in chunk_ids:
+                self.pointers.pop(chunk_id, None)
+                # Stale ids left in the LSH buckets are skipped by check()
+                self.signatures.pop(chunk_id, None)
+
+    def save(self, index_dir: Path):
+        index_dir = Path(index_dir)
+        with self._lock:
+            pointers = dict(self.pointers)
+            ids = list(self.signatures)
+            signatures = (
+                np.vstack([self.signatures[i] for i in ids])
+                if ids
+                else np.zeros((0, self.bands * self.rows), dtype=np.uint32)
+            )
+        with open(index_dir / DUPLICATES_FILE, "w") as f:
+            json.dump(pointers, f)
+        # np.savez appends .npz to names without it, so write through a handle
+        tmp_path = index_dir / (SIGNATURES_FILE + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, ids=np.array(ids, dtype=str), signatures=signatures)
+        os.replace(tmp_path, index_dir / SIGNATURES_FILE)
+
+    def load(self, index_dir: Path):
+        index_dir = Path(index_dir)
+        if (index_dir / DUPLICATES_FILE).exists():
+            with open(index_dir / DUPLICATES_FILE, "r") as f:
+                self.pointers.update(json.load(f))
+        if (index_dir / SIGNATURES_FILE).exists():
+            data = np.load(index_dir / SIGNATURES_FILE)
+            for chunk_id, signature in zip(data["ids"], data["signatures"]):
+                self._add(str(chunk_id), signature)
+
+    def log_stats(self):
+        logging.info(
+            f"Near-duplicate removal: {self.saved_chunks} chunks "
+            f"({self.saved_bytes / 1024 / 1024:.1f} MB of text) not embedded, "
+            f"{len(self.pointers)} duplicates recorded in total"
+        )
+
+    def retain(self, stored_ids: Set[str], expected_ids: Set[str]):
+        """Reconciles the saved state with a reloaded index
+
+        Keeps signatures of chunks that are in the vectorstore and pointers of
+        expected chunks whose surviving copy is still kept.
+        """
+        with self._lock:
+            for chunk_id in [i for i in self.signatures if i not in stored_ids]:
+                del self.signatures[chunk_id]
+            for dup_id, pointer in list(self.pointers.items()):
+                if (
+                    dup_id not in expected_ids
+                    or pointer["duplicate_of"] not in self.signatures
+                ):
+                    del self.pointers[dup_id]
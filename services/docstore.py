@@ -0,0 +1,117 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Optional, Union
+from langchain_community.docstore.base import Docstore
+from langchain_core.documents import Document
+from .index_manifest import manifest_fingerprint
+
+DOCSTORE_FILE = "docstore.sqlite"
+EXPORT_BATCH_SIZE = 10000
+
+
+def write_docstore(vectorstore, index_dir: Path):
+    """Exports the chunks of `vectorstore` to an SQLite docstore in `index_dir`
+
+    Rows are keyed by FAISS position, so the API can resolve search hits
+    without unpickling the whole docstore. Skipped if the docstore already
+    matches the index.
+    """
+    index_dir = Path(index_dir)
+    fingerprint = manifest_fingerprint(index_dir)
+    if read_docstore_fingerprint(index_dir) == fingerprint:
+        return
+
+    tmp_path = index_dir / (DOCSTORE_FILE + ".tmp")
+    if tmp_path.exists():
+        os.remove(tmp_path)
+    db = sqlite3.connect(str(tmp_path))
+    db.execute(
+        "CREATE TABLE chunks (pos INTEGER PRIMARY KEY, id TEXT NOT NULL, "
+        "text TEXT NOT NULL, metadata TEXT NOT NULL)"
+    )
+    db.execute("CREATE UNIQUE INDEX chunks_id ON chunks (id)")
+    db.execute("CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    rows = []
+    for pos in range(vectorstore.index.ntotal):
+        chunk_id = vectorstore.index_to_docstore_id[pos]
+        doc = vectorstore.docstore.search(chunk_id)
+        rows.append((pos, chunk_id, doc.page_content, json.dumps(doc.metadata)))
+        if len(rows) >= EXPORT_BATCH_SIZE:
+            db.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)", rows)
+            rows = []
+    db.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)", rows)
+    # The fingerprint is written last and marks the export as complete
+    db.execute("INSERT INTO info VALUES ('fingerprint', ?)", (fingerprint,))
+    db.commit()
+    db.close()
+    os.replace(tmp_path, index_dir / DOCSTORE_FILE)
+    logging.info(f"Wrote {vectorstore.index.ntotal} chunks to {DOCSTORE_FILE}")
+
+
+def read_docstore_fingerprint(index_dir: Path) -> Optional[str]:
+    docstore_path = Path(index_dir) / DOCSTORE_FILE
+    if not docstore_path.exists():
+        return None
+    db = sqlite3.connect(f"file:{docstore_path}?mode=ro", uri=True)
+    try:
+        row = db.execute("SELECT value FROM info WHERE key = 'fingerprint'").fetchone()
+    except sqlite3.DatabaseError:
+        row = None
+    finally:
+        db.close()
+    return row[0] if row else None
+
+
+class SQLiteDocstore(Docstore):
+    """Read-only docstore that fetches chunks from SQLite when they are hit
+
+    `index_to_docstore_id` is a lazy mapping over the same table, so neither
+    the chunk texts nor the id mapping are held in memory.
+    """
+
+    def __init__(self, path: Path):
+        self._db = sqlite3.connect(
+            f"file:{path}?mode=ro", uri=True, check_same_thread=False
+        )
+        self._lock = threading.Lock()
+        self.index_to_docstore_id = _LazyIdMapping(self)
+
+    def _query(self, sql: str, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def search(self, search: str) -> Union[str, Document]:
+        rows = self._query("SELECT text, metadata FROM chunks WHERE id = ?", (search,))
+        if not rows:
+            return f"ID {search} not found."
+        text, metadata = rows[0]
+        return Document(id=search, page_content=text, metadata=json.loads(metadata))
+
+    def close(self):
+        self._db.close()
+
+
+class _LazyIdMapping(Mapping):
+    """FAISS position -> docstore id, read from the docstore table on demand"""
+
+    def __init__(self, docstore: SQLiteDocstore):
+        self._docstore = docstore
+
+    def __getitem__(self, pos):
+        rows = self._docstore._query("SELECT id FROM chunks WHERE pos = ?", (int(pos),))
+        if not rows:
+            raise KeyError(pos)
+        return rows[0][0]
+
+    def __iter__(self):
+        for (pos,) in self._docstore._query("SELECT pos FROM chunks ORDER BY pos"):
+            yield pos
+
+    def __len__(self):
+        return self._docstore._query("SELECT COUNT(*) FROM chunks")[0][0]
@@ -1,145 +1,549 @@
 import time
+import queue
 import logging
-import json
+import hashlib
+import threading
+import multiprocessing
+from collections import deque, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
+from typing import Optional, Tuple
 from tqdm import tqdm
-from datasets import Dataset
-from langchain.docstore.document import Document as LangchainDocument
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain_community.vectorstores.utils import DistanceStrategy
-from .utils import format_time
+from .bioc_reader import INPUT_TYPES, is_archive, iter_archive_members, read_bioc_passages
+from .chunker import CHUNKER_VERSION, PassageChunker
+from .dedup import ChunkDeduplicator
+from .embedding_cache import EmbeddingCache
+from .embeddings import SentenceEmbedder, parity_check
+from .index_manifest import (
+    IndexManifest,
+    chunk_ids_for,
+    load_checkpoint,
+    save_checkpoint,
+)
+from .utils import format_time, peak_rss_mb
 
-MARKDOWN_SEPARATORS = [
-    "\n#{1,6} ",
-    "```\n",
-    "\n\\*\\*\\*+\n",
-    "\n---+\n",
-    "\n___+\n",
-    "\n\n",
-    "\n",
-    " ",
-    "",
-]
+# Per-process state for the extraction/chunking pool, set by _init_chunk_worker
+_worker_chunker = None
 
-JSON_SEPARATORS = ["/n/n", "/n", ". ", ", ", " ", ""]
+# Rough per-chunk memory costs used to size pipeline batches: Document object
+# overhead and one Python float per embedding dimension
+CHUNK_OVERHEAD_BYTES = 1024
+FLOAT_BYTES = 32
 
+# Batches alive at once: one being built, two queued for embedding, one being
+# embedded, two queued for indexing and one being indexed
+PIPELINE_SLOTS = 7
+STAGE_QUEUE_SIZE = 2
+
+FileResult = namedtuple(
+    "FileResult", ["size", "mtime", "sha256", "chunks", "unchanged"]
+)
+# Results for archives: one per BioC member, then one once the archive is read
+MemberResult = namedtuple("MemberResult", ["member", "sha256", "chunks"])
+ArchiveEnd = namedtuple("ArchiveEnd", ["size", "mtime", "sha256"])
+ChunkBatch = namedtuple("ChunkBatch", ["index", "results", "docs", "ids", "skipped"])
+
+_DONE = object()
+
+
+def _init_chunk_worker(tokenizer_name, chunk_tokens, chunk_overlap):
+    """Builds the passage chunker once per worker process"""
+    global _worker_chunker
+    _worker_chunker = PassageChunker(tokenizer_name, chunk_tokens, chunk_overlap)
+
+
+def _extract_and_chunk(item: Tuple[Path, Optional[str]]) -> FileResult:
+    """Parses a single file and splits it into chunks (runs in a worker)
+
+    Files whose content hash matches `known_sha256` are reported as unchanged
+    without being parsed.
+    """
+    file, known_sha256 = item
+    stat = file.stat()
+    raw = file.read_bytes()
+    sha256 = hashlib.sha256(raw).hexdigest()
+    if sha256 == known_sha256:
+        return FileResult(stat.st_size, stat.st_mtime, sha256, [], True)
+
+    passages = read_bioc_passages(raw, file.name)
+    chunks = _worker_chunker.split(passages, str(file)) if passages else []
+    return FileResult(stat.st_size, stat.st_mtime, sha256, chunks, False)
+
+
+def _chunk_member(item: Tuple[str, str, bytes]) -> MemberResult:
+    """Parses and chunks one BioC file read from an archive (runs in a worker)"""
+    source, member, raw = item
+    passages = read_bioc_passages(raw, member)
+    chunks = _worker_chunker.split(passages, source) if passages else []
+    return MemberResult(member, hashlib.sha256(raw).hexdigest(), chunks)
+
+
+def _iter_file_chunks(items, pool, max_pending):
+    """Yields (file, result) in input order with at most `max_pending` tasks in flight
+
+    Archives are streamed here, in the calling process, and each of their
+    members is chunked as a separate task.
+    """
+
+    def tasks():
+        for file, known_sha256 in items:
+            if not is_archive(file):
+                yield file, _extract_and_chunk, (file, known_sha256)
+                continue
+            stat = file.stat()
+            digest = {}
+            for member, raw in iter_archive_members(file, digest):
+                yield file, _chunk_member, (f"{file}::{member}", member, raw)
+            yield file, None, ArchiveEnd(stat.st_size, stat.st_mtime, digest["sha256"])
+
+    if pool is None:
+        for file, fn, arg in tasks():
+            yield file, fn(arg) if fn is not None else arg
+        return
+
+    pending = deque()
+    for file, fn, arg in tasks():
+        pending.append((file, pool.submit(fn, arg) if fn is not None else arg))
+        if len(pending) >= max_pending:
+            done_file, result = pending.popleft()
+            yield done_file, result.result() if isinstance(result, Future) else result
+    while pending:
+        done_file, result = pending.popleft()
+        yield done_file, result.result() if isinstance(result, Future) else result
 
-def extract_text_from_json(json_file: Path) -> str:
-    try:
-        with open(json_file, "r") as f:
-            bioc_data = json.load(f)
 
-        all_text = []
-        if isinstance(bioc_data, list):
-            bioc_data = bioc_data[0]
+def _plan_dedup(manifest, deduplicator, input_files, pending_files, removed_files):
+    """Extends an incremental plan for near-duplicate removal
 
-        for document in bioc_data.get("documents", []):
-            for passage in document.get("passages", []):
-                all_text.append(passage.get("text", ""))
-        return "\n".join(all_text)
-    except json.JSONDecodeError:
-        logging.warning(f"Skipping invalid JSON file: {json_file.name}")
-        return ""
-    except Exception as e:
-        logging.error(f"Failed to process {json_file.name}: {e}")
-        return ""
+    Chunks of changed and removed files are about to be replaced, so files
+    holding duplicates of them are re-chunked as well, and all replaced chunks
+    are forgotten by `deduplicator` before any new chunk is checked. Returns
+    the files to process and the replaced ids that were duplicates, which have
+    no vectors in the index.
+    """
+    replaced = {str(file) for file, _ in pending_files if str(file) in manifest.files}
+    replaced.update(removed_files)
+    replaced_ids = {i for path in replaced for i in manifest.chunk_ids(path)}
+    owners = manifest.owners()
+    while True:
+        dependents = deduplicator.dependents(replaced_ids) - replaced_ids
+        new_paths = {owners[dup_id.split("-")[0]] for dup_id in dependents} - replaced
+        if not new_paths:
+            break
+        replaced.update(new_paths)
+        replaced_ids.update(i for path in new_paths for i in manifest.chunk_ids(path))
+
+    duplicate_ids = {i for i in replaced_ids if deduplicator.is_duplicate(i)}
+    deduplicator.remove(replaced_ids)
+    # Forgotten signatures cannot be restored without re-chunking, so files
+    # are no longer skipped on an unchanged hash
+    pending = {str(file) for file, _ in pending_files} | replaced
+    return [(file, None) for file in input_files if str(file) in pending], duplicate_ids
+
+
+def _put(stage_queue, item, stop_event):
+    """Blocking put that gives up once the pipeline is stopped"""
+    while not stop_event.is_set():
+        try:
+            stage_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(stage_queue, stop_event):
+    """Blocking get that returns _DONE once the pipeline is stopped"""
+    while True:
+        try:
+            return stage_queue.get(timeout=0.1)
+        except queue.Empty:
+            if stop_event.is_set():
+                return _DONE
+
+
+def _start_stage(name, target, stop_event, errors):
+    def run():
+        try:
+            target()
+        except BaseException as e:
+            logging.error(f"{name} stage failed: {e}")
+            errors.append(e)
+            stop_event.set()
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
 
 
 def process_docs_in_groups(
-    input_files, group_size, chunk_size, chunk_overlap, input_type, embedding_model_name
+    input_files,
+    chunk_size,
+    chunk_overlap,
+    input_type,
+    embedding_model_name,
+    workers=1,
+    max_memory=2048,
+    index_path=None,
+    checkpoint_every=1,
+    embedding_cache_dir=None,
+    embedding_cache_mb=4096,
+    device=None,
+    embedding_backend="auto",
+    embedding_processes=1,
+    embedding_threads=None,
+    parity_sample=0,
+    batch_tokens=8192,
+    dedup_threshold=None,
 ):
-    """Process and incrementally save documents to vector database"""
+    """Process and incrementally save documents to vector database
 
-    if input_type == "json":
-        separator_type = JSON_SEPARATORS
-    else:
-        separator_type = MARKDOWN_SEPARATORS
-
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap,
-        add_start_index=True,
-        strip_whitespace=True,
-        separators=separator_type,
-    )
+    Runs as a streaming pipeline: extraction/chunking (in a pool of `workers`
+    processes), embedding and indexing work concurrently on consecutive
+    batches, joined by bounded queues. Batches always end on a file boundary
+    and are sized so that all batches in flight fit in `max_memory` MB. The
+    FAISS index itself still grows with the corpus. Chunk order and metadata
+    do not depend on the number of workers. `input_files` are BioC JSON or
+    XML files, or tar/zip archives of them that are read without being
+    extracted to disk (see services.bioc_reader). Articles are chunked per BioC
+    passage and section (see services.chunker); `chunk_size` and
+    `chunk_overlap` are in embedding-tokenizer tokens, and chunk_size
+    defaults to (and is capped at) the embedding model's max sequence length.
+
+    When `index_path` is given the build is incremental: a manifest of indexed
+    files is kept next to the index, a checkpoint is written every
+    `checkpoint_every` batches, and a rerun only embeds new or changed files
+    and drops the chunks of files no longer in `input_files`.
+
+    With `embedding_cache_dir`, chunk vectors are cached on disk (up to
+    `embedding_cache_mb` MB) and the model only embeds chunks it has not seen.
+
+    The device is auto-detected unless given; on CPU the embedder defaults to
+    the int8 backend (see services.embeddings). With `parity_sample`, up to
+    that many chunks of the first batch are also embedded in fp32 to report
+    the cosine drift of the chosen backend. Chunks are embedded in
+    length-bucketed batches of at most `batch_tokens` padded tokens.
+
+    With `dedup_threshold`, chunks whose estimated Jaccard similarity to an
+    already kept chunk reaches the threshold are not embedded; they are
+    recorded in the index directory as pointers to the kept copy (see
+    services.dedup).
+    """
+
+    if input_type not in INPUT_TYPES:
+        raise ValueError(f"Unsupported input type: {input_type}")
 
-    embedding_model = HuggingFaceEmbeddings(
-        model_name=embedding_model_name,
-        multi_process=False,
-        model_kwargs={"device": "cuda"},
-        encode_kwargs={"normalize_embeddings": True},
+    embedding_model = SentenceEmbedder(
+        embedding_model_name,
+        device=device,
+        backend=embedding_backend,
+        num_processes=embedding_processes,
+        num_threads=embedding_threads,
+        batch_tokens=batch_tokens,
+    )
+    embedding_dim = len(embedding_model.embed_query("dimension probe"))
+    chunk_tokens = embedding_model.max_seq_length
+    if chunk_size and chunk_size > chunk_tokens:
+        logging.warning(
+            f"Chunk size {chunk_size} exceeds the {chunk_tokens} tokens "
+            f"{embedding_model_name} can embed, using {chunk_tokens}"
+        )
+    elif chunk_size:
+        chunk_tokens = chunk_size
+    batch_budget = max_memory * 1024 * 1024 // PIPELINE_SLOTS
+    logging.info(
+        f"Memory budget {max_memory} MB: up to {batch_budget // (1024 * 1024)} MB per batch"
     )
 
-    knowledge_vectorstore = None
-    num_groups = (len(input_files) + group_size - 1) // group_size
+    settings = {
+        "input_type": input_type,
+        "chunker": CHUNKER_VERSION,
+        "chunk_size": chunk_tokens,
+        "chunk_overlap": chunk_overlap,
+        "embedding_model": embedding_model_name,
+    }
+    deduplicator = None
+    if dedup_threshold:
+        settings["dedup_threshold"] = dedup_threshold
+        deduplicator = ChunkDeduplicator(dedup_threshold)
+    knowledge_vectorstore, manifest = None, IndexManifest(settings=settings)
+    if index_path is not None:
+        knowledge_vectorstore, manifest = load_checkpoint(
+            index_path, embedding_model, settings, deduplicator
+        )
 
-    for i in range(0, len(input_files), group_size):
-        group_files = input_files[i : i + group_size]
-        group_index = i // group_size + 1
+    pending_files, removed_files = manifest.plan(input_files)
+    duplicate_ids = set()
+    if deduplicator is not None:
+        pending_files, duplicate_ids = _plan_dedup(
+            manifest, deduplicator, input_files, pending_files, removed_files
+        )
+    if removed_files:
+        removed_ids = [i for path in removed_files for i in manifest.chunk_ids(path)]
+        removed_ids = [i for i in removed_ids if i not in duplicate_ids]
+        if removed_ids:
+            knowledge_vectorstore.delete(removed_ids)
+        for path in removed_files:
+            del manifest.files[path]
         logging.info(
-            f"\nExtracting text from {input_type.upper()} Group {group_index}/{num_groups}"
+            f"Removed {len(removed_ids)} chunks of {len(removed_files)} deleted files"
         )
-        doc_data = []
-
-        skipped_files = []
-        for file in tqdm(
-            group_files, desc=f"{input_type.upper()} files", position=0, leave=False
-        ):
-            if input_type == "json":
-                text = extract_text_from_json(file)
-            else:
-                raise ValueError(f"Unsupported input type: {input_type}")
-
-            if text:
-                doc_data.append({"text": text, "source": str(file)})
-            else:
-                skipped_files.append(file.name)
-
-        if skipped_files:
-            logging.warning(
-                f"Skipped files in group {group_index}: {', '.join(skipped_files)}"
-            )
+    logging.info(
+        f"{len(pending_files)} new or changed files to process, "
+        f"{len(input_files) - len(pending_files)} unchanged"
+    )
 
-        if not doc_data:
-            logging.warning(f"No valid documents in group {group_index}, skipping...")
-            continue
+    dirty = bool(removed_files)
+    if not pending_files:
+        if dirty and index_path is not None:
+            save_checkpoint(knowledge_vectorstore, manifest, index_path, deduplicator)
+        embedding_model.close()
+        return knowledge_vectorstore
+
+    embedding_cache = None
+    if embedding_cache_dir is not None and embedding_cache_mb > 0:
+        # Quantized vectors differ slightly, so each backend has its own cache
+        embedding_cache = EmbeddingCache(
+            embedding_cache_dir,
+            f"{embedding_model_name}-{embedding_model.backend}",
+            embedding_dim,
+            embedding_cache_mb,
+        )
 
-        ds = Dataset.from_dict(
-            {
-                "text": [data["text"] for data in doc_data],
-                "source": [data["source"] for data in doc_data],
-            }
+    pool = None
+    if workers > 1:
+        # Spawn so the workers never inherit the parent's CUDA context
+        pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_chunk_worker,
+            initargs=(embedding_model_name, chunk_tokens, chunk_overlap),
         )
+        logging.info(f"Extracting and chunking with {workers} worker processes")
+    else:
+        _init_chunk_worker(embedding_model_name, chunk_tokens, chunk_overlap)
+
+    stop_event = threading.Event()
+    errors = []
+    chunk_queue = queue.Queue(maxsize=STAGE_QUEUE_SIZE)
+    vector_queue = queue.Queue(maxsize=STAGE_QUEUE_SIZE)
+    stage_seconds = {"embed": 0.0, "index": 0.0, "checkpoint": 0.0}
+
+    def chunk_stage():
+        batch_results, batch_docs, batch_ids, batch_skipped = [], [], [], []
+        batch_bytes = 0
+        batch_index = 0
+        for file, result in _iter_file_chunks(pending_files, pool, max(1, workers) * 4):
+            if stop_event.is_set():
+                return
+            batch_results.append((file, result))
+            if isinstance(result, ArchiveEnd):
+                pass
+            elif result.chunks:
+                source = str(file)
+                if isinstance(result, MemberResult):
+                    source = f"{file}::{result.member}"
+                docs = result.chunks
+                ids = chunk_ids_for(source, result.sha256, len(docs))
+                if deduplicator is not None:
+                    kept = [
+                        (doc, chunk_id)
+                        for doc, chunk_id in zip(docs, ids)
+                        if deduplicator.check(chunk_id, doc.page_content, doc.metadata)
+                        is None
+                    ]
+                    docs = [doc for doc, _ in kept]
+                    ids = [chunk_id for _, chunk_id in kept]
+                batch_docs += docs
+                batch_ids += ids
+                batch_bytes += sum(
+                    len(doc.page_content) * 2
+                    + CHUNK_OVERHEAD_BYTES
+                    + embedding_dim * FLOAT_BYTES
+                    for doc in docs
+                )
+            elif isinstance(result, MemberResult):
+                batch_skipped.append(f"{file.name}::{result.member}")
+            elif not result.unchanged:
+                batch_skipped.append(file.name)
+
+            if batch_bytes >= batch_budget:
+                batch_index += 1
+                batch = ChunkBatch(
+                    batch_index, batch_results, batch_docs, batch_ids, batch_skipped
+                )
+                if not _put(chunk_queue, batch, stop_event):
+                    return
+                batch_results, batch_docs, batch_ids, batch_skipped = [], [], [], []
+                batch_bytes = 0
+
+        if batch_results:
+            batch = ChunkBatch(
+                batch_index + 1, batch_results, batch_docs, batch_ids, batch_skipped
+            )
+            if not _put(chunk_queue, batch, stop_event):
+                return
+        _put(chunk_queue, _DONE, stop_event)
+
+    def embed_stage():
+        nonlocal parity_sample
+        while True:
+            batch = _get(chunk_queue, stop_event)
+            if batch is _DONE:
+                break
+            start_embed_time = time.time()
+            vectors = []
+            texts = [doc.page_content for doc in batch.docs]
+            if texts and parity_sample and embedding_model.backend != "fp32":
+                parity_check(embedding_model, texts[:parity_sample])
+                parity_sample = 0
+            if texts and embedding_cache is not None:
+                vectors = embedding_cache.embed_documents(embedding_model, texts)
+            elif texts:
+                vectors = embedding_model.embed_documents(texts)
+            stage_seconds["embed"] += time.time() - start_embed_time
+            if not _put(vector_queue, (batch, vectors), stop_event):
+                return
+        _put(vector_queue, _DONE, stop_event)
 
-        knowledge_base = [
-            LangchainDocument(
-                page_content=text, metadata={"source": source}
+    stages = [
+        _start_stage("chunk", chunk_stage, stop_event, errors),
+        _start_stage("embed", embed_stage, stop_event, errors),
+    ]
+
+    progress = tqdm(
+        total=len(pending_files), desc=f"{input_type.upper()} files", position=0, leave=False
+    )
+    pipeline_start_time = time.time()
+    batches_since_checkpoint = 0
+    open_archives = {}
+
+    try:
+        while True:
+            item = _get(vector_queue, stop_event)
+            if item is _DONE:
+                break
+            batch, vectors = item
+
+            if batch.skipped:
+                logging.warning(
+                    f"Skipped files in batch {batch.index}: {', '.join(batch.skipped)}"
+                )
+            progress.update(
+                sum(not isinstance(result, MemberResult) for _, result in batch.results)
+            )
+
+            start_index_time = time.time()
+            stale_ids = []
+            for file, result in batch.results:
+                path = str(file)
+                if isinstance(result, FileResult):
+                    if result.unchanged:
+                        num_chunks = manifest.files[path]["num_chunks"]
+                    else:
+                        stale_ids += manifest.chunk_ids(path)
+                        num_chunks = len(result.chunks)
+                    manifest.record(
+                        path, result.size, result.mtime, result.sha256, num_chunks
+                    )
+                    continue
+
+                # Archives may span batches: the old chunks go with the first
+                # result and the manifest entry is written with the last one
+                if path not in open_archives:
+                    stale_ids += manifest.chunk_ids(path)
+                    manifest.files.pop(path, None)
+                    open_archives[path] = {}
+                if isinstance(result, MemberResult):
+                    open_archives[path][result.member] = [
+                        result.sha256,
+                        len(result.chunks),
+                    ]
+                else:
+                    manifest.record_archive(
+                        path,
+                        result.size,
+                        result.mtime,
+                        result.sha256,
+                        open_archives.pop(path),
+                    )
+            stale_ids = [i for i in stale_ids if i not in duplicate_ids]
+            if stale_ids:
+                knowledge_vectorstore.delete(stale_ids)
+
+            if batch.docs:
+                text_embeddings = list(
+                    zip([doc.page_content for doc in batch.docs], vectors)
+                )
+                metadatas = [doc.metadata for doc in batch.docs]
+                if knowledge_vectorstore is None:
+                    logging.info("Creating knowledge vectorstore...")
+                    knowledge_vectorstore = FAISS.from_embeddings(
+                        text_embeddings,
+                        embedding_model,
+                        metadatas=metadatas,
+                        ids=batch.ids,
+                        distance_strategy=DistanceStrategy.COSINE,
+                    )
+                else:
+                    knowledge_vectorstore.add_embeddings(
+                        text_embeddings, metadatas=metadatas, ids=batch.ids
+                    )
+            stage_seconds["index"] += time.time() - start_index_time
+
+            num_documents = sum(
+                not isinstance(result, ArchiveEnd) for _, result in batch.results
             )
-            for text, source in zip(ds["text"], ds["source"])
-        ]
-
-        logging.info("Splitting text into chunks...")
-        docs_processed = []
-        for doc in knowledge_base:
-            docs_processed += text_splitter.split_documents([doc])
-
-        start_vectorstore_time = time.time()
-        if knowledge_vectorstore is None:
-            logging.info("Creating knowledge vectorstore...")
-            knowledge_vectorstore = FAISS.from_documents(
-                docs_processed,
-                embedding_model,
-                distance_strategy=DistanceStrategy.COSINE,
+            logging.info(
+                f"Batch {batch.index}: {len(batch.docs)} chunks from "
+                f"{num_documents} files added to vectorstore"
             )
-        else:
-            logging.info("Adding to knowledge vectorstore...")
-            knowledge_vectorstore.add_documents(docs_processed)
 
-        vectorstore_elapsed_time = format_time(int(time.time() - start_vectorstore_time))
-        logging.info(
-            f"Group {group_index} vectorstore added in {vectorstore_elapsed_time}"
-        )
+            dirty = True
+            batches_since_checkpoint += 1
+            if (
+                index_path is not None
+                and knowledge_vectorstore is not None
+                and batches_since_checkpoint >= checkpoint_every
+            ):
+                start_checkpoint_time = time.time()
+                save_checkpoint(
+                    knowledge_vectorstore, manifest, index_path, deduplicator
+                )
+                stage_seconds["checkpoint"] += time.time() - start_checkpoint_time
+                batches_since_checkpoint = 0
+                dirty = False
+    finally:
+        stop_event.set()
+        progress.close()
+        for stage in stages:
+            stage.join()
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        if embedding_cache is not None:
+            embedding_cache.close()
+        embedding_model.close()
+
+    if errors:
+        raise errors[0]
+
+    if dirty and index_path is not None and knowledge_vectorstore is not None:
+        save_checkpoint(knowledge_vectorstore, manifest, index_path, deduplicator)
+
+    pipeline_elapsed_time = format_time(int(time.time() - pipeline_start_time))
+    logging.info(
+        f"Pipeline finished in {pipeline_elapsed_time} "
+        f"(embedding busy {format_time(stage_seconds['embed'])}, "
+        f"indexing busy {format_time(stage_seconds['index'])}, "
+        f"checkpointing {format_time(stage_seconds['checkpoint'])}, "
+        f"peak RSS {peak_rss_mb():.0f} MB)"
+    )
+    embedding_model.log_stats()
+    if embedding_cache is not None:
+        embedding_cache.log_stats()
+    if deduplicator is not None:
+        deduplicator.log_stats()
 
     return knowledge_vectorstore
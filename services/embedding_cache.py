@@ -0,0 +1,143 @@
+import re
+import sqlite3
+import hashlib
+import logging
+import threading
+import numpy as np
+from pathlib import Path
+from typing import Dict, List
+
+
+def normalize_chunk_text(text: str) -> str:
+    """Collapses whitespace so re-extracted copies of a chunk share a cache key"""
+    return " ".join(text.split())
+
+
+def chunk_cache_key(text: str) -> str:
+    return hashlib.sha256(normalize_chunk_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Content-addressed, size-capped on-disk cache of chunk embeddings
+
+    Each embedding model gets its own directory holding a memory-mapped float32
+    array of vectors and a SQLite table mapping chunk text hashes to rows of
+    that array. When the cache is full the least recently used rows are reused.
+    """
+
+    def __init__(self, cache_dir: Path, model_name: str, dim: int, max_mb: int):
+        model_slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name)
+        self.path = Path(cache_dir) / model_slug
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.dim = dim
+        self.capacity = max(1, max_mb * 1024 * 1024 // (dim * 4))
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(str(self.path / "index.sqlite"), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries "
+            "(key TEXT PRIMARY KEY, slot INTEGER NOT NULL, last_used INTEGER NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)"
+        )
+        # Rows beyond a reduced size cap are dropped
+        self._db.execute("DELETE FROM entries WHERE slot >= ?", (self.capacity,))
+        self._db.commit()
+
+        vectors_path = self.path / f"vectors-{dim}.f32"
+        with open(vectors_path, "ab") as f:
+            f.truncate(self.capacity * dim * 4)
+        self._vectors = np.memmap(
+            vectors_path, dtype=np.float32, mode="r+", shape=(self.capacity, dim)
+        )
+
+        used_slots = {slot for (slot,) in self._db.execute("SELECT slot FROM entries")}
+        self._free_slots = [s for s in range(self.capacity - 1, -1, -1) if s not in used_slots]
+        self._tick = self._db.execute(
+            "SELECT COALESCE(MAX(last_used), 0) FROM entries"
+        ).fetchone()[0]
+
+    def lookup(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """Returns the cached vectors for `keys` and marks them as recently used"""
+        found = {}
+        with self._lock:
+            unique_keys = list(dict.fromkeys(keys))
+            for i in range(0, len(unique_keys), 500):
+                batch_keys = unique_keys[i : i + 500]
+                placeholders = ",".join("?" * len(batch_keys))
+                rows = self._db.execute(
+                    f"SELECT key, slot FROM entries WHERE key IN ({placeholders})",
+                    batch_keys,
+                ).fetchall()
+                for key, slot in rows:
+                    found[key] = np.array(self._vectors[slot])
+
+            self._tick += 1
+            self._db.executemany(
+                "UPDATE entries SET last_used = ? WHERE key = ?",
+                [(self._tick, key) for key in found],
+            )
+            self._db.commit()
+        return found
+
+    def put(self, keys: List[str], vectors: List[List[float]]):
+        """Stores new vectors, evicting the least recently used ones if needed"""
+        with self._lock:
+            entries = dict(zip(keys, vectors))
+            needed = len(entries) - len(self._free_slots)
+            if needed > 0:
+                evicted = self._db.execute(
+                    "SELECT key, slot FROM entries ORDER BY last_used LIMIT ?", (needed,)
+                ).fetchall()
+                self._db.executemany(
+                    "DELETE FROM entries WHERE key = ?", [(key,) for key, _ in evicted]
+                )
+                self._free_slots += [slot for _, slot in evicted]
+
+            self._tick += 1
+            rows = []
+            for key, vector in list(entries.items())[: len(self._free_slots)]:
+                slot = self._free_slots.pop()
+                self._vectors[slot] = vector
+                rows.append((key, slot, self._tick))
+            self._vectors.flush()
+            self._db.executemany(
+                "INSERT OR REPLACE INTO entries (key, slot, last_used) VALUES (?, ?, ?)",
+                rows,
+            )
+            self._db.commit()
+
+    def embed_documents(self, embedding_model, texts: List[str]) -> List[List[float]]:
+        """Embeds `texts`, calling `embedding_model` only for cache misses"""
+        keys = [chunk_cache_key(text) for text in texts]
+        cached = self.lookup(keys)
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key in cached:
+                self.hits += 1
+            else:
+                self.misses += 1
+                missing.setdefault(key, text)
+
+        if missing:
+            new_vectors = embedding_model.embed_documents(list(missing.values()))
+            self.put(list(missing.keys()), new_vectors)
+            cached.update(zip(missing.keys(), new_vectors))
+
+        return [cached[key] for key in keys]
+
+    def log_stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups else 0.0
+        logging.info(
+            f"Embedding cache: {self.hits}/{lookups} chunks served from cache "
+            f"({hit_rate:.1f}% hit rate)"
+        )
+
+    def close(self):
+        self._vectors.flush()
+        self._db.close()
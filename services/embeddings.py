@@ -0,0 +1,258 @@
+import os
+import time
+import logging
+import multiprocessing
+import numpy as np
+import torch
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+from langchain_core.embeddings import Embeddings
+from sentence_transformers import SentenceTransformer
+from transformers import AutoTokenizer
+
+EMBEDDING_BACKENDS = ["auto", "fp32", "int8"]
+
+# Per-process encoder for the multi-process CPU backend, set by _init_encoder_worker
+_worker_model = None
+
+
+def detect_device() -> str:
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def load_sentence_model(
+    model_name: str, device: str, backend: str, num_threads: Optional[int] = None
+) -> SentenceTransformer:
+    """Loads a sentence-transformers model, int8-quantizing its linear layers if asked"""
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    model = SentenceTransformer(model_name, device=device)
+    if backend == "int8":
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    model.eval()
+    return model
+
+
+def _init_encoder_worker(model_name, backend, num_threads):
+    global _worker_model
+    _worker_model = load_sentence_model(model_name, "cpu", backend, num_threads)
+
+
+def _encode(model: SentenceTransformer, texts: List[str], batch_size: int) -> np.ndarray:
+    with torch.inference_mode():
+        return model.encode(
+            texts,
+            batch_size=batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+
+
+def _encode_in_worker(texts: List[str], batch_size: int) -> np.ndarray:
+    return _encode(_worker_model, texts, batch_size)
+
+
+def _worker_max_seq_length() -> int:
+    return _worker_model.max_seq_length
+
+
+def bucket_by_length(lengths: List[int], batch_tokens: int) -> List[List[int]]:
+    """Groups text indices into batches of similar length
+
+    Indices are sorted by token length and greedily packed so that each batch,
+    padded to its longest member, stays within `batch_tokens` tokens.
+    """
+    batches = []
+    batch = []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # Sorted ascending, so the new item is the longest of the batch
+        if batch and (len(batch) + 1) * lengths[i] > batch_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class SentenceEmbedder(Embeddings):
+    """Normalized sentence-transformers embeddings for index builds
+
+    On CPU the default backend is dynamic int8 quantization of the linear
+    layers, with torch intra-op threads split across `num_processes` encoder
+    processes. On GPU the model runs in plain fp32.
+
+    Texts are sorted into token-length buckets and encoded in batches of at
+    most `batch_tokens` padded tokens, then scattered back to input order.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        device: Optional[str] = None,
+        backend: str = "auto",
+        num_processes: int = 1,
+        num_threads: Optional[int] = None,
+        batch_size: int = 32,
+        batch_tokens: int = 8192,
+    ):
+        if backend not in EMBEDDING_BACKENDS:
+            raise ValueError(f"Unsupported embedding backend: {backend}")
+        self.model_name = model_name
+        self.device = device or detect_device()
+        if backend == "auto":
+            backend = "int8" if self.device == "cpu" else "fp32"
+        if backend == "int8" and self.device != "cpu":
+            raise ValueError("The int8 embedding backend only runs on CPU")
+        self.backend = backend
+        self.batch_size = batch_size
+        self.batch_tokens = batch_tokens
+        self.stats = {
+            "texts": 0,
+            "tokens": 0,
+            "padded_tokens": 0,
+            "unbucketed_tokens": 0,
+            "seconds": 0.0,
+        }
+
+        num_processes = max(1, num_processes) if self.device == "cpu" else 1
+        if self.device == "cpu" and num_threads is None:
+            num_threads = max(1, (os.cpu_count() or 1) // num_processes)
+        self.num_processes = num_processes
+        self.num_threads = num_threads
+
+        self.model = None
+        self.pool = None
+        if num_processes > 1:
+            self.pool = ProcessPoolExecutor(
+                max_workers=num_processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_encoder_worker,
+                initargs=(model_name, backend, num_threads),
+            )
+        else:
+            self.model = load_sentence_model(model_name, self.device, backend, num_threads)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+        if self.model is not None:
+            self.max_seq_length = self.model.max_seq_length
+        else:
+            self.max_seq_length = self.pool.submit(_worker_max_seq_length).result()
+
+        logging.info(
+            f"Embedding with {model_name} on {self.device} ({backend}, "
+            f"{num_processes} process(es), {num_threads or 'default'} threads each)"
+        )
+
+    def token_lengths(self, texts: List[str]) -> List[int]:
+        """Token counts after truncation, from one call to the fast batch tokenizer"""
+        encoded = self.tokenizer(
+            texts,
+            add_special_tokens=True,
+            truncation=True,
+            max_length=self.max_seq_length,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+        )
+        return [len(ids) for ids in encoded["input_ids"]]
+
+    def encode(self, texts: List[str], record_stats: bool = True) -> np.ndarray:
+        """Embeds `texts` in length-bucketed batches, returned in input order
+
+        With `record_stats=False`, the texts are left out of the throughput
+        and padding stats logged by `log_stats`.
+        """
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        start_time = time.time()
+        lengths = self.token_lengths(texts)
+        batches = bucket_by_length(lengths, self.batch_tokens)
+        batch_texts = [[texts[i] for i in batch] for batch in batches]
+
+        if self.pool is None:
+            results = [_encode(self.model, chunk, len(chunk)) for chunk in batch_texts]
+        else:
+            results = list(
+                self.pool.map(
+                    _encode_in_worker, batch_texts, [len(chunk) for chunk in batch_texts]
+                )
+            )
+
+        vectors = np.empty((len(texts), results[0].shape[1]), dtype=np.float32)
+        for batch, batch_vectors in zip(batches, results):
+            vectors[batch] = batch_vectors
+
+        if not record_stats:
+            return vectors
+        self.stats["texts"] += len(texts)
+        self.stats["tokens"] += sum(lengths)
+        self.stats["padded_tokens"] += sum(
+            len(batch) * max(lengths[i] for i in batch) for batch in batches
+        )
+        # What fixed-size batches in input order would have padded to
+        self.stats["unbucketed_tokens"] += sum(
+            len(lengths[i : i + self.batch_size]) * max(lengths[i : i + self.batch_size])
+            for i in range(0, len(lengths), self.batch_size)
+        )
+        self.stats["seconds"] += time.time() - start_time
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.encode([text])[0].tolist()
+
+    def log_stats(self):
+        stats = self.stats
+        if not stats["padded_tokens"]:
+            return
+        waste = 1 - stats["tokens"] / stats["padded_tokens"]
+        unbucketed_waste = 1 - stats["tokens"] / stats["unbucketed_tokens"]
+        tokens_per_second = stats["tokens"] / stats["seconds"] if stats["seconds"] else 0.0
+        logging.info(
+            f"Embedded {stats['texts']} chunks, {stats['tokens']} tokens at "
+            f"{tokens_per_second:.0f} tokens/s; padding waste {waste:.1%} "
+            f"(vs {unbucketed_waste:.1%} with unbucketed batches of {self.batch_size})"
+        )
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+def parity_check(embedder: SentenceEmbedder, texts: List[str]) -> dict:
+    """Compares `embedder` against fp32 vectors of the same model on `texts`
+
+    Returns the mean, 1st-percentile and minimum cosine similarity between the
+    two sets of (normalized) vectors and the speedup of `embedder`.
+    """
+    reference_model = load_sentence_model(embedder.model_name, embedder.device, "fp32")
+
+    start_time = time.time()
+    reference = _encode(reference_model, texts, embedder.batch_size)
+    reference_seconds = time.time() - start_time
+
+    start_time = time.time()
+    # The sample is not part of the build's embedding stats
+    candidate = embedder.encode(texts, record_stats=False)
+    candidate_seconds = time.time() - start_time
+
+    cosines = np.sum(reference * candidate, axis=1)
+    report = {
+        "num_texts": len(texts),
+        "mean_cosine": float(cosines.mean()),
+        "p1_cosine": float(np.percentile(cosines, 1)),
+        "min_cosine": float(cosines.min()),
+        "speedup": reference_seconds / candidate_seconds if candidate_seconds else 0.0,
+    }
+    logging.info(
+        f"Embedding parity ({embedder.backend} vs fp32) on {len(texts)} chunks: "
+        f"mean cosine {report['mean_cosine']:.4f}, p1 {report['p1_cosine']:.4f}, "
+        f"min {report['min_cosine']:.4f}, {report['speedup']:.2f}x throughput"
+    )
+    return report
@@ -0,0 +1,170 @@
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+log = logging.getLogger(__name__)
+
+# Requests kept for the latency percentiles
+LATENCY_WINDOW = 1000
+
+
+class _Request:
+    def __init__(self, prompt: str, num_tokens: int, streamer=None):
+        self.prompt = prompt
+        self.num_tokens = num_tokens
+        self.streamer = streamer
+        self.future = Future()
+        self.submitted = time.time()
+
+
+class GenerationBatcher:
+    """Micro-batches concurrent calls to a text-generation pipeline
+
+    Callable like the pipeline itself with a single prompt, from any number
+    of threads. A scheduler thread collects the prompts arriving within
+    `max_wait` seconds of the first one, up to `max_batch_size` prompts and
+    `max_batch_tokens` padded tokens (longest prompt plus `max_new_tokens`,
+    times the batch size), and generates them in one batched call. Calls
+    with a `streamer` are generated on their own, since streamers follow a
+    single sequence.
+    """
+
+    def __init__(
+        self,
+        llm,
+        tokenizer,
+        max_batch_size: int = 8,
+        max_wait: float = 0.05,
+        max_batch_tokens: int = 16384,
+        max_new_tokens: int = 500,
+    ):
+        self.llm = llm
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_batch_tokens = max_batch_tokens
+        self.max_new_tokens = max_new_tokens
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._waits = deque(maxlen=LATENCY_WINDOW)
+        self._counts = {"requests": 0, "batches": 0, "failed": 0}
+        self._busy_seconds = 0.0
+        self._thread = threading.Thread(
+            target=self._schedule, name="generation-batcher", daemon=True
+        )
+        self._thread.start()
+
+    def __call__(self, prompts, **kwargs):
+        """Generates one prompt, or a list of them like the pipeline does
+
+        Pipeline arguments such as batch_size are ignored; the batcher decides.
+        A `streamer` (single prompt only) receives the tokens as they decode.
+        """
+        single = isinstance(prompts, str)
+        streamer = kwargs.get("streamer")
+        if streamer is not None and not single:
+            raise ValueError("A streamer can only follow a single prompt")
+        requests = []
+        for prompt in [prompts] if single else prompts:
+            num_tokens = len(self.tokenizer(prompt, add_special_tokens=False).input_ids)
+            requests.append(_Request(prompt, num_tokens, streamer))
+            self._queue.put(requests[-1])
+        outputs = [request.future.result() for request in requests]
+        return outputs[0] if single else outputs
+
+    def _batch_tokens(self, batch) -> int:
+        longest = max(request.num_tokens for request in batch)
+        return len(batch) * (longest + self.max_new_tokens)
+
+    def _collect(self, carried):
+        """Blocks for the first request, then gathers more until the batch is full"""
+        batch = [carried or self._queue.get()]
+        if batch[0].streamer is not None:
+            return batch, None
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if (
+                request.streamer is not None
+                or self._batch_tokens(batch + [request]) > self.max_batch_tokens
+            ):
+                # Starts the next batch instead
+                return batch, request
+            batch.append(request)
+        return batch, None
+
+    def _schedule(self):
+        carried = None
+        while True:
+            batch, carried = self._collect(carried)
+            start_time = time.time()
+            try:
+                if batch[0].streamer is not None:
+                    outputs = [self.llm(batch[0].prompt, streamer=batch[0].streamer)]
+                else:
+                    outputs = self.llm(
+                        [request.prompt for request in batch], batch_size=len(batch)
+                    )
+            except Exception as e:
+                log.error(f"Generation failed for a batch of {len(batch)}: {e}")
+                with self._lock:
+                    self._counts["failed"] += len(batch)
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+
+            end_time = time.time()
+            with self._lock:
+                self._counts["requests"] += len(batch)
+                self._counts["batches"] += 1
+                self._busy_seconds += end_time - start_time
+                for request in batch:
+                    self._latencies.append(end_time - request.submitted)
+                    self._waits.append(start_time - request.submitted)
+            log.info(
+                f"Generated a batch of {len(batch)} in {end_time - start_time:.1f}s"
+            )
+            for request, output in zip(batch, outputs):
+                request.future.set_result(output)
+
+    def stats(self) -> dict:
+        """Throughput and latency, to tune the batch window and limits"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            waits = sorted(self._waits)
+            counts = dict(self._counts)
+            busy_seconds = self._busy_seconds
+        uptime = time.time() - self._started
+
+        def percentile(values, p):
+            if not values:
+                return None
+            return round(values[min(len(values) - 1, int(p * len(values)))], 3)
+
+        return {
+            **counts,
+            "queued": self._queue.qsize(),
+            "mean_batch_size": round(counts["requests"] / counts["batches"], 2)
+            if counts["batches"]
+            else None,
+            "requests_per_second": round(counts["requests"] / uptime, 4),
+            "busy_fraction": round(busy_seconds / uptime, 4),
+            "latency_p50": percentile(latencies, 0.5),
+            "latency_p95": percentile(latencies, 0.95),
+            "queue_wait_p50": percentile(waits, 0.5),
+            "queue_wait_p95": percentile(waits, 0.95),
+            "max_batch_size": self.max_batch_size,
+            "max_wait": self.max_wait,
+            "max_batch_tokens": self.max_batch_tokens,
+        }
@@ -0,0 +1,222 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+from langchain_community.vectorstores import FAISS
+
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+
+
+def chunk_ids_for(path: str, sha256: str, num_chunks: int) -> List[str]:
+    """Deterministic docstore ids for the chunks of one version of a file"""
+    path_key = hashlib.sha1(path.encode("utf-8")).hexdigest()[:12]
+    return [f"{path_key}-{sha256[:12]}-{i}" for i in range(num_chunks)]
+
+
+def manifest_fingerprint(index_dir: Path) -> str:
+    """Identifies a saved build, so files derived from it can be checked as current"""
+    with open(Path(index_dir) / MANIFEST_FILE, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class IndexManifest:
+    """Records size, mtime, content hash and chunk count of every indexed file"""
+
+    def __init__(
+        self, files: Optional[Dict[str, dict]] = None, settings: Optional[dict] = None
+    ):
+        self.files = files or {}
+        self.settings = settings or {}
+
+    @classmethod
+    def load(cls, index_dir: Path) -> "IndexManifest":
+        manifest_path = Path(index_dir) / MANIFEST_FILE
+        if not manifest_path.exists():
+            return cls()
+        with open(manifest_path, "r") as f:
+            data = json.load(f)
+        return cls(data.get("files", {}), data.get("settings", {}))
+
+    def save(self, index_dir: Path):
+        manifest_path = Path(index_dir) / MANIFEST_FILE
+        tmp_path = manifest_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "version": MANIFEST_VERSION,
+                    "settings": self.settings,
+                    "files": self.files,
+                },
+                f,
+            )
+        os.replace(tmp_path, manifest_path)
+
+    def record(self, path: str, size: int, mtime: float, sha256: str, num_chunks: int):
+        self.files[path] = {
+            "size": size,
+            "mtime": mtime,
+            "sha256": sha256,
+            "num_chunks": num_chunks,
+        }
+
+    def record_archive(
+        self, path: str, size: int, mtime: float, sha256: str, members: Dict[str, list]
+    ):
+        """Records an archive with the [sha256, num_chunks] of each BioC member"""
+        self.files[path] = {
+            "size": size,
+            "mtime": mtime,
+            "sha256": sha256,
+            "members": members,
+        }
+
+    def chunk_ids(self, path: str) -> List[str]:
+        entry = self.files.get(path)
+        if entry is None:
+            return []
+        if "members" in entry:
+            return [
+                chunk_id
+                for member, (sha256, num_chunks) in entry["members"].items()
+                for chunk_id in chunk_ids_for(f"{path}::{member}", sha256, num_chunks)
+            ]
+        return chunk_ids_for(path, entry["sha256"], entry["num_chunks"])
+
+    def owners(self) -> Dict[str, str]:
+        """Maps the path key embedded in chunk ids back to manifest paths"""
+        owners = {}
+        for path, entry in self.files.items():
+            sources = [path]
+            if "members" in entry:
+                sources = [f"{path}::{member}" for member in entry["members"]]
+            for source in sources:
+                owners[hashlib.sha1(source.encode("utf-8")).hexdigest()[:12]] = path
+        return owners
+
+    def all_chunk_ids(self) -> Set[str]:
+        return {chunk_id for path in self.files for chunk_id in self.chunk_ids(path)}
+
+    def plan(
+        self, input_files: List[Path]
+    ) -> Tuple[List[Tuple[Path, Optional[str]]], List[str]]:
+        """Splits the input into files to (re)process and indexed files now gone
+
+        Files whose size and mtime match the manifest are skipped without being
+        read. Everything else is returned with its last known hash, so workers
+        can skip files that were only touched.
+        """
+        pending = []
+        seen = set()
+        for file in input_files:
+            path = str(file)
+            seen.add(path)
+            entry = self.files.get(path)
+            if entry is not None:
+                stat = file.stat()
+                if stat.st_size == entry["size"] and stat.st_mtime == entry["mtime"]:
+                    continue
+            pending.append((file, entry["sha256"] if entry else None))
+
+        removed = [path for path in self.files if path not in seen]
+        return pending, removed
+
+
+def _recover_index_dir(index_dir: Path):
+    """Finishes or discards a checkpoint interrupted by a crash"""
+    tmp_dir = index_dir.with_name(index_dir.name + ".tmp")
+    old_dir = index_dir.with_name(index_dir.name + ".old")
+    if not index_dir.exists() and (tmp_dir / MANIFEST_FILE).exists():
+        # The crash happened between the two renames, the new checkpoint is complete
+        os.rename(tmp_dir, index_dir)
+    for stale_dir in (tmp_dir, old_dir):
+        if stale_dir.exists():
+            shutil.rmtree(stale_dir)
+
+
+def load_checkpoint(
+    index_dir: Path, embedding_model, settings: dict, deduplicator=None
+) -> Tuple[Optional[FAISS], IndexManifest]:
+    """Loads a previous (possibly partial) build and reconciles it with its manifest
+
+    A build made with different settings (chunking, embedding model, ...) cannot
+    be extended, so it is ignored and the index is rebuilt from scratch. The
+    state of `deduplicator`, if given, is restored along with the index.
+    """
+    index_dir = Path(index_dir)
+    _recover_index_dir(index_dir)
+    if not (index_dir / MANIFEST_FILE).exists():
+        return None, IndexManifest(settings=settings)
+
+    manifest = IndexManifest.load(index_dir)
+    if manifest.settings != settings:
+        logging.warning(
+            f"Build settings changed since the index in {index_dir} was built, "
+            "rebuilding from scratch"
+        )
+        return None, IndexManifest(settings=settings)
+    vectorstore = FAISS.load_local(
+        str(index_dir),
+        embeddings=embedding_model,
+        allow_dangerous_deserialization=True,
+    )
+
+    stored_ids = set(vectorstore.index_to_docstore_id.values())
+    expected_ids = manifest.all_chunk_ids()
+    orphan_ids = list(stored_ids - expected_ids)
+    if orphan_ids:
+        logging.warning(f"Removing {len(orphan_ids)} chunks missing from the manifest")
+        vectorstore.delete(orphan_ids)
+        stored_ids -= set(orphan_ids)
+
+    # Deduplicated chunks are accounted for by a pointer to their kept copy
+    accounted_ids = stored_ids
+    if deduplicator is not None:
+        deduplicator.load(index_dir)
+        deduplicator.retain(stored_ids, expected_ids)
+        accounted_ids = stored_ids | set(deduplicator.pointers)
+
+    incomplete = [
+        path
+        for path in manifest.files
+        if any(chunk_id not in accounted_ids for chunk_id in manifest.chunk_ids(path))
+    ]
+    for path in incomplete:
+        present_ids = [i for i in manifest.chunk_ids(path) if i in stored_ids]
+        if present_ids:
+            vectorstore.delete(present_ids)
+        if deduplicator is not None:
+            deduplicator.remove(manifest.chunk_ids(path))
+        del manifest.files[path]
+
+    logging.info(
+        f"Resuming from {len(manifest.files)} indexed files "
+        f"({vectorstore.index.ntotal} chunks) in {index_dir}"
+    )
+    return vectorstore, manifest
+
+
+def save_checkpoint(
+    vectorstore: FAISS, manifest: IndexManifest, index_dir: Path, deduplicator=None
+):
+    """Atomically replaces `index_dir` with the current index and manifest"""
+    index_dir = Path(index_dir)
+    tmp_dir = index_dir.with_name(index_dir.name + ".tmp")
+    old_dir = index_dir.with_name(index_dir.name + ".old")
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+
+    vectorstore.save_local(str(tmp_dir))
+    if deduplicator is not None:
+        deduplicator.save(tmp_dir)
+    # The manifest is written last and marks the checkpoint as complete
+    manifest.save(tmp_dir)
+
+    if index_dir.exists():
+        os.rename(index_dir, old_dir)
+    os.rename(tmp_dir, index_dir)
+    if old_dir.exists():
+        shutil.rmtree(old_dir)
@@ -0,0 +1,212 @@
+import gc
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+from .ann_index import ANN_REPORT_FILE
+from .index_manifest import MANIFEST_FILE, manifest_fingerprint
+from .lexical_index import LEXICAL_INFO_FILE
+from .metadata_index import METADATA_INFO_FILE
+
+CURRENT_FILE = "CURRENT"
+VERSION_FILE = "version.json"
+# Reports of the files derived from the chunks: a rebuild that only changes
+# these (index type, vector codec, BM25 on or off) is still a new version
+DERIVED_REPORT_FILES = [ANN_REPORT_FILE, LEXICAL_INFO_FILE, METADATA_INFO_FILE]
+
+log = logging.getLogger(__name__)
+
+
+def versions_root_for(index_path: Path) -> Path:
+    """Directory holding the published versions of the index built at `index_path`"""
+    index_path = Path(index_path)
+    return index_path.with_name(index_path.name + ".versions")
+
+
+def current_version_dir(index_path: Path) -> Path:
+    """Directory of the current published version, or `index_path` if none is"""
+    root = versions_root_for(index_path)
+    current_path = root / CURRENT_FILE
+    if not current_path.exists():
+        return Path(index_path)
+    return root / current_path.read_text().strip()
+
+
+def read_version_info(version_dir: Path) -> dict:
+    version_path = Path(version_dir) / VERSION_FILE
+    if not version_path.exists():
+        return {"version": None, "path": str(version_dir)}
+    with open(version_path, "r") as f:
+        return json.load(f)
+
+
+def build_key(index_path: Path) -> str:
+    """Identifies a build by its manifest and the reports of its derived files"""
+    digest = hashlib.sha256(manifest_fingerprint(index_path).encode("utf-8"))
+    for name in DERIVED_REPORT_FILES:
+        path = Path(index_path) / name
+        digest.update(f"\0{name}\0".encode("utf-8"))
+        if path.exists():
+            digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def _link_or_copy(source: Path, target: Path):
+    # Builds replace files rather than rewrite them, so hard links are safe
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def publish_version(index_path: Path, keep: int = 3) -> Optional[str]:
+    """Publishes the finished build at `index_path` as a new immutable version
+
+    The files are hard-linked (or copied) into `<index>.versions/<version>/`
+    with a version.json, then the CURRENT pointer is switched atomically. The
+    oldest versions beyond `keep` are deleted. Returns the new version, or
+    None if the build, derived files included, is already the current version.
+    """
+    index_path = Path(index_path)
+    root = versions_root_for(index_path)
+    root.mkdir(parents=True, exist_ok=True)
+    fingerprint = manifest_fingerprint(index_path)
+    key = build_key(index_path)
+    current = read_version_info(current_version_dir(index_path))
+    if current.get("build_key") == key:
+        log.info(f"Version {current['version']} of {index_path} is already current")
+        return None
+
+    version = f"{time.strftime('%Y%m%d-%H%M%S')}-{key[:8]}"
+    tmp_dir = root / f"{version}.tmp"
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir()
+    for source in index_path.iterdir():
+        if source.is_file():
+            _link_or_copy(source, tmp_dir / source.name)
+    with open(tmp_dir / MANIFEST_FILE, "r") as f:
+        num_files = len(json.load(f).get("files", {}))
+    with open(tmp_dir / VERSION_FILE, "w") as f:
+        json.dump(
+            {
+                "version": version,
+                "fingerprint": fingerprint,
+                "build_key": key,
+                "created": time.time(),
+                "source": str(index_path),
+                "num_files": num_files,
+            },
+            f,
+            indent=2,
+        )
+    os.rename(tmp_dir, root / version)
+
+    pointer_tmp = root / (CURRENT_FILE + ".tmp")
+    pointer_tmp.write_text(version)
+    os.replace(pointer_tmp, root / CURRENT_FILE)
+    log.info(f"Published {index_path} as version {version}")
+
+    versions = sorted(
+        path.name for path in root.iterdir() if (path / VERSION_FILE).exists()
+    )
+    # Servers still draining a deleted version keep their open files and maps
+    for old in versions[: max(0, len(versions) - keep)]:
+        if old != version:
+            shutil.rmtree(root / old)
+            log.info(f"Deleted old index version {old}")
+    return version
+
+
+class _LoadedVersion:
+    def __init__(self, info: dict, knowledge_base):
+        self.info = info
+        self.label = info.get("version") or info.get("path")
+        self.knowledge_base = knowledge_base
+        self.in_flight = 0
+        self.retired = False
+
+
+class VersionedKnowledgeBase:
+    """The served knowledge base, swappable while queries are running
+
+    Queries hold the version they started with through `acquire()`. After a
+    `swap()`, new queries get the new version while the old one drains; once
+    its last query finishes it is closed and its memory released.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = None
+        self._draining = []
+
+    @property
+    def knowledge_base(self):
+        with self._lock:
+            return self._current.knowledge_base if self._current else None
+
+    @property
+    def version(self) -> Optional[str]:
+        """Version (or path, if unpublished) of the served index"""
+        with self._lock:
+            return self._current.label if self._current else None
+
+    @contextmanager
+    def acquire(self):
+        with self._lock:
+            loaded = self._current
+            if loaded is not None:
+                loaded.in_flight += 1
+        try:
+            yield loaded.knowledge_base if loaded else None
+        finally:
+            if loaded is not None:
+                with self._lock:
+                    loaded.in_flight -= 1
+                    drained = loaded.retired and loaded.in_flight == 0
+                if drained:
+                    self._release(loaded)
+
+    def swap(self, info: dict, knowledge_base):
+        with self._lock:
+            old = self._current
+            self._current = _LoadedVersion(info, knowledge_base)
+            drained = False
+            if old is not None:
+                old.retired = True
+                drained = old.in_flight == 0
+                if not drained:
+                    self._draining.append(old)
+        log.info(f"Now serving index version {self._current.label}")
+        if drained:
+            self._release(old)
+
+    def _release(self, loaded: _LoadedVersion):
+        with self._lock:
+            if loaded in self._draining:
+                self._draining.remove(loaded)
+            knowledge_base, loaded.knowledge_base = loaded.knowledge_base, None
+        close = getattr(getattr(knowledge_base, "docstore", None), "close", None)
+        if close is not None:
+            close()
+        del knowledge_base
+        gc.collect()
+        log.info(f"Released index version {loaded.label}")
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "current": dict(self._current.info, in_flight=self._current.in_flight)
+                if self._current
+                else None,
+                "draining": [
+                    dict(loaded.info, in_flight=loaded.in_flight)
+                    for loaded in self._draining
+                ],
+            }
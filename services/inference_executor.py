@@ -0,0 +1,109 @@
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class QueueFullError(Exception):
+    """Raised when a job is refused because every worker and queue slot is taken"""
+
+
+class JobTimeoutError(Exception):
+    """Raised when a job does not finish within its timeout
+
+    `started` tells whether it timed out while running or still waiting in
+    the queue (in which case it was dropped without running).
+    """
+
+    def __init__(self, message: str, started: bool):
+        super().__init__(message)
+        self.started = started
+
+
+class InferenceExecutor:
+    """Bounded thread pool that runs blocking model calls off the event loop
+
+    At most `max_workers` jobs run at once and at most `max_queue` more wait
+    for a worker; further jobs are refused with QueueFullError instead of
+    piling up. A job that times out keeps its slot until its thread actually
+    returns, so slow jobs cannot push the server past its limits.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int, timeout: float):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=f"{name}-worker"
+        )
+        self._lock = threading.Lock()
+        self._admitted = 0
+        self._running = 0
+        self.stats = {"completed": 0, "failed": 0, "rejected": 0, "timed_out": 0}
+
+    async def run(self, fn, *args, **kwargs):
+        """Runs `fn(*args, **kwargs)` on a worker thread and returns its result"""
+        future = self.submit(fn, *args, **kwargs)
+        try:
+            return await asyncio.wait_for(
+                asyncio.wrap_future(future), timeout=self.timeout
+            )
+        except asyncio.TimeoutError:
+            # A job still in the queue is cancelled by wait_for and never runs
+            with self._lock:
+                self.stats["timed_out"] += 1
+            started = future.started.is_set()
+            where = "running" if started else "waiting in the queue"
+            raise JobTimeoutError(f"Timed out after {self.timeout}s {where}", started)
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """Queues `fn(*args, **kwargs)` without waiting for it
+
+        Raises QueueFullError right away if the job is not admitted. The
+        returned future has a `started` event, set once a worker picks it up.
+        """
+        with self._lock:
+            if self._admitted >= self.max_workers + self.max_queue:
+                self.stats["rejected"] += 1
+                raise QueueFullError(f"The {self.name} queue is full")
+            self._admitted += 1
+
+        started = threading.Event()
+
+        def job():
+            started.set()
+            with self._lock:
+                self._running += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+
+        future = self._executor.submit(job)
+        future.started = started
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future):
+        with self._lock:
+            self._admitted -= 1
+            if future.cancelled():
+                return
+            if future.exception() is not None:
+                self.stats["failed"] += 1
+            else:
+                self.stats["completed"] += 1
+
+    def load(self) -> dict:
+        with self._lock:
+            return {
+                "running": self._running,
+                "queued": self._admitted - self._running,
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                **self.stats,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
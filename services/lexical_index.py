@@ -0,0 +1,200 @@
+import os
+import re
+import json
+import math
+import logging
+import numpy as np
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import List, Optional, Tuple
+from .index_manifest import manifest_fingerprint
+
+LEXICAL_INFO_FILE = "bm25.json"
+# Arrays of the index, each memory-mapped by the API
+LEXICAL_ARRAYS = [
+    "terms",  # uint8: the sorted vocabulary, UTF-8 encoded back to back
+    "term_offsets",  # int64: start of each term in `terms`, plus the end
+    "postings_offsets",  # int64: start of each term's postings, plus the end
+    "postings_docs",  # int32: FAISS positions of the chunks containing the term
+    "postings_tfs",  # uint16: occurrences of the term in each of those chunks
+    "doc_lengths",  # int32: number of terms of each chunk
+]
+
+# Words and identifiers such as BRCA1, IL-6, COVID-19 or NCT01234567
+TOKEN_PATTERN = re.compile(r"\w+(?:[-.]\w+)*")
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have if in into is it its of on "
+    "or that the their there these this to was were which with".split()
+)
+
+
+def lexical_file(index_dir: Path, name: str) -> Path:
+    return Path(index_dir) / f"bm25_{name}.npy"
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased words; hyphenated or dotted terms also yield their parts"""
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(text.lower()):
+        token = match.group()
+        if token in STOPWORDS:
+            continue
+        tokens.append(token)
+        if "-" in token or "." in token:
+            tokens.extend(
+                part for part in re.split(r"[-.]", token) if part not in STOPWORDS
+            )
+    return tokens
+
+
+def remove_lexical_index(index_dir: Path):
+    for path in [Path(index_dir) / LEXICAL_INFO_FILE] + [
+        lexical_file(index_dir, name) for name in LEXICAL_ARRAYS
+    ]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def read_lexical_fingerprint(index_dir: Path) -> Optional[str]:
+    info_path = Path(index_dir) / LEXICAL_INFO_FILE
+    if not info_path.exists():
+        return None
+    with open(info_path, "r") as f:
+        return json.load(f).get("fingerprint")
+
+
+def build_lexical_index(vectorstore, index_dir: Path, k1: float = 1.2, b: float = 0.75):
+    """Writes a BM25 inverted index over the chunks of `vectorstore` to `index_dir`
+
+    Chunks are identified by their FAISS position, like in the SQLite
+    docstore. Skipped if the index already matches the build.
+    """
+    index_dir = Path(index_dir)
+    fingerprint = manifest_fingerprint(index_dir)
+    if read_lexical_fingerprint(index_dir) == fingerprint:
+        return
+
+    postings = defaultdict(lambda: (array("i"), array("H")))
+    doc_lengths = np.zeros(vectorstore.index.ntotal, dtype=np.int32)
+    for pos in range(vectorstore.index.ntotal):
+        doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[pos])
+        tokens = tokenize(doc.page_content)
+        doc_lengths[pos] = len(tokens)
+        for term, tf in Counter(tokens).items():
+            docs, tfs = postings[term]
+            docs.append(pos)
+            tfs.append(min(tf, 65535))
+
+    terms = sorted(postings)
+    encoded = [term.encode("utf-8") for term in terms]
+    term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    term_offsets[1:] = np.cumsum([len(term) for term in encoded])
+    postings_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    postings_offsets[1:] = np.cumsum([len(postings[term][0]) for term in terms])
+    arrays = {
+        "terms": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+        "term_offsets": term_offsets,
+        "postings_offsets": postings_offsets,
+        "postings_docs": np.concatenate(
+            [np.frombuffer(postings[term][0], dtype=np.int32) for term in terms]
+            or [np.zeros(0, dtype=np.int32)]
+        ),
+        "postings_tfs": np.concatenate(
+            [np.frombuffer(postings[term][1], dtype=np.uint16) for term in terms]
+            or [np.zeros(0, dtype=np.uint16)]
+        ),
+        "doc_lengths": doc_lengths,
+    }
+    for name in LEXICAL_ARRAYS:
+        tmp_path = lexical_file(index_dir, name + ".tmp")
+        np.save(tmp_path, arrays[name])
+        os.replace(tmp_path, lexical_file(index_dir, name))
+
+    # The info file is written last and marks the index as complete
+    info = {
+        "fingerprint": fingerprint,
+        "num_docs": int(len(doc_lengths)),
+        "num_terms": len(terms),
+        "avg_doc_length": float(doc_lengths.mean()) if len(doc_lengths) else 0.0,
+        "k1": k1,
+        "b": b,
+    }
+    tmp_path = index_dir / (LEXICAL_INFO_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(info, f, indent=2)
+    os.replace(tmp_path, index_dir / LEXICAL_INFO_FILE)
+    logging.info(
+        f"Wrote a BM25 index of {len(terms)} terms over {len(doc_lengths)} chunks"
+    )
+
+
+class LexicalIndex:
+    """BM25 search over the memory-mapped inverted index written at build time
+
+    Only the vocabulary entries and postings a query touches are read, so
+    the index costs next to no heap in the API process.
+    """
+
+    def __init__(self, index_dir: Path):
+        index_dir = Path(index_dir)
+        with open(index_dir / LEXICAL_INFO_FILE, "r") as f:
+            info = json.load(f)
+        self.num_docs = info["num_docs"]
+        self.avg_doc_length = info["avg_doc_length"] or 1.0
+        self.k1 = info["k1"]
+        self.b = info["b"]
+        for name in LEXICAL_ARRAYS:
+            setattr(self, name, np.load(lexical_file(index_dir, name), mmap_mode="r"))
+
+    def _term(self, i: int) -> bytes:
+        return self.terms[self.term_offsets[i] : self.term_offsets[i + 1]].tobytes()
+
+    def _postings(self, term: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        encoded = term.encode("utf-8")
+        num_terms = len(self.term_offsets) - 1
+        i = bisect_left(range(num_terms), encoded, key=self._term)
+        if i == num_terms or self._term(i) != encoded:
+            return None
+        start, end = self.postings_offsets[i], self.postings_offsets[i + 1]
+        return self.postings_docs[start:end], self.postings_tfs[start:end]
+
+    def search(self, query: str, k: int, id_filter=None) -> List[Tuple[int, float]]:
+        """(FAISS position, BM25 score) of the `k` best chunks for `query`
+
+        With `id_filter`, only chunks it allows are returned.
+        """
+        all_docs, all_scores = [], []
+        for term, query_tf in Counter(tokenize(query)).items():
+            postings = self._postings(term)
+            if postings is None:
+                continue
+            docs, tfs = np.asarray(postings[0]), np.asarray(postings[1], np.float32)
+            idf = math.log(1 + (self.num_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            lengths = np.asarray(self.doc_lengths[docs], dtype=np.float32)
+            norm = self.k1 * (1 - self.b + self.b * lengths / self.avg_doc_length)
+            all_docs.append(docs)
+            all_scores.append(query_tf * idf * tfs * (self.k1 + 1) / (tfs + norm))
+        if not all_docs:
+            return []
+        docs, inverse = np.unique(np.concatenate(all_docs), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(all_scores))
+        if id_filter is not None:
+            allowed = id_filter.contains(docs)
+            docs, scores = docs[allowed], scores[allowed]
+        top = np.argsort(-scores, kind="stable")[:k]
+        return [(int(docs[i]), float(scores[i])) for i in top]
+
+
+def open_lexical_index(index_dir: Path) -> Optional[LexicalIndex]:
+    """The BM25 index of `index_dir`, or None if it is missing or out of date"""
+    fingerprint = read_lexical_fingerprint(index_dir)
+    if fingerprint is None:
+        return None
+    if fingerprint != manifest_fingerprint(index_dir):
+        logging.warning(f"The BM25 index in {index_dir} is out of date, not using it")
+        return None
+    return LexicalIndex(index_dir)
@@ -0,0 +1,196 @@
+import os
+import json
+import logging
+import threading
+import numpy as np
+import faiss
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+from .index_manifest import manifest_fingerprint
+
+METADATA_INFO_FILE = "metadata.json"
+# Columns of chunk metadata, each memory-mapped by the API: publication years
+# (0 when unknown) and codes into the vocabularies of metadata.json (-1 when
+# unknown)
+METADATA_COLUMNS = {
+    "year": np.int16,
+    "journal": np.int32,
+    "article_type": np.int32,
+    "section": np.int32,
+}
+# Query filter fields matched against the categorical columns
+FILTER_COLUMNS = {
+    "journals": "journal",
+    "article_types": "article_type",
+    "sections": "section",
+}
+# Distinct filters whose bitsets are kept for reuse
+FILTER_CACHE_SIZE = 64
+
+
+class FilterError(ValueError):
+    """Raised for filters the served index cannot apply"""
+
+
+def metadata_file(index_dir: Path, name: str) -> Path:
+    return Path(index_dir) / f"meta_{name}.npy"
+
+
+def read_metadata_fingerprint(index_dir: Path) -> Optional[str]:
+    info_path = Path(index_dir) / METADATA_INFO_FILE
+    if not info_path.exists():
+        return None
+    with open(info_path, "r") as f:
+        return json.load(f).get("fingerprint")
+
+
+def build_metadata_index(vectorstore, index_dir: Path):
+    """Writes the metadata columns of the chunks of `vectorstore` to `index_dir`
+
+    Rows are FAISS positions, like in the SQLite docstore and BM25 index.
+    Skipped if the columns already match the build.
+    """
+    index_dir = Path(index_dir)
+    fingerprint = manifest_fingerprint(index_dir)
+    if read_metadata_fingerprint(index_dir) == fingerprint:
+        return
+
+    num_docs = vectorstore.index.ntotal
+    columns = {
+        name: np.zeros(num_docs, dtype=dtype)
+        for name, dtype in METADATA_COLUMNS.items()
+    }
+    codes = {name: {} for name in FILTER_COLUMNS.values()}
+    for pos in range(num_docs):
+        doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[pos])
+        columns["year"][pos] = doc.metadata.get("year") or 0
+        for name, values in codes.items():
+            value = doc.metadata.get(name)
+            columns[name][pos] = values.setdefault(value, len(values)) if value else -1
+
+    for name in METADATA_COLUMNS:
+        # np.save appends .npy to names without it, so write through a handle
+        tmp_path = index_dir / (metadata_file(index_dir, name).name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, columns[name])
+        os.replace(tmp_path, metadata_file(index_dir, name))
+
+    # The info file is written last and marks the columns as complete
+    info = {
+        "fingerprint": fingerprint,
+        "num_docs": num_docs,
+        "vocabularies": {name: list(values) for name, values in codes.items()},
+    }
+    tmp_path = index_dir / (METADATA_INFO_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(info, f)
+    os.replace(tmp_path, index_dir / METADATA_INFO_FILE)
+    logging.info(
+        f"Wrote metadata columns for {num_docs} chunks "
+        f"({len(codes['journal'])} journals)"
+    )
+
+
+class IdFilter:
+    """The FAISS positions a metadata filter allows, as a bitset
+
+    `selector` restricts a FAISS search to these positions, so filtered
+    searches visit no more vectors than unfiltered ones.
+    """
+
+    def __init__(self, mask: np.ndarray):
+        self.bitmap = np.packbits(mask, bitorder="little")
+        self.count = int(np.count_nonzero(mask))
+        # The selector reads the bitmap in place; this object keeps it alive
+        self.selector = faiss.IDSelectorBitmap(
+            len(self.bitmap), faiss.swig_ptr(self.bitmap)
+        )
+
+    def contains(self, positions) -> np.ndarray:
+        positions = np.asarray(positions, dtype=np.int64)
+        return ((self.bitmap[positions >> 3] >> (positions & 7)) & 1).astype(bool)
+
+    def positions(self) -> np.ndarray:
+        return np.flatnonzero(np.unpackbits(self.bitmap, bitorder="little"))
+
+
+class MetadataIndex:
+    """Turns query filters into bitsets over the memory-mapped metadata columns
+
+    Filters take publication years (`year_min`, `year_max`, inclusive) and
+    lists of accepted `journals`, `article_types` and `sections`, matched
+    case-insensitively. Bitsets of recently used filters are cached.
+    """
+
+    def __init__(self, index_dir: Path):
+        index_dir = Path(index_dir)
+        with open(index_dir / METADATA_INFO_FILE, "r") as f:
+            info = json.load(f)
+        self.num_docs = info["num_docs"]
+        self.codes = {}
+        for name, vocabulary in info["vocabularies"].items():
+            self.codes[name] = {}
+            for code, value in enumerate(vocabulary):
+                self.codes[name].setdefault(value.casefold(), []).append(code)
+        for name in METADATA_COLUMNS:
+            setattr(self, name, np.load(metadata_file(index_dir, name), mmap_mode="r"))
+        self._filters = OrderedDict()
+        self._lock = threading.Lock()
+
+    def id_filter(self, filters: dict) -> Optional[IdFilter]:
+        """Bitset of the chunks matching `filters`, or None if nothing is filtered"""
+        filters = {key: value for key, value in filters.items() if value is not None}
+        unknown = set(filters) - {"year_min", "year_max", *FILTER_COLUMNS}
+        if unknown:
+            raise FilterError(f"Unknown filters: {', '.join(sorted(unknown))}")
+        if not filters:
+            return None
+        key = json.dumps(
+            {
+                name: sorted({v.casefold() for v in value})
+                if name in FILTER_COLUMNS
+                else value
+                for name, value in filters.items()
+            },
+            sort_keys=True,
+        )
+        with self._lock:
+            if key in self._filters:
+                self._filters.move_to_end(key)
+                return self._filters[key]
+
+        mask = np.ones(self.num_docs, dtype=bool)
+        if "year_min" in filters or "year_max" in filters:
+            years = np.asarray(self.year)
+            mask &= years > 0
+            if "year_min" in filters:
+                mask &= years >= filters["year_min"]
+            if "year_max" in filters:
+                mask &= years <= filters["year_max"]
+        for name, column in FILTER_COLUMNS.items():
+            if name in filters:
+                codes = [
+                    code
+                    for value in filters[name]
+                    for code in self.codes[column].get(value.casefold(), [])
+                ]
+                mask &= np.isin(getattr(self, column), codes)
+
+        id_filter = IdFilter(mask)
+        with self._lock:
+            self._filters[key] = id_filter
+            while len(self._filters) > FILTER_CACHE_SIZE:
+                self._filters.popitem(last=False)
+        return id_filter
+
+
+def open_metadata_index(index_dir: Path) -> Optional[MetadataIndex]:
+    """The metadata columns of `index_dir`, or None if missing or out of date"""
+    fingerprint = read_metadata_fingerprint(index_dir)
+    if fingerprint is None:
+        return None
+    if fingerprint != manifest_fingerprint(index_dir):
+        logging.warning(f"The metadata columns in {index_dir} are out of date")
+        return None
+    return MetadataIndex(index_dir)
@@ -1,8 +1,10 @@
 import time
 import torch
 import logging
+import threading
 from .utils import format_time
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from transformers.utils.quantization_config import BitsAndBytesConfig
 from transformers import (
     AutoTokenizer,
@@ -10,17 +12,56 @@ from transformers import (
 )
 from transformers.pipelines import pipeline
 from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
+from .ann_index import RescoringFAISS, read_knowledge_base
+from .query_processor import ContextPacker, CrossEncoderReranker
+from .generation_batcher import GenerationBatcher
+from .prefix_cache import PrefixCachedGenerator, prompt_prefix
+from .lexical_index import open_lexical_index
+from .metadata_index import open_metadata_index
+from .index_versions import (
+    VersionedKnowledgeBase,
+    current_version_dir,
+    read_version_info,
+)
 from config import (
     READER_MODEL,
     EMBEDDING_MODEL,
-    # RERANKER_MODEL,
+    RERANKER_MODEL,
+    RERANKER_DEVICE,
+    RERANK_CANDIDATES,
+    RERANK_BATCH_SIZE,
+    RERANK_BUDGET,
     FAISS_INDEX,
+    FAISS_NPROBE,
+    FAISS_EF_SEARCH,
+    FAISS_RESCORE_FACTOR,
+    INDEX_WATCH_INTERVAL,
+    LEXICAL_SEARCH,
+    GENERATION_BATCH_SIZE,
+    GENERATION_BATCH_WAIT,
+    GENERATION_BATCH_TOKENS,
+    PREFIX_KV_CACHE,
     PROMPT_TEMPLATE,
+    PROMPT_TOKEN_BUDGET,
+    CONTEXT_DUPLICATE_THRESHOLD,
 )
 
 log = logging.getLogger(__name__)
 
+# Components in the order their load is reported
+COMPONENTS = ["embedding_model", "knowledge_base", "tokenizer", "reader_llm"]
+RETRIEVAL_COMPONENTS = ["embedding_model", "knowledge_base"]
+if RERANKER_MODEL:
+    COMPONENTS.append("reranker")
+    RETRIEVAL_COMPONENTS.append("reranker")
+MAX_NEW_TOKENS = 500
+GENERATION_KWARGS = {
+    "do_sample": True,
+    "temperature": 0.2,
+    "repetition_penalty": 1.1,
+    "max_new_tokens": MAX_NEW_TOKENS,
+}
+
 
 class ModelLoader:
     def __init__(self):
@@ -34,58 +75,303 @@ class ModelLoader:
             bnb_4bit_compute_dtype=torch.bfloat16,
         )
 
-    def load_models(self):
+        self.embedding_model = None
+        # Swapped by reload_knowledge_base while queries keep running
+        self.index_versions = VersionedKnowledgeBase()
+        self.index_path = FAISS_INDEX
+        self.reload_status = {"state": "idle", "seconds": None, "error": None}
+        self.tokenizer = None
+        self.rag_prompt_template = None
+        self.context_packer = None
+        self.reader_llm = None
+        self.generation_batcher = None
+        self.prefix_generator = None
+        self.reranker = None
+        self.status = {
+            name: {"state": "pending", "seconds": None, "error": None}
+            for name in COMPONENTS
+        }
+        self._lock = threading.Lock()
+        self._executor = None
+        self._done = threading.Event()
+
+    def _run(self, name, load):
+        """Loads one component, recording its state and load time"""
+        with self._lock:
+            self.status[name]["state"] = "loading"
+        start_time = time.time()
         try:
-            init_start_time = time.time()
-
-            log.info("Initializing embedding model...")
-            self.embedding_model = HuggingFaceEmbeddings(
-                model_name=EMBEDDING_MODEL,
-                multi_process=False,
-                model_kwargs={"device": self.device},
-                encode_kwargs={"normalize_embeddings": True},
-            )
+            result = load()
+        except Exception as e:
+            log.error(f"Error while loading {name}: {e}")
+            with self._lock:
+                self.status[name].update(state="failed", error=str(e))
+            raise
+        elapsed = time.time() - start_time
+        with self._lock:
+            self.status[name].update(state="ready", seconds=round(elapsed, 2))
+        log.info(f"{name} ready in {format_time(int(elapsed))}")
+        return result
 
-            self.knowledge_base = FAISS.load_local(
-                FAISS_INDEX,
-                embeddings=self.embedding_model,
-                allow_dangerous_deserialization=True,
-            )
+    def _load_embedding_model(self):
+        self.embedding_model = HuggingFaceEmbeddings(
+            model_name=EMBEDDING_MODEL,
+            multi_process=False,
+            model_kwargs={"device": self.device},
+            encode_kwargs={"normalize_embeddings": True},
+        )
 
-            self.model = AutoModelForCausalLM.from_pretrained(
-                READER_MODEL, quantization_config=self.bnb_config
-            )
-            self.tokenizer = AutoTokenizer.from_pretrained(READER_MODEL)
-            self.rag_prompt_template = self.tokenizer.apply_chat_template(
-                PROMPT_TEMPLATE, tokenize=False, add_generation_prompt=True
+    def _read_index_version(self, index_path):
+        """Reads the current published version of `index_path` (or the path itself)"""
+        version_dir = current_version_dir(index_path)
+        info = dict(read_version_info(version_dir), path=str(version_dir))
+        index_files = read_knowledge_base(
+            version_dir, nprobe=FAISS_NPROBE, ef_search=FAISS_EF_SEARCH
+        )
+        lexical_index = open_lexical_index(version_dir) if LEXICAL_SEARCH else None
+        metadata_index = open_metadata_index(version_dir)
+        return info, (*index_files, lexical_index, metadata_index)
+
+    def _make_knowledge_base(self, index_files):
+        (
+            index,
+            docstore,
+            index_to_docstore_id,
+            full_vectors,
+            lexical_index,
+            metadata_index,
+        ) = index_files
+        return RescoringFAISS(
+            self.embedding_model,
+            index,
+            docstore,
+            index_to_docstore_id,
+            full_vectors=full_vectors,
+            rescore_factor=FAISS_RESCORE_FACTOR,
+            lexical_index=lexical_index,
+            metadata_index=metadata_index,
+        )
+
+    def _load_knowledge_base(self, embedding_future):
+        # Read the index files while the embedding model loads, then attach it
+        info, index_files = self._read_index_version(self.index_path)
+        embedding_future.result()
+        self.index_versions.swap(info, self._make_knowledge_base(index_files))
+
+    def reload_knowledge_base(self, index_path=None) -> bool:
+        """Loads the current version of `index_path` in the background and swaps it in
+
+        Defaults to the index being served. Returns False if the initial load
+        or another reload is still running.
+        """
+        with self._lock:
+            if (
+                self.status["knowledge_base"]["state"] != "ready"
+                or self.reload_status["state"] == "loading"
+            ):
+                return False
+            self.reload_status = {"state": "loading", "seconds": None, "error": None}
+        threading.Thread(
+            target=self._reload,
+            args=(index_path or self.index_path,),
+            name="index-reload",
+            daemon=True,
+        ).start()
+        return True
+
+    def _reload(self, index_path):
+        start_time = time.time()
+        try:
+            info, index_files = self._read_index_version(index_path)
+            self.index_versions.swap(info, self._make_knowledge_base(index_files))
+            self.index_path = index_path
+            state, error = "ready", None
+        except Exception as e:
+            log.error(f"Error while reloading the index from {index_path}: {e}")
+            state, error = "failed", str(e)
+        with self._lock:
+            self.reload_status = {
+                "state": state,
+                "seconds": round(time.time() - start_time, 2),
+                "error": error,
+            }
+
+    def _watch_index(self, interval):
+        """Reloads the index whenever a new version of it is published"""
+        while True:
+            time.sleep(interval)
+            current = self.index_versions.status()["current"]
+            if current is None:
+                continue
+            try:
+                published = str(current_version_dir(self.index_path))
+            except OSError:
+                continue
+            if published != current["path"] and self.reload_knowledge_base():
+                log.info(f"New index version published at {published}, reloading")
+
+    def _load_reranker(self):
+        self.reranker = CrossEncoderReranker(
+            RERANKER_MODEL,
+            device=RERANKER_DEVICE,
+            candidates=RERANK_CANDIDATES,
+            batch_size=RERANK_BATCH_SIZE,
+            budget=RERANK_BUDGET,
+        )
+
+    def _load_tokenizer(self):
+        self.tokenizer = AutoTokenizer.from_pretrained(READER_MODEL)
+        # Batched generation pads prompts on the left, next to the new tokens
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.rag_prompt_template = self.tokenizer.apply_chat_template(
+            PROMPT_TEMPLATE, tokenize=False, add_generation_prompt=True
+        )
+        if PROMPT_TOKEN_BUDGET:
+            self.context_packer = ContextPacker(
+                self.tokenizer,
+                PROMPT_TOKEN_BUDGET,
+                duplicate_threshold=CONTEXT_DUPLICATE_THRESHOLD,
             )
 
-            self.reader_llm = pipeline(
+    def _load_reader_llm(self, tokenizer_future):
+        self.model = AutoModelForCausalLM.from_pretrained(
+            READER_MODEL, quantization_config=self.bnb_config
+        )
+        tokenizer_future.result()
+        if PREFIX_KV_CACHE:
+            # Prompts only prefill what follows the constant prefix
+            llm = self.prefix_generator = PrefixCachedGenerator(
+                self.model,
+                self.tokenizer,
+                prompt_prefix(self.rag_prompt_template),
+                GENERATION_KWARGS,
+            )
+        else:
+            llm = pipeline(
                 model=self.model,
                 tokenizer=self.tokenizer,
                 task="text-generation",
-                do_sample=True,
-                temperature=0.2,
-                repetition_penalty=1.1,
                 return_full_text=False,
-                max_new_tokens=500,
+                **GENERATION_KWARGS,
             )
+        if GENERATION_BATCH_SIZE > 1:
+            # Concurrent queries share forward passes
+            llm = self.generation_batcher = GenerationBatcher(
+                llm,
+                self.tokenizer,
+                max_batch_size=GENERATION_BATCH_SIZE,
+                max_wait=GENERATION_BATCH_WAIT,
+                max_batch_tokens=GENERATION_BATCH_TOKENS,
+                max_new_tokens=MAX_NEW_TOKENS,
+            )
+        self.reader_llm = llm
 
-            # self.reranker = RERANKER_MODEL
+    def start_loading(self, components=COMPONENTS, watch_index: bool = True):
+        """Loads `components`, and those they depend on, in background threads"""
+        init_start_time = time.time()
+        needed = set(components)
+        if "knowledge_base" in needed:
+            needed.add("embedding_model")
+        if "reader_llm" in needed:
+            needed.add("tokenizer")
+        for name in COMPONENTS:
+            if name not in needed:
+                self.status[name]["state"] = "skipped"
 
-            init_elapsed_time = format_time(int(time.time() - init_start_time))
-            log.info(f"Models initialized in {init_elapsed_time}")
-
-            return ModelDependencies(
-                self.embedding_model,
-                self.knowledge_base,
-                self.reader_llm,
-                self.rag_prompt_template,
-                # self.reranker,
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(needed), thread_name_prefix="model-loader"
+        )
+        futures = {}
+        loads = {
+            "embedding_model": self._load_embedding_model,
+            "tokenizer": self._load_tokenizer,
+            "knowledge_base": lambda: self._load_knowledge_base(
+                futures["embedding_model"]
+            ),
+            "reader_llm": lambda: self._load_reader_llm(futures["tokenizer"]),
+        }
+        # Dependencies are submitted first, so their futures exist when needed
+        for name in ["embedding_model", "tokenizer", "knowledge_base", "reader_llm"]:
+            if name in needed:
+                futures[name] = self._executor.submit(self._run, name, loads[name])
+        if "reranker" in needed:
+            futures["reranker"] = self._executor.submit(
+                self._run, "reranker", self._load_reranker
             )
-        except Exception as e:
-            log.error(f"Error during models initialization: {e}")
-            raise e
+
+        def finish():
+            for future in futures.values():
+                future.exception()
+            self._executor.shutdown()
+            init_elapsed_time = format_time(int(time.time() - init_start_time))
+            log.info(f"Model loading finished in {init_elapsed_time}")
+            self._done.set()
+
+        threading.Thread(target=finish, name="model-loader-done", daemon=True).start()
+        if watch_index and INDEX_WATCH_INTERVAL and "knowledge_base" in needed:
+            threading.Thread(
+                target=self._watch_index,
+                args=(INDEX_WATCH_INTERVAL,),
+                name="index-watcher",
+                daemon=True,
+            ).start()
+
+    def is_ready(self, components=COMPONENTS) -> bool:
+        with self._lock:
+            return all(self.status[name]["state"] == "ready" for name in components)
+
+    def readiness(self) -> dict:
+        with self._lock:
+            components = {name: dict(status) for name, status in self.status.items()}
+        return {
+            "ready": all(c["state"] == "ready" for c in components.values()),
+            "retrieval_ready": all(
+                components[name]["state"] == "ready" for name in RETRIEVAL_COMPONENTS
+            ),
+            "components": components,
+        }
+
+    def dependencies(self):
+        """Currently loaded components; those still loading are None"""
+        return ModelDependencies(
+            self.embedding_model,
+            self.index_versions.knowledge_base,
+            self.reader_llm,
+            self.rag_prompt_template,
+            self.reranker,
+            self.context_packer,
+        )
+
+    def answer_settings(self, retrieval_only: bool = False) -> dict:
+        """Models and settings an answer depends on, besides the index version"""
+        if retrieval_only:
+            return {
+                "retrieval_only": True,
+                "embedding_model": EMBEDDING_MODEL,
+                "reranker": RERANKER_MODEL,
+                "lexical_search": LEXICAL_SEARCH,
+            }
+        return {
+            "embedding_model": EMBEDDING_MODEL,
+            "reranker": RERANKER_MODEL,
+            "lexical_search": LEXICAL_SEARCH,
+            "reader_model": READER_MODEL,
+            "generation": GENERATION_KWARGS,
+            "prompt_template": self.rag_prompt_template,
+            "prompt_token_budget": PROMPT_TOKEN_BUDGET,
+            "context_duplicate_threshold": CONTEXT_DUPLICATE_THRESHOLD,
+        }
+
+    def load_models(self, components=COMPONENTS, watch_index: bool = True):
+        """Loads `components` and blocks until they are ready"""
+        self.start_loading(components, watch_index)
+        self._done.wait()
+        failed = [n for n, s in self.status.items() if s["state"] == "failed"]
+        if failed:
+            raise RuntimeError(f"Failed to load {', '.join(failed)}")
+        return self.dependencies()
 
 
 ModelDependencies = namedtuple(
@@ -95,6 +381,7 @@ ModelDependencies = namedtuple(
         "knowledge_base",
         "reader_llm",
         "rag_prompt_template",
-        # "reranker",
+        "reranker",
+        "context_packer",
     ],
 )
@@ -1,72 +1,607 @@
 import time
+import hashlib
 import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, List, Tuple
 from langchain_community.vectorstores import FAISS
+from transformers import TextIteratorStreamer
 from transformers.pipelines.base import Pipeline
-# Commented out reranker-related code to avoid issues with colbert
-# from ragatouille import RAGPretrainedModel
+from .metadata_index import FilterError
 from .utils import format_time
 
 log = logging.getLogger(__name__)
 
+# Runs BM25 searches while the FAISS search runs in the calling thread
+_lexical_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="lexical-search")
+# Rank offset of reciprocal rank fusion; larger values flatten the top ranks
+RRF_K = 60
+# Chunks retrieved per context passage with a ContextPacker, so chunks it
+# merges or drops can be replaced
+CONTEXT_CANDIDATE_FACTOR = 2
+
+
+class Reranker(ABC):
+    """Re-orders retrieved chunks by their relevance to the question
+
+    Implementations score (question, chunk text) pairs; higher is more
+    relevant. `candidates` is how many hits retrieval should fetch for it.
+    """
+
+    candidates = 30
+
+    @abstractmethod
+    def score(self, question: str, texts: List[str]) -> List[float]:
+        """Relevance of each of `texts` to `question`"""
+
+    def rerank(self, question: str, docs_with_scores, k: int):
+        """The `k` most relevant (doc, retrieval score) pairs"""
+        scores = self.score(question, [doc.page_content for doc, _ in docs_with_scores])
+        order = sorted(range(len(scores)), key=lambda i: -scores[i])
+        return [docs_with_scores[i] for i in order[:k]]
+
+
+class CrossEncoderReranker(Reranker):
+    """Cross-encoder reranker for the CPU, with a score cache and a time budget
+
+    Pairs are scored in batches of `batch_size`, best-ranked hits first, and
+    their scores cached by (question, chunk). With `budget` seconds per
+    query, the number of candidates is cut to what fits the budget at the
+    measured scoring speed, and scoring stops once the budget is spent;
+    hits left unscored keep their retrieval order after the reranked ones.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        device: str = "cpu",
+        candidates: int = 30,
+        batch_size: int = 16,
+        budget: Optional[float] = None,
+        cache_size: int = 100000,
+    ):
+        from sentence_transformers import CrossEncoder
+
+        self.model = CrossEncoder(model_name, device=device)
+        self.candidates = candidates
+        self.batch_size = batch_size
+        self.budget = budget
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # Moving average of the seconds it takes to score one pair
+        self._seconds_per_pair = None
+
+    def _cache_key(self, question: str, text: str) -> bytes:
+        return hashlib.sha1(f"{question}\0{text}".encode("utf-8")).digest()
+
+    def score(self, question: str, texts: List[str]) -> List[Optional[float]]:
+        """Scores of `texts`, or None for those the time budget left unscored"""
+        start_time = time.time()
+        keys = [self._cache_key(question, text) for text in texts]
+        with self._lock:
+            scores = [self._cache.get(key) for key in keys]
+            for key, score in zip(keys, scores):
+                if score is not None:
+                    self._cache.move_to_end(key)
+
+        pending = [i for i, score in enumerate(scores) if score is None]
+        for b in range(0, len(pending), self.batch_size):
+            if b > 0 and self.budget and time.time() - start_time > self.budget:
+                log.info(f"Rerank budget spent, {len(pending) - b} hits left unscored")
+                break
+            batch = pending[b : b + self.batch_size]
+            batch_start_time = time.time()
+            batch_scores = self.model.predict([(question, texts[i]) for i in batch])
+            seconds_per_pair = (time.time() - batch_start_time) / len(batch)
+            with self._lock:
+                self._seconds_per_pair = (
+                    seconds_per_pair
+                    if self._seconds_per_pair is None
+                    else 0.8 * self._seconds_per_pair + 0.2 * seconds_per_pair
+                )
+                for i, score in zip(batch, batch_scores):
+                    scores[i] = float(score)
+                    self._cache[keys[i]] = scores[i]
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return scores
+
+    def rerank(self, question: str, docs_with_scores, k: int):
+        limit = len(docs_with_scores)
+        if self.budget and self._seconds_per_pair:
+            limit = max(k, int(self.budget / self._seconds_per_pair))
+        candidates = docs_with_scores[:limit]
+        scores = self.score(question, [doc.page_content for doc, _ in candidates])
+        scored = sorted(
+            (i for i, score in enumerate(scores) if score is not None),
+            key=lambda i: -scores[i],
+        )
+        unscored = [i for i, score in enumerate(scores) if score is None]
+        return [candidates[i] for i in (scored + unscored)[:k]]
+
+
+class ContextPacker:
+    """Packs retrieved chunks into the reader prompt within a token budget
+
+    Chunks are taken in ranking order and counted with the reader's
+    tokenizer. A chunk that overlaps or directly follows a passage of the
+    same source (by `start_index`) is merged into it, and one sharing
+    `duplicate_threshold` of its word 5-grams with a passage is dropped.
+    Passages are added while the whole prompt stays within
+    `prompt_token_budget` tokens; the first one that does not fit is cut to
+    the room left, if that is at least `min_passage_tokens`.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        prompt_token_budget: int,
+        duplicate_threshold: float = 0.8,
+        min_passage_tokens: int = 64,
+        shingle_size: int = 5,
+    ):
+        self.tokenizer = tokenizer
+        self.prompt_token_budget = prompt_token_budget
+        self.duplicate_threshold = duplicate_threshold
+        self.min_passage_tokens = min_passage_tokens
+        self.shingle_size = shingle_size
+        # Tokens build_prompt adds around each passage
+        self.passage_overhead = count_tokens(tokenizer, "Document 10:::\n\n")
+
+    def _shingles(self, text: str) -> set:
+        words = text.lower().split()
+        return {
+            " ".join(words[i : i + self.shingle_size])
+            for i in range(max(1, len(words) - self.shingle_size + 1))
+        }
+
+    def _is_duplicate(self, shingles: set, passages) -> bool:
+        for passage in passages:
+            common = len(shingles & passage["shingles"])
+            smaller = min(len(shingles), len(passage["shingles"])) or 1
+            if common / smaller >= self.duplicate_threshold:
+                return True
+        return False
+
+    def _merge(self, passage: dict, doc) -> Optional[str]:
+        """Text of `passage` extended with `doc`, or None if they are not contiguous"""
+        start = doc.metadata.get("start_index")
+        if (
+            start is None
+            or passage["start"] is None
+            or doc.metadata.get("source", "unknown") != passage["source"]
+        ):
+            return None
+        pieces = sorted(
+            [(passage["start"], passage["text"]), (start, doc.page_content)],
+            key=lambda piece: (piece[0], -len(piece[1])),
+        )
+        (first_start, first_text), (second_start, second_text) = pieces
+        first_end = first_start + len(first_text)
+        if second_start > first_end + 1:
+            return None
+        if second_start == first_end + 1:
+            # Chunks never span sections, so a gap in one is a word boundary
+            same_section = doc.metadata.get("section") == passage["section"]
+            return first_text + (" " if same_section else "\n") + second_text
+        return first_text + second_text[first_end - second_start :]
+
+    def _truncate(self, text: str, num_tokens: int) -> str:
+        offsets = self.tokenizer(
+            text, add_special_tokens=False, return_offsets_mapping=True
+        )["offset_mapping"]
+        return text[: offsets[num_tokens - 1][1]] if num_tokens < len(offsets) else text
+
+    def pack(self, question: str, docs_with_scores, prompt_template: str, max_passages):
+        """(prompt, references, prompt tokens) from the ranked (doc, score) pairs"""
+        room = self.prompt_token_budget - count_tokens(
+            self.tokenizer, build_prompt(question, [], prompt_template)
+        )
+        passages, used = [], 0
+        merged = dropped = 0
+        for doc, score in docs_with_scores:
+            for passage in passages:
+                text = self._merge(passage, doc)
+                if text is None:
+                    continue
+                num_tokens = count_tokens(self.tokenizer, text) + self.passage_overhead
+                if used - passage["tokens"] + num_tokens <= room:
+                    used += num_tokens - passage["tokens"]
+                    passage.update(
+                        text=text,
+                        start=min(passage["start"], doc.metadata["start_index"]),
+                        tokens=num_tokens,
+                        shingles=self._shingles(text),
+                    )
+                    merged += 1
+                break
+            else:
+                shingles = self._shingles(doc.page_content)
+                if self._is_duplicate(shingles, passages):
+                    dropped += 1
+                    continue
+                if len(passages) >= max_passages:
+                    continue
+                text = doc.page_content
+                num_tokens = count_tokens(self.tokenizer, text) + self.passage_overhead
+                if used + num_tokens > room:
+                    left = room - used - self.passage_overhead
+                    if left < self.min_passage_tokens:
+                        break
+                    text = self._truncate(text, left)
+                    num_tokens = left + self.passage_overhead
+                passages.append(
+                    {
+                        "text": text,
+                        "source": doc.metadata.get("source", "unknown"),
+                        "start": doc.metadata.get("start_index"),
+                        "section": doc.metadata.get("section"),
+                        "score": float(score),
+                        "tokens": num_tokens,
+                        "shingles": shingles,
+                    }
+                )
+                used += num_tokens
+                if used >= room:
+                    break
+
+        references = [
+            (passage["text"], passage["source"], passage["score"])
+            for passage in passages
+        ]
+        prompt = build_prompt(question, references, prompt_template)
+        prompt_tokens = count_tokens(self.tokenizer, prompt)
+        log.info(
+            f"Packed {len(docs_with_scores)} chunks into {len(passages)} passages "
+            f"({merged} merged, {dropped} duplicates dropped), "
+            f"{prompt_tokens} prompt tokens"
+        )
+        return prompt, references, prompt_tokens
+
+
+def retrieve_documents(
+    question: str,
+    knowledge_index: FAISS,
+    num_retrieved_docs: Optional[int] = None,
+    num_docs_final: int = 5,
+    reranker: Optional[Reranker] = None,
+    filters: Optional[dict] = None,
+) -> List[Tuple[str, str, float]]:
+    """Retrieves the (content, source, score) of the chunks most relevant to a question
+
+    See retrieve_chunks.
+    """
+    return _references(
+        retrieve_chunks(
+            question,
+            knowledge_index,
+            num_retrieved_docs,
+            num_docs_final,
+            reranker,
+            filters,
+        )
+    )
+
+
+def retrieve_chunks(
+    question: str,
+    knowledge_index: FAISS,
+    num_retrieved_docs: Optional[int] = None,
+    num_docs_final: int = 5,
+    reranker: Optional[Reranker] = None,
+    filters: Optional[dict] = None,
+):
+    """Retrieves the (doc, score) of the chunks most relevant to a question
+
+    Without a reranker, only `num_docs_final` hits are fetched; with one,
+    `num_retrieved_docs` (default: the reranker's candidates) are fetched and
+    reranked. If the index has a BM25 `lexical_index`, it is searched in
+    parallel and both result lists are fused (see reciprocal_rank_fusion).
+    Scores are retrieval distances, or fused scores with BM25. `filters`
+    (see services.metadata_index) restrict both searches to matching chunks.
+    """
+    log.info("Retrieving documents...")
+    k = _num_candidates(num_retrieved_docs, num_docs_final, reranker)
+    search_kwargs = _filter_kwargs(knowledge_index, filters)
+    if search_kwargs is None:
+        return []
+    lexical_index = getattr(knowledge_index, "lexical_index", None)
+    if lexical_index is not None:
+        lexical_hits = _lexical_pool.submit(
+            lexical_index.search, question, k, **search_kwargs
+        )
+    docs_with_scores = knowledge_index.similarity_search_with_score(
+        query=question, k=k, **search_kwargs
+    )
+    if lexical_index is not None:
+        docs_with_scores = reciprocal_rank_fusion(
+            knowledge_index, docs_with_scores, lexical_hits.result(), k
+        )
+    return _select_chunks(question, docs_with_scores, num_docs_final, reranker)
+
+
+def retrieve_documents_batch(
+    questions: List[str],
+    knowledge_index: FAISS,
+    num_retrieved_docs: Optional[int] = None,
+    num_docs_final: int = 5,
+    reranker: Optional[Reranker] = None,
+    filters: Optional[dict] = None,
+) -> List[List[Tuple[str, str, float]]]:
+    """retrieve_documents for several questions, embedded and searched together"""
+    return [
+        _references(docs_with_scores)
+        for docs_with_scores in retrieve_chunks_batch(
+            questions,
+            knowledge_index,
+            num_retrieved_docs,
+            num_docs_final,
+            reranker,
+            filters,
+        )
+    ]
+
+
+def retrieve_chunks_batch(
+    questions: List[str],
+    knowledge_index: FAISS,
+    num_retrieved_docs: Optional[int] = None,
+    num_docs_final: int = 5,
+    reranker: Optional[Reranker] = None,
+    filters: Optional[dict] = None,
+):
+    """retrieve_chunks for several questions, embedded and searched together"""
+    log.info(f"Retrieving documents for {len(questions)} questions...")
+    k = _num_candidates(num_retrieved_docs, num_docs_final, reranker)
+    search_kwargs = _filter_kwargs(knowledge_index, filters)
+    if search_kwargs is None:
+        return [[] for _ in questions]
+    query_embeddings = knowledge_index.embedding_function.embed_documents(questions)
+    lexical_index = getattr(knowledge_index, "lexical_index", None)
+    if lexical_index is not None:
+        all_lexical_hits = [
+            _lexical_pool.submit(lexical_index.search, question, k, **search_kwargs)
+            for question in questions
+        ]
+    all_docs_with_scores = knowledge_index.similarity_search_with_score_by_vectors(
+        query_embeddings, k=k, **search_kwargs
+    )
+    if lexical_index is not None:
+        all_docs_with_scores = [
+            reciprocal_rank_fusion(knowledge_index, docs_with_scores, hits.result(), k)
+            for docs_with_scores, hits in zip(all_docs_with_scores, all_lexical_hits)
+        ]
+    return [
+        _select_chunks(question, docs_with_scores, num_docs_final, reranker)
+        for question, docs_with_scores in zip(questions, all_docs_with_scores)
+    ]
+
+
+def _filter_kwargs(knowledge_index: FAISS, filters: Optional[dict]):
+    """Search arguments applying `filters`, or None if no chunk matches them"""
+    if not filters:
+        return {}
+    metadata_index = getattr(knowledge_index, "metadata_index", None)
+    if metadata_index is None:
+        raise FilterError("The served index has no metadata columns to filter on")
+    id_filter = metadata_index.id_filter(filters)
+    if id_filter is None:
+        return {}
+    log.info(f"Filters match {id_filter.count} of {metadata_index.num_docs} chunks")
+    if id_filter.count == 0:
+        return None
+    return {"id_filter": id_filter}
+
+
+def reciprocal_rank_fusion(
+    knowledge_index: FAISS, docs_with_scores, lexical_hits, k: int
+):
+    """Merges FAISS (doc, distance) and BM25 (position, score) hits by rank
+
+    Each chunk scores the sum of 1 / (RRF_K + rank) over the lists it
+    appears in, so chunks found by both searches rise to the top. Returns
+    the `k` best (doc, fused score) pairs.
+    """
+    fused = {}
+    for rank, (doc, _) in enumerate(docs_with_scores):
+        fused[doc.id] = [doc, 1 / (RRF_K + rank + 1)]
+    for rank, (pos, _) in enumerate(lexical_hits):
+        chunk_id = knowledge_index.index_to_docstore_id[pos]
+        if chunk_id not in fused:
+            fused[chunk_id] = [knowledge_index.docstore.search(chunk_id), 0.0]
+        fused[chunk_id][1] += 1 / (RRF_K + rank + 1)
+    ranked = sorted(fused.values(), key=lambda hit: -hit[1])
+    return [(doc, score) for doc, score in ranked[:k]]
+
+
+def _num_candidates(num_retrieved_docs, num_docs_final: int, reranker) -> int:
+    if reranker is None:
+        return num_docs_final
+    return max(num_docs_final, num_retrieved_docs or reranker.candidates)
+
+
+def _select_chunks(question, docs_with_scores, num_docs_final: int, reranker):
+    if reranker is not None:
+        log.info("Reranking documents...")
+        docs_with_scores = reranker.rerank(question, docs_with_scores, num_docs_final)
+    return docs_with_scores[:num_docs_final]
+
+
+def _references(docs_with_scores) -> List[Tuple[str, str, float]]:
+    return [
+        (doc.page_content, doc.metadata.get("source", "unknown"), float(score))
+        for doc, score in docs_with_scores
+    ]
+
+
+def retrieve_context(
+    question: str,
+    llm: Pipeline,
+    knowledge_index: FAISS,
+    prompt_template: str,
+    reranker: Optional[Reranker] = None,
+    num_retrieved_docs: Optional[int] = None,
+    num_docs_final: int = 5,
+    filters: Optional[dict] = None,
+    context_packer: Optional[ContextPacker] = None,
+) -> Tuple[str, List[Tuple[str, str, float]], int]:
+    """Retrieves the references to a question and builds the reader prompt
+
+    With a `context_packer`, spare chunks are retrieved and packed into at
+    most `num_docs_final` passages within its token budget. Returns the
+    prompt, the references it contains and its length in tokens.
+    """
+    num_chunks = num_docs_final
+    if context_packer is not None:
+        num_chunks *= CONTEXT_CANDIDATE_FACTOR
+    docs_with_scores = retrieve_chunks(
+        question,
+        knowledge_index,
+        num_retrieved_docs,
+        num_chunks,
+        reranker,
+        filters,
+    )
+    return _prepare_prompt(
+        question, docs_with_scores, llm, prompt_template, num_docs_final, context_packer
+    )
+
+
+def _prepare_prompt(
+    question, docs_with_scores, llm, prompt_template, num_docs_final, context_packer
+):
+    if context_packer is not None:
+        return context_packer.pack(
+            question, docs_with_scores, prompt_template, num_docs_final
+        )
+    relevant_docs = _references(docs_with_scores[:num_docs_final])
+    prompt = build_prompt(question, relevant_docs, prompt_template)
+    return prompt, relevant_docs, count_tokens(llm.tokenizer, prompt)
+
 
 def answer_with_rag(
     question: str,
     llm: Pipeline,
     knowledge_index: FAISS,
     prompt_template: str,
-    # Commented out reranker-related code to avoid issues with colbert
-    # reranker: Optional[RAGPretrainedModel] = None,
-    num_retrieved_docs: int = 100,
+    reranker: Optional[Reranker] = None,
+    num_retrieved_docs: Optional[int] = None,
     num_docs_final: int = 5,
-) -> Tuple[str, List[Tuple[str, str, float]]]:
-    """Generates an answer to the user queries with references"""
+    filters: Optional[dict] = None,
+    context_packer: Optional[ContextPacker] = None,
+) -> Tuple[str, List[Tuple[str, str, float]], int]:
+    """Generates an answer to the user queries with references
+
+    `filters` restrict the references to chunks of matching articles and
+    sections (see services.metadata_index). Returns the answer, the
+    references and the number of prompt tokens (see retrieve_context).
+    """
     answer_start_time = time.time()
 
-    log.info("Retrieving documents...")
-    docs_with_scores = knowledge_index.similarity_search_with_score(
-        query=question, k=num_retrieved_docs
+    final_prompt, relevant_docs, prompt_tokens = retrieve_context(
+        question,
+        llm,
+        knowledge_index,
+        prompt_template,
+        reranker,
+        num_retrieved_docs,
+        num_docs_final,
+        filters,
+        context_packer,
     )
 
-    doc_contents = [doc.page_content for doc, _ in docs_with_scores]
-    doc_metadata = [doc.metadata.get("source", "unknown") for doc, _ in docs_with_scores]
-    doc_scores = [score for _, score in docs_with_scores]
-
-    # Commented out reranker-related code to avoid issues with colbert
-    # if reranker:
-    #     log.info("Reranking documents...")
-    #     # reranked_docs = reranker.rerank(question, doc_contents, k=num_docs_final)
-    #     # reranked_contents = [
-    #     #     rdoc["content"] if isinstance(rdoc, dict) else rdoc
-    #     #     for rdoc in reranked_docs
-    #     # ]
-
-    #     # relevant_docs = [
-    #     #     (
-    #     #         content,
-    #     #         doc_metadata[doc_contents.index(content)],
-    #     #         doc_scores[doc_contents.index(content)],
-    #     #     )
-    #     #     for content in reranked_contents
-    #     # ]
-    # else:
-    relevant_docs = [
-        (doc_contents[i], doc_metadata[i], doc_scores[i])
-        for i in range(min(num_docs_final, len(doc_contents)))
-    ]
+    log.info(f"Generating answer from a prompt of {prompt_tokens} tokens...")
+    answer = _generated_text(llm(final_prompt))
+    answer_elapsed_time = format_time(int(time.time() - answer_start_time))
+    log.info(f"Answer generated in {answer_elapsed_time}")
+
+    return answer, relevant_docs, prompt_tokens
+
+
+def answer_with_rag_batch(
+    questions: List[str],
+    llm: Pipeline,
+    knowledge_index: FAISS,
+    prompt_template: str,
+    reranker: Optional[Reranker] = None,
+    num_retrieved_docs: Optional[int] = None,
+    num_docs_final: int = 5,
+    batch_size: int = 8,
+    filters: Optional[dict] = None,
+    context_packer: Optional[ContextPacker] = None,
+) -> List[Tuple[str, List[Tuple[str, str, float]], int]]:
+    """answer_with_rag for several questions, retrieved together and batch-generated"""
+    answer_start_time = time.time()
+    num_chunks = num_docs_final
+    if context_packer is not None:
+        num_chunks *= CONTEXT_CANDIDATE_FACTOR
+    all_docs_with_scores = retrieve_chunks_batch(
+        questions,
+        knowledge_index,
+        num_retrieved_docs,
+        num_chunks,
+        reranker,
+        filters,
+    )
+    prompts, all_relevant_docs, all_prompt_tokens = zip(
+        *(
+            _prepare_prompt(
+                question,
+                docs_with_scores,
+                llm,
+                prompt_template,
+                num_docs_final,
+                context_packer,
+            )
+            for question, docs_with_scores in zip(questions, all_docs_with_scores)
+        )
+    )
+    log.info(f"Generating {len(prompts)} answers...")
+    outputs = llm(list(prompts), batch_size=batch_size)
+    answers = [_generated_text(output) for output in outputs]
+    answer_elapsed_time = format_time(int(time.time() - answer_start_time))
+    log.info(f"{len(answers)} answers generated in {answer_elapsed_time}")
+
+    return list(zip(answers, all_relevant_docs, all_prompt_tokens))
 
+
+def make_streamer(llm: Pipeline, timeout: Optional[float] = None):
+    """Iterator over the text of the answer being generated, for generate_answer
+
+    Iterating raises queue.Empty if no new text arrives within `timeout`.
+    """
+    return TextIteratorStreamer(
+        llm.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=timeout
+    )
+
+
+def generate_answer(prompt: str, llm: Pipeline, streamer=None) -> str:
+    """Generates the answer to a prompt from build_prompt, streaming it to `streamer`"""
+    if streamer is None:
+        return _generated_text(llm(prompt))
+    try:
+        return _generated_text(llm(prompt, streamer=streamer))
+    except Exception:
+        # Stops the reader of the stream, which would otherwise wait for more text
+        streamer.end()
+        raise
+
+
+def count_tokens(tokenizer, text: str) -> int:
+    return len(tokenizer(text, add_special_tokens=False).input_ids)
+
+
+def build_prompt(question: str, relevant_docs, prompt_template: str) -> str:
     context = "\nExtracted documents:\n"
     for i, (content, _, _) in enumerate(relevant_docs):
         context += f"Document {i + 1}:::\n{content}\n"
+    return prompt_template.format(question=question, context=context)
 
-    final_prompt = prompt_template.format(question=question, context=context)
-    log.info("Generating answer...")
-    llm_output = llm(final_prompt)
-    if isinstance(llm_output, list) and len(llm_output) > 0 and isinstance(llm_output[0], dict):
-        answer = llm_output[0].get("generated_text", "No generated text found")
-    else:
-        raise ValueError("Unexpected output format from LLM pipeline")
-    answer_elapsed_time = format_time(int(time.time() - answer_start_time))
-    log.info(f"Answer generated in {answer_elapsed_time}")
 
-    return answer, relevant_docs
+def _generated_text(llm_output) -> str:
+    if isinstance(llm_output, list) and len(llm_output) > 0 and isinstance(llm_output[0], dict):
+        return llm_output[0].get("generated_text", "No generated text found")
+    raise ValueError("Unexpected output format from LLM pipeline")
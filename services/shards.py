@@ -0,0 +1,311 @@
+import os
+import json
+import time
+import socket
+import logging
+import hashlib
+import threading
+from pathlib import Path
+from typing import Iterator, List, Optional
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from .dedup import ChunkDeduplicator
+from .index_manifest import IndexManifest, save_checkpoint
+
+SHARDS_FILE = "shards.json"
+DONE_SUFFIX = ".done"
+LEASE_SUFFIX = ".lease"
+MERGE_BATCH_SIZE = 10000
+
+
+def shard_root_for(index_path: Path) -> Path:
+    """Directory holding the shards of the index at `index_path`"""
+    index_path = Path(index_path)
+    return index_path.with_name(index_path.name + ".shards")
+
+
+def shard_dir(shard_root: Path, shard_id: int) -> Path:
+    return Path(shard_root) / f"shard-{shard_id:03d}"
+
+
+def shard_of(path: Path, num_shards: int) -> int:
+    """Deterministic shard of an input file, stable when other files come and go"""
+    digest = hashlib.sha1(str(path).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+
+def shard_files(input_files: List[Path], shard_id: int, num_shards: int) -> List[Path]:
+    return [file for file in input_files if shard_of(file, num_shards) == shard_id]
+
+
+def shard_fingerprint(files: List[Path]) -> str:
+    """Identifies a shard's inputs, so a finished shard is redone when they change"""
+    digest = hashlib.sha256()
+    for file in files:
+        stat = file.stat()
+        digest.update(f"{file}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def init_shard_root(shard_root: Path, num_shards: int):
+    """Creates the shard directory, or checks it was created for `num_shards`"""
+    shard_root = Path(shard_root)
+    shard_root.mkdir(parents=True, exist_ok=True)
+    layout_path = shard_root / SHARDS_FILE
+    try:
+        fd = os.open(layout_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"num_shards": num_shards}, f)
+    except FileExistsError:
+        pass
+
+    layout = read_shard_layout(shard_root)
+    if layout["num_shards"] != num_shards:
+        raise ValueError(
+            f"{shard_root} was created with {layout['num_shards']} shards, "
+            f"not {num_shards}; remove it to reshard"
+        )
+
+
+def read_shard_layout(shard_root: Path) -> dict:
+    with open(Path(shard_root) / SHARDS_FILE, "r") as f:
+        return json.load(f)
+
+
+def is_shard_done(shard_root: Path, shard_id: int, fingerprint: str) -> bool:
+    done_path = shard_dir(shard_root, shard_id).with_suffix(DONE_SUFFIX)
+    return done_path.exists() and done_path.read_text().strip() == fingerprint
+
+
+def mark_shard_done(shard_root: Path, shard_id: int, fingerprint: str):
+    done_path = shard_dir(shard_root, shard_id).with_suffix(DONE_SUFFIX)
+    tmp_path = done_path.with_name(done_path.name + ".tmp")
+    tmp_path.write_text(fingerprint)
+    os.replace(tmp_path, done_path)
+
+
+class ShardLease:
+    """Exclusive, expiring claim on one shard, held as a file on shared storage
+
+    The lease file is created atomically and its mtime is refreshed by a
+    heartbeat thread. A lease not refreshed for `ttl` seconds is considered
+    abandoned (e.g. its worker crashed) and may be taken over; the partial
+    shard it leaves behind is resumed from its last checkpoint.
+    """
+
+    def __init__(self, shard_root: Path, shard_id: int, ttl: float = 600):
+        self.path = shard_dir(shard_root, shard_id).with_suffix(LEASE_SUFFIX)
+        self.shard_id = shard_id
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._stop_event = threading.Event()
+        self._heartbeat = None
+
+    def _create(self) -> bool:
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump({"owner": self.owner, "acquired": time.time()}, f)
+        return True
+
+    @staticmethod
+    def _read(path: Path) -> tuple:
+        """(owner, mtime) of a lease file; the owner is None while it is written"""
+        mtime = path.stat().st_mtime
+        try:
+            with open(path, "r") as f:
+                owner = json.load(f).get("owner")
+        except ValueError:
+            owner = None
+        return owner, mtime
+
+    def acquire(self) -> bool:
+        if self._create():
+            self._start_heartbeat()
+            return True
+        try:
+            expired = self._read(self.path)
+        except FileNotFoundError:
+            return False
+        if time.time() - expired[1] < self.ttl:
+            return False
+
+        # Move the expired lease aside first so only one worker can take it over
+        expired_path = self.path.with_name(f"{self.path.name}.expired-{self.owner}")
+        try:
+            os.rename(self.path, expired_path)
+        except FileNotFoundError:
+            return False
+        # Another worker may have taken the lease over, or its owner refreshed
+        # it, since it was judged expired: then it is put back untouched
+        if self._read(expired_path) != expired:
+            try:
+                os.link(expired_path, self.path)
+            except FileExistsError:
+                logging.error(f"Could not restore the lease on shard {self.shard_id}")
+            os.remove(expired_path)
+            return False
+        os.remove(expired_path)
+        logging.warning(f"Taking over expired lease on shard {self.shard_id}")
+        if not self._create():
+            return False
+        self._start_heartbeat()
+        return True
+
+    def _start_heartbeat(self):
+        def beat():
+            while not self._stop_event.wait(self.ttl / 3):
+                try:
+                    os.utime(self.path)
+                except FileNotFoundError:
+                    logging.error(f"Lease on shard {self.shard_id} was lost")
+                    return
+
+        self._heartbeat = threading.Thread(target=beat, daemon=True)
+        self._heartbeat.start()
+
+    def release(self):
+        self._stop_event.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def claim_shards(
+    shard_root: Path,
+    input_files: List[Path],
+    num_shards: int,
+    ttl: float = 600,
+    shard_id: Optional[int] = None,
+) -> Iterator[tuple]:
+    """Yields (shard id, files, fingerprint) for each unfinished shard this worker wins
+
+    The lease is held until the caller asks for the next shard. With
+    `shard_id`, only that shard is considered.
+    """
+    shard_ids = range(num_shards) if shard_id is None else [shard_id]
+    for i in shard_ids:
+        files = shard_files(input_files, i, num_shards)
+        fingerprint = shard_fingerprint(files)
+        if is_shard_done(shard_root, i, fingerprint):
+            continue
+        lease = ShardLease(shard_root, i, ttl)
+        if not lease.acquire():
+            logging.info(f"Shard {i} is leased by another worker")
+            continue
+        try:
+            # Another worker may have finished it between the check and the lease
+            if not is_shard_done(shard_root, i, fingerprint):
+                yield i, files, fingerprint
+        finally:
+            lease.release()
+
+
+def merge_shards(
+    shard_root: Path, index_path: Path, input_files: List[Path], embedding_model
+):
+    """Combines finished shards into a single index at `index_path`
+
+    Chunks are added in the order of `input_files`, so the merged index holds
+    the same chunks, ids and vector order as a serial build of those files.
+    Near-duplicate removal, if enabled, only ran within each shard. The merged
+    manifest lets later serial builds extend the index incrementally.
+    """
+    shard_root = Path(shard_root)
+    num_shards = read_shard_layout(shard_root)["num_shards"]
+    shard_inputs = [shard_files(input_files, i, num_shards) for i in range(num_shards)]
+    unfinished = [
+        i
+        for i, files in enumerate(shard_inputs)
+        if not is_shard_done(shard_root, i, shard_fingerprint(files))
+    ]
+    if unfinished:
+        raise RuntimeError(
+            f"Shards not finished for these inputs: {', '.join(map(str, unfinished))}"
+        )
+
+    shards = []
+    settings = None
+    for i, files in enumerate(shard_inputs):
+        if not files:
+            shards.append((None, IndexManifest()))
+            continue
+        path = shard_dir(shard_root, i)
+        manifest = IndexManifest.load(path)
+        if settings is not None and manifest.settings != settings:
+            raise ValueError(f"Shard {i} was built with different settings")
+        settings = manifest.settings
+        vectorstore = None
+        if (path / "index.faiss").exists():
+            vectorstore = FAISS.load_local(
+                str(path), embedding_model, allow_dangerous_deserialization=True
+            )
+        shards.append((vectorstore, manifest))
+
+    merged_manifest = IndexManifest(settings=settings)
+    deduplicator = None
+    if settings and settings.get("dedup_threshold"):
+        deduplicator = ChunkDeduplicator(settings["dedup_threshold"])
+        for i, files in enumerate(shard_inputs):
+            if files:
+                deduplicator.load(shard_dir(shard_root, i))
+
+    positions = [
+        {chunk_id: pos for pos, chunk_id in vectorstore.index_to_docstore_id.items()}
+        if vectorstore is not None
+        else {}
+        for vectorstore, _ in shards
+    ]
+
+    merged = None
+    batch = []
+
+    def flush():
+        nonlocal merged
+        text_embeddings = [(doc.page_content, vector) for _, doc, vector in batch]
+        metadatas = [doc.metadata for _, doc, _ in batch]
+        ids = [chunk_id for chunk_id, _, _ in batch]
+        if merged is None:
+            merged = FAISS.from_embeddings(
+                text_embeddings,
+                embedding_model,
+                metadatas=metadatas,
+                ids=ids,
+                distance_strategy=DistanceStrategy.COSINE,
+            )
+        else:
+            merged.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+        batch.clear()
+
+    for file in input_files:
+        i = shard_of(file, num_shards)
+        vectorstore, manifest = shards[i]
+        path = str(file)
+        if path not in manifest.files:
+            continue
+        merged_manifest.files[path] = manifest.files[path]
+        for chunk_id in manifest.chunk_ids(path):
+            pos = positions[i].get(chunk_id)
+            if pos is None:
+                # Near-duplicates have no vector of their own
+                continue
+            doc = vectorstore.docstore.search(chunk_id)
+            batch.append((chunk_id, doc, vectorstore.index.reconstruct(pos)))
+            if len(batch) >= MERGE_BATCH_SIZE:
+                flush()
+    if batch:
+        flush()
+
+    if merged is None:
+        raise RuntimeError("The shards contain no chunks")
+    save_checkpoint(merged, merged_manifest, index_path, deduplicator)
+    logging.info(
+        f"Merged {num_shards} shards: {merged.index.ntotal} chunks from "
+        f"{len(merged_manifest.files)} files"
+    )
+    return merged
@@ -1,4 +1,5 @@
 import logging
+import resource
 
 
 def configure_logging():
@@ -23,3 +24,8 @@ def format_time(seconds: int) -> str:
         return f"{seconds}s"
     else:
         return "0s"
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB (ru_maxrss is KB on Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
@@ -0,0 +1,34 @@
+import json
+import faiss
+import numpy as np
+import pytest
+from services import ann_index
+from services.ann_index import ANN_INDEX_FILE, build_ann_index
+
+
+def make_flat_index(index_dir, num_vectors=512, dim=16):
+    vectors = np.random.default_rng(0).random((num_vectors, dim), dtype=np.float32)
+    index = faiss.IndexFlatIP(dim)
+    index.add(vectors)
+    faiss.write_index(index, str(index_dir / "index.faiss"))
+    (index_dir / "manifest.json").write_text(json.dumps({"files": {}}))
+
+
+@pytest.mark.parametrize(
+    "index_type, vector_codec",
+    [("ivf_flat", "float32"), ("hnsw", "float32"), ("ivf_flat", "sq8")],
+)
+def test_rebuild_without_changes_skips_training(
+    tmp_path, monkeypatch, index_type, vector_codec
+):
+    make_flat_index(tmp_path)
+    options = dict(nlist=4, recall_queries=16, vector_codec=vector_codec)
+    report = build_ann_index(tmp_path, index_type, **options)
+    mtime = (tmp_path / ANN_INDEX_FILE).stat().st_mtime_ns
+
+    def index_factory(*args):
+        raise AssertionError("The up-to-date ANN index was rebuilt")
+
+    monkeypatch.setattr(ann_index.faiss, "index_factory", index_factory)
+    assert build_ann_index(tmp_path, index_type, **options) == report
+    assert (tmp_path / ANN_INDEX_FILE).stat().st_mtime_ns == mtime